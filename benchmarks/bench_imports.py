@@ -0,0 +1,104 @@
+
+# coding: utf-8
+
+# In[1]:
+
+"""Times importing each datapipeline module in a fresh interpreter and reports
+which heavy optional libraries each import pulls in. Run from the directory
+holding datapipeline and benchmarks:
+
+    python -m benchmarks.bench_imports --repeat 5
+
+pandas and numpy are timed too, as the floor every module pays.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+from benchmarks.bench_pipeline import environment
+
+
+# In[2]:
+
+MODULES = ['numpy', 'pandas',
+           'datapipeline.tools.instrument', 'datapipeline.tools.common_funcs',
+           'datapipeline.tools.subjindex', 'datapipeline.tools.shards',
+           'datapipeline.tools.journal', 'datapipeline.tools.dedup',
+           'datapipeline.tools.labelindex',
+           'datapipeline.tools.tablestore', 'datapipeline.tools.dag',
+           'datapipeline.tools.config', 'datapipeline.tools.radarplot',
+           'datapipeline.gather.codetranslator', 'datapipeline.gather.cogtestdates',
+           'datapipeline.gather.factoranalysis', 'datapipeline.gather.pibparams',
+           'datapipeline.gather.pibdvr',
+           'datapipeline.gather.mri', 'datapipeline.gather.fdg',
+           'datapipeline.gather.pvc',
+           'datapipeline.gather.inventory', 'datapipeline.gather.cohortarray', 'datapipeline.gather.gathermany',
+           'datapipeline.merge.datamerge', 'datapipeline.analyze.mixedmodels',
+           'datapipeline.analyze.resampling', 'datapipeline.analyze.correlations',
+           'datapipeline.__main__']
+
+#libraries that should only be imported by the functions that need them
+HEAVY = ['nibabel', 'scipy', 'matplotlib', 'statsmodels', 'yaml']
+
+_PROBE = """
+import sys, time, json, importlib
+t0 = time.perf_counter()
+importlib.import_module(%r)
+secs = time.perf_counter() - t0
+print(json.dumps({'secs': secs, 'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+
+def time_import(module, repeat=3):
+    """Imports module in repeat fresh interpreters and keeps the fastest.
+    Interpreter start-up is not counted.
+    """
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', _PROBE %(module, HEAVY)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+        if out.returncode != 0:
+            msg = out.stderr.strip().splitlines()
+            return {'module': module, 'status': 'error', 'error': msg[-1] if msg else ''}
+        cur = json.loads(out.stdout.strip().splitlines()[-1])
+        if best is None or cur['secs'] < best['secs']:
+            best = cur
+    return {'module': module, 'status': 'ok', 'import_s': best['secs'],
+            'heavy_loaded': best['heavy']}
+
+
+# In[3]:
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark import time of datapipeline '
+                                     'modules.')
+    parser.add_argument('--modules', nargs='+', default=MODULES,
+                        help='modules to import, default all')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='fresh interpreters per module, the fastest is kept')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON file to write, default prints to stdout')
+    args = parser.parse_args(argv)
+
+    results = []
+    for module in args.modules:
+        res = time_import(module, args.repeat)
+        results.append(res)
+        sys.stderr.write('%-38s %-6s %s\n' %(module, res['status'],
+                         '%.3fs %s' %(res['import_s'], ' '.join(res['heavy_loaded']))
+                         if res['status'] == 'ok' else res['error']))
+
+    out = json.dumps({'environment': environment(), 'results': results}, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
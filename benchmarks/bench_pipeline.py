@@ -0,0 +1,261 @@
+
+# coding: utf-8
+
+# In[1]:
+
+"""Times the gather and merge stages on synthetic cohorts and writes the
+results as JSON. Run from the directory holding datapipeline and benchmarks:
+
+    python -m benchmarks.bench_pipeline --subjects 100 1000 10000 --timepoints 5
+
+Stages whose inputs cannot be made here (for example generate_values without
+FSL on the path) are reported with status 'skipped', and stages that raise are
+reported with status 'error' so one failure does not stop the run.
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthcohort as sc
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import cogtestdates
+from datapipeline.gather import factoranalysis
+from datapipeline.gather import pibparams
+from datapipeline.gather import fdg
+from datapipeline.merge import datamerge
+
+
+# In[2]:
+
+def measure(func, repeat=1):
+    """Calls func repeat times and keeps the fastest call, then once more
+    with tracemalloc running to find its peak memory. Tracing slows every
+    allocation, so it is kept out of the timed calls.
+
+    Returns
+    -------
+    result : dict
+        Wall and CPU seconds of the fastest call, peak traced memory in MB of
+        the extra call and the increase in the process high-water RSS in MB
+        over the timed calls
+    """
+    best = None
+    gc.collect()
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for _ in range(repeat):
+        gc.collect()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        func()
+        cur = {'wall_s': time.perf_counter() - wall0, 'cpu_s': time.process_time() - cpu0}
+        if best is None or cur['wall_s'] < best['wall_s']:
+            best = cur
+    #ru_maxrss is in kB on Linux
+    best['rss_growth_mb'] = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss0) / 1024.
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    best['peak_mb'] = peak / 2.**20
+    return best
+
+
+# In[3]:
+
+def bench_rate_of_change(nsubs, maxtps, workdir):
+    tbl = sc.cogtests_long(nsubs, maxtps)
+    return len(tbl), lambda: cf.rate_of_change(tbl.copy(), 'codeb', 'NP_Tp', 'NP_Date',
+                                               'F0', 'F0_sl')
+
+
+def bench_zscore(nsubs, maxtps, workdir):
+    sessions = sc.session_tables(nsubs, maxtps)
+    blpth = os.path.join(workdir, 'baseline.xlsx')
+    sc.session_tables(min(nsubs, 500), 1, seed=6)['sess1'].to_excel(blpth, index=False)
+    rows = sum(len(t) for t in sessions.values())
+    return rows, lambda: factoranalysis.zscore(blpth, sessions, sc.TESTS)
+
+
+def bench_factorscores(nsubs, maxtps, workdir):
+    subjdata = sc.zscored_long(nsubs, maxtps)
+    wpth = os.path.join(workdir, 'weights.xlsx')
+    sc.factor_weights().to_excel(wpth, index=False)
+    return len(subjdata), lambda: factoranalysis.factorscores(subjdata, wpth, sc.TESTS)
+
+
+def bench_cogtestdates(nsubs, maxtps, workdir):
+    wide, staticrename = sc.cogdates_wide(nsubs, maxtps)
+    path = os.path.join(workdir, 'cogdates.xlsx')
+    wide.to_excel(path, index=False)
+    outdir = os.path.join(workdir, 'out', '')
+    os.makedirs(outdir)
+    return len(wide), lambda: cogtestdates.cogtestdates_run(path, staticrename, outdir)
+
+
+def bench_pibparams(nsubs, maxtps, workdir):
+    paths = sc.write_excel_inputs(nsubs, maxtps, workdir)
+    outdir = os.path.join(workdir, 'out', '')
+    os.makedirs(outdir)
+    pibrename = dict((col, col) for col in sc.PIB_COLS)
+    return (len(sc.pib_table(nsubs, maxtps)),
+            lambda: pibparams.pibparams_run(paths['pib'], pibrename, outdir, 1.08))
+
+
+def bench_mergelots(nsubs, maxtps, workdir):
+    tbldict = sc.merge_inputs(nsubs, maxtps)
+    tbldict['cogtests'] = tbldict['cogtestdates'].merge(tbldict['cogdata'], on=['codeb', 'NP_Tp'])
+    for key in ['pibparams', 'aseg_change', 'fdg_metaroi']:
+        tpcol = [c for c in tbldict[key].columns if '_Tp' in c][0]
+        flat = tbldict[key][tbldict[key][tpcol] == 1]
+        tbldict['%s_flat' %key] = flat.merge(tbldict['codetranslator'], on='codea')
+    tbldict['subjinfo'] = tbldict['subjinfo'].merge(tbldict['codetranslator'], on='codea')
+    tblstojoin = ['cogtests', 'subjinfo', 'pibparams_flat', 'aseg_change_flat', 'fdg_metaroi_flat']
+    return (len(tbldict['cogtests']),
+            lambda: datamerge.mergelots(tbldict, tblstojoin, ['codea', 'codeb']))
+
+
+def bench_datamerge_run(nsubs, maxtps, workdir):
+    tbldict = sc.merge_inputs(nsubs, maxtps)
+    outdir = os.path.join(workdir, 'merge', '')
+    os.makedirs(outdir)
+    sc.write_pickles(tbldict, outdir)
+    filenames = sorted(tbldict)
+    return (len(tbldict['cogtestdates']),
+            lambda: datamerge.datamerge_run(filenames, outdir, ['F0', 'F1', 'F2']))
+
+
+def bench_pet_mri_date(nsubs, maxtps, workdir):
+    rootpath = os.path.join(workdir, 'fs', '')
+    subs = sc.freesurfer_tree(nsubs, maxtps, rootpath)
+    return len(subs), lambda: [cf.pet_mri_date(rootpath, sub) for sub in subs]
+
+
+def bench_extractFSvolumes(nsubs, maxtps, workdir):
+    rootpath = os.path.join(workdir, 'fs', '')
+    subs = sc.freesurfer_tree(nsubs, maxtps, rootpath)
+    rois = sorted(sc.FS_LUT)
+    return len(subs), lambda: cf.extractFSvolumes(rootpath, subs, rois, sc.FS_LUT,
+                                                  'aparc+aseg.nii.gz')
+
+
+def bench_generate_values(nsubs, maxtps, workdir):
+    if shutil.which('fslstats') is None:
+        return None, 'fslstats not found on the path'
+    datadir = os.path.join(workdir, 'fdgdata', '')
+    maskdir = os.path.join(workdir, 'fdgmask', '')
+    os.makedirs(maskdir)
+    files, template = sc.fdg_tree(nsubs, maxtps, datadir)
+    fdg.create_masks([os.path.basename(f) for f in files], datadir, maskdir, template)
+    return len(files), lambda: fdg.generate_values(maskdir)
+
+
+#stages timed, and whether they build image files
+BENCHMARKS = [
+    ('rate_of_change', bench_rate_of_change, False),
+    ('zscore', bench_zscore, False),
+    ('factorscores', bench_factorscores, False),
+    ('cogtestdates', bench_cogtestdates, False),
+    ('pibparams', bench_pibparams, False),
+    ('mergelots', bench_mergelots, False),
+    ('datamerge_run', bench_datamerge_run, False),
+    ('pet_mri_date', bench_pet_mri_date, True),
+    ('extractFSvolumes', bench_extractFSvolumes, True),
+    ('generate_values', bench_generate_values, True),
+]
+
+
+# In[4]:
+
+def run_one(name, setup, nsubs, maxtps, repeat):
+    """Builds the inputs of a single stage and times it
+    """
+    workdir = tempfile.mkdtemp(prefix='dpbench_')
+    result = {'stage': name, 'subjects': nsubs, 'timepoints': maxtps}
+    try:
+        rows, func = setup(nsubs, maxtps, workdir)
+        if rows is None:
+            result.update({'status': 'skipped', 'reason': func})
+            return result
+        result.update(measure(func, repeat))
+        result.update({'status': 'ok', 'rows': rows,
+                       'rows_per_s': rows / result['wall_s'] if result['wall_s'] else None})
+    except Exception as e:
+        msg = str(e).strip().splitlines()
+        result.update({'status': 'error',
+                       'error': '%s: %s' %(type(e).__name__, msg[0] if msg else '')})
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def environment():
+    """Versions and commit the results were made with
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         universal_newlines=True,
+                                         stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+            'host': platform.node(), 'python': platform.python_version(),
+            'pandas': pd.__version__, 'numpy': np.__version__}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark datapipeline stages on '
+                                     'synthetic cohorts.')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[100, 1000],
+                        help='cohort sizes to run, e.g. 100 1000 10000 50000')
+    parser.add_argument('--timepoints', type=int, default=5,
+                        help='largest number of timepoints per subject (1-9, as _v# '
+                        'names hold one digit)')
+    parser.add_argument('--max-scans', type=int, default=200,
+                        help='largest cohort used for stages that write image files')
+    parser.add_argument('--stages', nargs='+', default=None,
+                        help='names of stages to run, default all')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='times to run each stage, the fastest is kept')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSON file to write, default prints to stdout')
+    args = parser.parse_args(argv)
+
+    results = []
+    for nsubs in args.subjects:
+        for name, setup, images in BENCHMARKS:
+            if args.stages and name not in args.stages:
+                continue
+            n = min(nsubs, args.max_scans) if images else nsubs
+            res = run_one(name, setup, n, args.timepoints, args.repeat)
+            results.append(res)
+            sys.stderr.write('%-18s %6d subjects  %-7s %s\n' %(name, n, res['status'],
+                             '%.3fs' %res['wall_s'] if 'wall_s' in res else
+                             res.get('error', res.get('reason', ''))))
+
+    out = json.dumps({'environment': environment(), 'results': results}, indent=1)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
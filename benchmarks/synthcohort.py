@@ -0,0 +1,289 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import numpy as np
+import pandas as pd
+
+
+# In[2]:
+
+#cognitive tests in the synthetic session workbooks
+TESTS = ['CVLT', 'Stroop', 'ListeningSpan', 'Category', 'Arithmetic', 'DigitSymbol',
+         'DSforward', 'DSbackward', 'MentalControl', 'LogicalMemory', 'VisualRep',
+         'Tapping', 'Trails']
+
+#label values written into the synthetic aparc+aseg volumes
+FS_LUT = {'Left-Hippocampus': 17, 'Right-Hippocampus': 53, 'Left-Amygdala': 18,
+          'Right-Amygdala': 54, 'Left-Lateral-Ventricle': 4, 'Right-Lateral-Ventricle': 43}
+
+#columns of the synthetic PIB sheets
+PIB_COLS = ['codea', 'PIB_Tp', 'PIB_Scandate', 'PIB_Age', 'PIB_Index']
+
+
+def subject_codes(nsubs):
+    """Returns matched lists of codea and codeb values for nsubs subjects.
+    Every codea is told apart by common_funcs.get_id.
+    """
+    codea = ['B%05d' %i for i in range(nsubs)]
+    codeb = [10000 + i for i in range(nsubs)]
+    return codea, codeb
+
+
+def visits(nsubs, maxtps, seed=0):
+    """Makes a long table with one row per subject per visit. Each subject gets
+    between 1 and maxtps visits, roughly 18 months apart.
+
+    Parameters
+    ----------
+    nsubs : int
+        Number of subjects
+    maxtps : int
+        Largest number of timepoints a subject can have
+    seed : int
+        Seed for the random number generator
+
+    Returns
+    -------
+    tbl : pandas DataFrame
+        Columns codea, codeb, Tp, Date and Age
+    """
+    rng = np.random.RandomState(seed)
+    codea, codeb = subject_codes(nsubs)
+    ntps = rng.randint(1, maxtps + 1, size=nsubs)
+    sub = np.repeat(np.arange(nsubs), ntps)
+    tp = np.concatenate([np.arange(1, n + 1) for n in ntps])
+    start = pd.Timestamp('2005-01-01') + pd.to_timedelta(rng.randint(0, 3650, nsubs), unit='D')
+    gap = pd.to_timedelta((tp - 1) * 548 + rng.randint(-60, 60, len(tp)), unit='D')
+    tbl = pd.DataFrame({'codea': np.array(codea)[sub], 'codeb': np.array(codeb)[sub], 'Tp': tp})
+    tbl['Date'] = pd.DatetimeIndex(start[sub]) + gap
+    tbl['Age'] = rng.uniform(60, 85, nsubs)[sub] + (tp - 1) * 1.5
+    return tbl
+
+
+# In[3]:
+
+def cogtests_long(nsubs, maxtps, seed=0):
+    """Long cognitive table in the layout datamerge makes from cogtestdates and
+    cogdata, with raw test scores and factor scores F0-F2
+    """
+    rng = np.random.RandomState(seed + 1)
+    tbl = visits(nsubs, maxtps, seed)
+    tbl = tbl.rename(columns={'Tp': 'NP_Tp', 'Date': 'NP_Date', 'Age': 'NP_Age'})
+    bl = tbl.groupby('codeb')['NP_Date'].transform('min')
+    tbl['NP_YrsRelBL'] = (tbl['NP_Date'] - bl).dt.days / 365.25
+    for test in TESTS + ['F0', 'F1', 'F2']:
+        tbl[test] = rng.normal(0, 1, len(tbl)) - 0.05 * tbl['NP_YrsRelBL']
+    return tbl
+
+
+def cogdates_wide(nsubs, maxtps, seed=0):
+    """Wide cognitive testing date sheet as read by cogtestdates_run, with static
+    subject columns and one 'N:: field' column per timepoint and field
+
+    Returns
+    -------
+    wide : pandas DataFrame
+    staticrename : dict
+        Rename map for the static columns, as passed to cogtestdates_run
+    """
+    rng = np.random.RandomState(seed + 2)
+    tbl = visits(nsubs, maxtps, seed)
+    codea, _ = subject_codes(nsubs)
+    wide = pd.DataFrame({'codea': codea})
+    wide['Sex'] = rng.randint(1, 3, nsubs)
+    wide['Education'] = rng.randint(10, 22, nsubs)
+    wide['APOE1'] = rng.choice([2, 3, 4], nsubs, p=[0.1, 0.7, 0.2])
+    wide['APOE2'] = rng.choice([2, 3, 4], nsubs, p=[0.1, 0.7, 0.2])
+    for tp in range(1, maxtps + 1):
+        cur = tbl[tbl['Tp'] == tp].set_index('codea')
+        wide['%d:: AgeatSession' %tp] = wide['codea'].map(cur['Age'])
+        wide['%d:: NeuropsychExamTestDate' %tp] = wide['codea'].map(cur['Date'])
+    staticrename = {'Sex': 'Sex', 'Education': 'Education', 'APOE1': 'APOE1', 'APOE2': 'APOE2'}
+    return wide, staticrename
+
+
+def session_tables(nsubs, maxtps, seed=0):
+    """One table of raw cognitive scores per testing session, keyed 'sessN' and
+    indexed by codeb, as made by factoranalysis.cogprep
+    """
+    tbl = cogtests_long(nsubs, maxtps, seed)
+    sessions = {}
+    for tp, cur in tbl.groupby('NP_Tp'):
+        sessions['sess%d' %tp] = cur.set_index('codeb')[TESTS]
+    return sessions
+
+
+def zscored_long(nsubs, maxtps, seed=0):
+    """Z-scored cognitive data indexed by (subject, session), as made by
+    factoranalysis.zscore
+    """
+    tbl = cogtests_long(nsubs, maxtps, seed)
+    tbl['minor'] = ['sess%d' %tp for tp in tbl['NP_Tp']]
+    tbl = tbl.rename(columns={'codeb': 'major'}).set_index(['major', 'minor'])
+    return tbl[TESTS]
+
+
+def factor_weights(seed=0):
+    """Three rows of factor weights, one column per cognitive test
+    """
+    rng = np.random.RandomState(seed + 3)
+    return pd.DataFrame(rng.uniform(-0.5, 0.5, (3, len(TESTS))), columns=TESTS)
+
+
+def pib_table(nsubs, maxtps, seed=0):
+    """Long PIB table with the columns pibparams_run renames PIB sheets into
+    """
+    rng = np.random.RandomState(seed + 4)
+    tbl = visits(nsubs, maxtps, seed + 10)
+    tbl = tbl.rename(columns={'Tp': 'PIB_Tp', 'Date': 'PIB_Scandate', 'Age': 'PIB_Age'})
+    tbl['PIB_Index'] = rng.lognormal(0.1, 0.15, len(tbl))
+    return tbl
+
+
+# In[4]:
+
+def merge_inputs(nsubs, maxtps, seed=0):
+    """Dictionary of every table datamerge_run reads, keyed by file prefix
+    """
+    rng = np.random.RandomState(seed + 5)
+    cog = cogtests_long(nsubs, maxtps, seed)
+    codea, codeb = subject_codes(nsubs)
+    tbldict = {}
+    tbldict['cogtestdates'] = cog[['codea', 'codeb', 'NP_Tp', 'NP_Date', 'NP_Age', 'NP_YrsRelBL']]
+    tbldict['cogdata'] = cog[['codeb', 'NP_Tp'] + TESTS + ['F0', 'F1', 'F2']]
+    tbldict['subjinfo'] = pd.DataFrame({'codea': codea, 'Sex': rng.randint(1, 3, nsubs)})
+    tbldict['codetranslator'] = pd.DataFrame({'codea': codea, 'codeb': codeb})
+    tbldict['pibparams'] = pib_table(nsubs, maxtps, seed)[PIB_COLS]
+    mri = visits(nsubs, maxtps, seed + 20)[['codea', 'Tp', 'Date']]
+    mri.columns = ['codea', 'MRI_Tp', 'MRI_Scandate']
+    for roi in FS_LUT:
+        mri[roi] = rng.normal(4000, 400, len(mri))
+    tbldict['aseg_change'] = mri
+    fdg = visits(nsubs, maxtps, seed + 30)[['codea', 'Tp', 'Date']]
+    fdg.columns = ['codea', 'FDG_Tp', 'FDG_Scandate']
+    fdg['FDG_val'] = rng.normal(1.2, 0.1, len(fdg))
+    tbldict['fdg_metaroi'] = fdg
+    for key in tbldict:
+        tbldict[key] = tbldict[key].copy()
+    return tbldict
+
+
+def write_pickles(tbldict, outdir):
+    """Saves each table as outdir/<key>_synthetic.pkl for collect2dict
+    """
+    for key, tbl in tbldict.items():
+        tbl.to_pickle(os.path.join(outdir, '%s_synthetic.pkl' %key))
+
+
+def write_excel_inputs(nsubs, maxtps, outdir, seed=0):
+    """Writes the spreadsheets read by the cognitive and PIB gather stages:
+    the wide cognitive date sheet, one workbook per session, a baseline
+    reference sheet, factor weights and a PIB workbook with sheets 'i' and 'j'.
+
+    Returns
+    -------
+    paths : dict
+        Full paths of the files written
+    """
+    paths = {}
+    wide, _ = cogdates_wide(nsubs, maxtps, seed)
+    paths['cogdates'] = os.path.join(outdir, 'cogdates.xlsx')
+    wide.to_excel(paths['cogdates'], index=False)
+
+    paths['sessions'] = []
+    for sess, tbl in sorted(session_tables(nsubs, maxtps, seed).items()):
+        path = os.path.join(outdir, 'cog_%s.xlsx' %sess)
+        tbl.reset_index().to_excel(path, index=False)
+        paths['sessions'].append(path)
+
+    paths['baseline'] = os.path.join(outdir, 'baseline.xlsx')
+    session_tables(nsubs, 1, seed + 6)['sess1'].to_excel(paths['baseline'], index=False)
+    paths['weights'] = os.path.join(outdir, 'weights.xlsx')
+    factor_weights(seed).to_excel(paths['weights'], index=False)
+
+    pib = pib_table(nsubs, maxtps, seed)
+    paths['pib'] = os.path.join(outdir, 'pib.xlsx')
+    with pd.ExcelWriter(paths['pib']) as writer:
+        pib[pib['PIB_Tp'] == 1].to_excel(writer, sheet_name='i', index=False)
+        pib[pib['PIB_Tp'] > 1].to_excel(writer, sheet_name='j', index=False)
+    return paths
+
+
+# In[5]:
+
+def _label_volume(rng, shape):
+    """Label volume with a box of voxels for each label in FS_LUT
+    """
+    vol = np.zeros(shape, dtype=np.int16)
+    for label in FS_LUT.values():
+        corner = rng.randint(0, shape[0] - 6, 3)
+        size = rng.randint(3, 6, 3)
+        vol[corner[0]:corner[0] + size[0], corner[1]:corner[1] + size[1],
+            corner[2]:corner[2] + size[2]] = label
+    return vol
+
+
+def freesurfer_tree(nsubs, maxtps, rootpath, shape=(24, 24, 24), seed=0):
+    """Writes a fake FreeSurfer subjects directory with <codea>_v<tp> folders,
+    each holding stats/aseg.stats, scripts/recon-all.log and mri/aparc+aseg.nii.gz
+
+    Returns
+    -------
+    subs : list
+        Names of the subject folders written
+    """
+    import nibabel as nb
+    rng = np.random.RandomState(seed + 7)
+    tbl = visits(nsubs, maxtps, seed + 20)
+    subs = []
+    for codea, tp, date in zip(tbl['codea'], tbl['Tp'], tbl['Date']):
+        sub = '%s_v%d' %(codea, tp)
+        subs.append(sub)
+        for fold in ['stats', 'scripts', 'mri']:
+            path = os.path.join(rootpath, sub, fold)
+            if not os.path.exists(path):
+                os.makedirs(path)
+        with open(os.path.join(rootpath, sub, 'stats', 'aseg.stats'), 'w') as f:
+            f.write('# Measure IntraCranialVol, ICV, Intracranial Volume, %f, mm^3\n'
+                    %rng.normal(1.5e6, 1e5))
+            for i, (roi, label) in enumerate(sorted(FS_LUT.items())):
+                f.write('%3d %4d %8d %10.1f %s\n' %(i + 1, label, 0, rng.normal(4000, 400), roi))
+        with open(os.path.join(rootpath, sub, 'scripts', 'recon-all.log'), 'w') as f:
+            f.write('%s\nsynthetic\n\n-i /data/raw/%s_%s_mprage.nii -all\n'
+                    %(sub, codea, date.strftime('%Y%m%d')))
+        vol = _label_volume(rng, shape)
+        nb.save(nb.Nifti1Image(vol, np.eye(4)),
+                os.path.join(rootpath, sub, 'mri', 'aparc+aseg.nii.gz'))
+    return subs
+
+
+def fdg_tree(nsubs, maxtps, rootpath, shape=(24, 24, 24), seed=0):
+    """Writes small warped FDG volumes named pn_<codea>_v<tp>.nii.gz and a
+    binary meta-ROI template
+
+    Returns
+    -------
+    files : list
+        Full paths of the FDG volumes
+    template : string
+        Full path of the meta-ROI template
+    """
+    import nibabel as nb
+    rng = np.random.RandomState(seed + 8)
+    tbl = visits(nsubs, maxtps, seed + 30)
+    if not os.path.exists(rootpath):
+        os.makedirs(rootpath)
+    files = []
+    for codea, tp in zip(tbl['codea'], tbl['Tp']):
+        path = os.path.join(rootpath, 'pn_%s_v%d.nii.gz' %(codea, tp))
+        vol = rng.normal(1.2, 0.2, shape).astype(np.float32)
+        nb.save(nb.Nifti1Image(vol, np.eye(4)), path)
+        files.append(path)
+    template = os.path.join(rootpath, 'metaroi_template.nii.gz')
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[8:16, 8:16, 8:16] = 1
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), template)
+    return files, template
@@ -0,0 +1,86 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import argparse
+import sys
+from datapipeline.tools import config as dpconfig
+from datapipeline.tools import instrument
+from datapipeline.gather import gathermany
+
+
+# In[2]:
+
+#subcommands and the stages they run
+COMMANDS = {
+    'codetranslator': ['codetranslator'],
+    'pibdvr': ['pibdvr'],
+    'pibparams': ['pibparams'],
+    'inventory': ['inventory'],
+    'mri': ['mri'],
+    'fdg': ['fdg'],
+    'pvc': ['pvc'],
+    'cogtestdates': ['cogtestdates'],
+    'factoranalysis': ['factoranalysis'],
+    'merge': ['datamerge'],
+    'all': None,
+}
+
+
+def make_parser():
+    """Builds the parser for the datapipeline command line
+    """
+    parser = argparse.ArgumentParser(prog='python -m datapipeline',
+                description='Gather data modalities and merge them into summary tables.')
+    sub = parser.add_subparsers(dest='command')
+    for command in sorted(COMMANDS):
+        if command == 'all':
+            helpstr = 'run every stage set up in the config file'
+        elif command == 'merge':
+            helpstr = 'merge gathered tables, running the gather stages they need'
+        else:
+            helpstr = 'gather %s data' %command
+        p = sub.add_parser(command, help=helpstr)
+        p.add_argument('config', help='YAML or TOML file holding paths, rois, '
+                       'pibcutoff and rename maps')
+        p.add_argument('-j', '--jobs', type=int, default=1,
+                       help='number of subjects each stage processes in parallel')
+        p.add_argument('--stage-jobs', type=int, default=1,
+                       help='number of independent stages run at the same time; '
+                       'up to stage-jobs * jobs workers run at once')
+        p.add_argument('--only-new', action='store_true',
+                       help='skip stages whose inputs have not changed since the last run')
+        p.add_argument('--profile', metavar='LOG', default=None,
+                       help='record time, memory, rows and files per stage as JSON lines in LOG')
+        p.add_argument('-q', '--quiet', action='store_true',
+                       help='do not print which stages run')
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    
+    config = dpconfig.load_config(args.config)
+    targets = COMMANDS[args.command]
+    if targets is not None:
+        missing = [t for t in targets if t not in gathermany.build_stages(config)]
+        if missing:
+            parser.error('%s is not set up in %s' %(', '.join(missing), args.config))
+    
+    if args.profile:
+        instrument.enable(args.profile)
+    gathermany.gathermany_run(config, targets=targets, jobs=args.jobs,
+                              stagejobs=args.stage_jobs, force=not args.only_new,
+                              verbose=not args.quiet)
+    if instrument.is_enabled() and not args.quiet:
+        print(instrument.summary().to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
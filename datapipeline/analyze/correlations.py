@@ -0,0 +1,291 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+def _prepare(X):
+    M = ~np.isnan(X)
+    #centering first keeps the sums below from cancelling for columns with a
+    #large mean and a small spread
+    with np.errstate(invalid='ignore'):
+        center = np.nanmean(np.where(M, X, np.nan), axis=0) if len(X) else 0.
+    return np.where(M, X - np.nan_to_num(center), 0.), M.astype(float)
+
+
+def _avg_ranks(lt, le):
+    #average rank of tied rows, from the counts of rows below and up to them
+    return lt + (le - lt + 1) / 2
+
+
+def _spearman(X):
+    """Spearman correlations with pairwise deletion. Each pair is ranked over
+    the rows where both are present, as in pandas. Every column is sorted once,
+    and the ranks of all pairs with one column are counted together with a
+    cumulative sum of the other columns' masks in its sort order.
+    """
+    M = ~np.isnan(X)
+    Mf = M.astype(float)
+    nrows, k = X.shape
+    #each column's rows in ascending order, missing values last
+    O = np.argsort(np.where(M, X, np.inf), axis=0, kind='mergesort')
+    Xs = np.take_along_axis(X, O, axis=0)
+    Ms = np.take_along_axis(Mf, O, axis=0)
+    #first and last sorted position of each group of tied values
+    pos = np.arange(nrows)[:, None]
+    newgrp = np.ones((nrows, k), dtype=bool)
+    newgrp[1:] = Xs[1:] != Xs[:-1]
+    lastgrp = np.ones((nrows, k), dtype=bool)
+    lastgrp[:-1] = newgrp[1:]
+    start = np.maximum.accumulate(np.where(newgrp, pos, 0), axis=0)
+    end = np.minimum.accumulate(np.where(lastgrp, pos, nrows - 1)[::-1], axis=0)[::-1]
+
+    r = np.full((k, k), np.nan)
+    n = Mf.T.dot(Mf)
+    for i in range(k):
+        js = slice(i, k)
+        #ranks of columns i onwards over the rows each shares with column i
+        c = np.vstack([np.zeros((1, k - i)), np.cumsum(Mf[O[:, js], i] * Ms[:, js], axis=0)])
+        B = np.empty((nrows, k - i))
+        np.put_along_axis(B, O[:, js], _avg_ranks(np.take_along_axis(c, start[:, js], axis=0),
+                                                  np.take_along_axis(c, end[:, js] + 1, axis=0)),
+                          axis=0)
+        #ranks of column i over the rows it shares with each of them
+        oi = O[:, i]
+        c = np.vstack([np.zeros((1, k - i)), np.cumsum(Mf[oi, js] * Mf[oi, i][:, None], axis=0)])
+        A = np.empty((nrows, k - i))
+        A[oi] = _avg_ranks(c[start[:, i]], c[end[:, i] + 1])
+        P = Mf[:, js] * Mf[:, i][:, None]
+        nn = n[i, js]
+        m2 = nn * ((nn + 1) / 2) ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r[i, js] = (((A * B * P).sum(axis=0) - m2)
+                        / np.sqrt(((A * A * P).sum(axis=0) - m2)
+                                  * ((B * B * P).sum(axis=0) - m2)))
+        r[js, i] = r[i, js]
+    return np.clip(r, -1, 1), n
+
+
+def corr_matrix(tbl, cols, method='pearson', chunksize=256):
+    """Correlation matrix with pairwise deletion of missing values, computed
+    from matrix products of the data and its missing-value mask rather than one
+    pair at a time. Rows of the matrix are computed chunksize at a time to bound
+    memory for very wide tables. Columns are centered on their means first, so
+    large offsets do not cost precision. Spearman correlations rank each pair
+    over the rows where both are present.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame such as subjtbl or NPtbl
+    cols : list
+        Names of numeric columns to correlate
+    method : string
+        'pearson' or 'spearman'. Default 'pearson'.
+    chunksize : int
+        Number of rows of the matrix computed at once. Default 256.
+
+    Returns
+    -------
+    r : pandas DataFrame
+        Correlation of each pair of columns
+    n : pandas DataFrame
+        Number of rows where both columns are present
+    """
+    X = tbl[cols].astype(float).values
+    if method == 'spearman' and np.isnan(X).any():
+        r, n = _spearman(X)
+        r[n < 3] = np.nan
+        return (pd.DataFrame(r, index=cols, columns=cols),
+                pd.DataFrame(n, index=cols, columns=cols))
+    elif method == 'spearman':
+        #with nothing missing, every pair shares the ranks of whole columns
+        X = pd.DataFrame(X).rank().values
+    elif method != 'pearson':
+        raise ValueError('method must be pearson or spearman, not %s' %method)
+    X, M = _prepare(X)
+    X2 = X * X
+    k = len(cols)
+    r = np.empty((k, k))
+    n = np.empty((k, k))
+    for start in range(0, k, chunksize):
+        sl = slice(start, start + chunksize)
+        #sums over the rows where both columns are present
+        nn = M[:, sl].T.dot(M)
+        sx = X[:, sl].T.dot(M)
+        sy = M[:, sl].T.dot(X)
+        sxx = X2[:, sl].T.dot(M)
+        syy = M[:, sl].T.dot(X2)
+        sxy = X[:, sl].T.dot(X)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            num = nn * sxy - sx * sy
+            den = np.sqrt((nn * sxx - sx * sx) * (nn * syy - sy * sy))
+            r[sl] = np.clip(num / den, -1, 1)
+        n[sl] = nn
+    r[n < 3] = np.nan
+    return pd.DataFrame(r, index=cols, columns=cols), pd.DataFrame(n, index=cols, columns=cols)
+
+
+def partial_corr_matrix(tbl, cols, covars=None, method='pearson', chunksize=256):
+    """Partial correlation matrix from a single inversion of a pairwise
+    correlation matrix. With covars, each pair of cols is correlated after
+    removing the covariates, as ppcor's pcor.test does with a z argument. Without
+    covars, each pair is correlated given all the other cols, as ppcor's pcor
+    does.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+    cols : list
+        Names of numeric columns to correlate
+    covars : list
+        Names of numeric columns to control for. Default None controls each pair
+        for all other columns in cols.
+    method : string
+        'pearson' or 'spearman'. Default 'pearson'.
+    chunksize : int
+        Passed to corr_matrix
+
+    Returns
+    -------
+    pr : pandas DataFrame
+        Partial correlation of each pair of columns
+    n : pandas DataFrame
+        Number of rows where both columns and every variable they are
+        conditioned on are present, for the p values of pr
+    ncond : int
+        Number of variables each pair is conditioned on, for degrees of freedom
+
+    A partial correlation is NaN when any correlation it is computed from is,
+    e.g. for pairs with fewer than 3 rows in common or constant columns.
+    Without covars that is every pair once one correlation is missing.
+    """
+    covars = [c for c in (covars or []) if c not in cols]
+    allcols = list(cols) + covars
+    r, n = corr_matrix(tbl, allcols, method, chunksize)
+    bad = np.isnan(r.values)
+    C = np.where(bad, 0., r.values)
+    k = len(cols)
+    if covars:
+        #pairwise deletion can leave the matrix slightly indefinite, so use pinv
+        Czz_inv = np.linalg.pinv(C[k:, k:])
+        S = C[:k, :k] - C[:k, k:].dot(Czz_inv).dot(C[k:, :k])
+        d = np.sqrt(np.clip(np.diag(S), 1e-300, None))
+        pr = S / np.outer(d, d)
+        rowbad = bad[:k, k:].any(axis=1) | bad[k:, k:].any()
+        pr[bad[:k, :k] | rowbad[:, None] | rowbad[None, :]] = np.nan
+        ncond = len(covars)
+    else:
+        P = np.linalg.pinv(C)
+        d = np.sqrt(np.clip(np.diag(P), 1e-300, None))
+        pr = -P / np.outer(d, d)
+        if bad.any():
+            pr[:] = np.nan
+        np.fill_diagonal(pr, np.where(np.diag(bad), np.nan, 1.))
+        ncond = k - 2
+    pr = np.clip(pr, -1, 1)
+    #complete cases over each pair and the variables it is conditioned on
+    M = tbl[allcols].notnull().values
+    if covars:
+        Mx = (M[:, :k] & M[:, k:].all(axis=1)[:, None]).astype(float)
+        nc = Mx.T.dot(Mx)
+    else:
+        nc = np.full((k, k), float(M.all(axis=1).sum()))
+        np.fill_diagonal(nc, np.diag(n.values[:k, :k]))
+    return (pd.DataFrame(pr, index=cols, columns=cols),
+            pd.DataFrame(nc, index=cols, columns=cols), ncond)
+
+
+# In[3]:
+
+def corr_pvalues(r, n, ncond=0):
+    """Two-sided p values of correlations from the t distribution with
+    n - 2 - ncond degrees of freedom
+    """
+    from scipy import stats
+    rv = r.values if hasattr(r, 'values') else r
+    dof = (n.values if hasattr(n, 'values') else n) - 2 - ncond
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = rv * np.sqrt(dof / (1 - rv * rv))
+        p = 2 * stats.t.sf(np.abs(t), dof)
+    p[dof < 1] = np.nan
+    np.fill_diagonal(p, 0.)
+    return pd.DataFrame(p, index=r.index, columns=r.columns) if hasattr(r, 'index') else p
+
+
+def fdr_matrix(p):
+    """Benjamini-Hochberg adjusted p values of a symmetric p value matrix,
+    counting each pair once
+    """
+    pv = p.values
+    iu = np.triu_indices_from(pv, k=1)
+    flat = pv[iu]
+    ok = ~np.isnan(flat)
+    q = np.full(flat.shape, np.nan)
+    m = ok.sum()
+    if m:
+        order = np.argsort(flat[ok])
+        ranked = flat[ok][order] * m / np.arange(1, m + 1)
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        qok = np.empty(m)
+        qok[order] = np.minimum(ranked, 1)
+        q[ok] = qok
+    out = np.zeros_like(pv)
+    out[iu] = q
+    out = out + out.T
+    np.fill_diagonal(out, 0.)
+    return pd.DataFrame(out, index=p.index, columns=p.columns)
+
+
+# In[4]:
+
+@instrument.profiled
+def correlations_run(tbl, cols, covars=None, method='pearson', outdir=None):
+    """Main function to correlate many variables of a merged table. Replaces the
+    corrplot, ppcor and pastecs steps of the R workflow.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame such as subjtbl or NPtbl from datamerge_run
+    cols : list
+        Names of numeric columns to correlate
+    covars : list
+        Names of columns to control for in the partial correlations. Default
+        None controls each pair for all other columns.
+    method : string
+        'pearson' or 'spearman'. Default 'pearson'.
+    outdir : string
+        If given, full path where the output is saved with save_xls_and_pkl
+
+    Returns
+    -------
+    corrtbl : pandas DataFrame
+        One row per pair of columns holding n, r, its p value and FDR-adjusted
+        q value, and the partial correlation with its p and q values
+    matrices : dict
+        The matrices 'r', 'p', 'q', 'n', 'partial_r', 'partial_p' and 'partial_q'
+    """
+    r, n = corr_matrix(tbl, cols, method)
+    p = corr_pvalues(r, n)
+    pr, pn, ncond = partial_corr_matrix(tbl, cols, covars, method)
+    pp = corr_pvalues(pr, pn, ncond)
+    matrices = {'r': r, 'p': p, 'q': fdr_matrix(p), 'n': n,
+                'partial_r': pr, 'partial_p': pp, 'partial_q': fdr_matrix(pp)}
+
+    iu = np.triu_indices(len(cols), k=1)
+    corrtbl = pd.DataFrame({'var1': np.array(cols)[iu[0]], 'var2': np.array(cols)[iu[1]]})
+    for key in ['n', 'r', 'p', 'q', 'partial_r', 'partial_p', 'partial_q']:
+        corrtbl[key] = matrices[key].values[iu]
+    corrtbl['n'] = corrtbl['n'].astype(int)
+
+    if outdir is not None:
+        cf.save_xls_and_pkl(corrtbl, 'correlations', outdir)
+    return corrtbl, matrices
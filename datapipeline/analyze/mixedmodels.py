@@ -0,0 +1,304 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+def parse_terms(fixed):
+    """Expands the right-hand side of an R-style formula into design columns.
+    'a*b' becomes a, b and a:b, and 'a:b' is the product of a and b.
+
+    Parameters
+    ----------
+    fixed : string or list
+        Formula right-hand side such as 'ss + ty*ss', or a list of terms
+
+    Returns
+    -------
+    terms : list
+        Terms in order of first appearance, each a tuple of column names
+    """
+    if isinstance(fixed, str):
+        fixed = fixed.split('+')
+    terms = []
+    for term in fixed:
+        term = term.strip()
+        if not term or term == '1':
+            continue
+        if '*' in term:
+            cols = [c.strip() for c in term.split('*')]
+            expanded = [(c,) for c in cols] + [tuple(cols)]
+        else:
+            expanded = [tuple(c.strip() for c in term.split(':'))]
+        for t in expanded:
+            if t not in terms:
+                terms.append(t)
+    return terms
+
+
+def design_matrix(tbl, terms):
+    """Builds a fixed-effects design matrix with an intercept
+
+    Returns
+    -------
+    X : numpy array
+        Array with one row per row of tbl and one column per term
+    names : list
+        Names of the columns of X, '(Intercept)' first and 'a:b' for interactions
+    """
+    X = [np.ones(len(tbl))]
+    names = ['(Intercept)']
+    for t in terms:
+        col = np.ones(len(tbl))
+        for c in t:
+            col = col * tbl[c].astype(float).values
+        X.append(col)
+        names.append(':'.join(t))
+    return np.column_stack(X), names
+
+
+# In[3]:
+
+def lmlist_slopes(tbl, subcol, timecol, ycols, mintps=2):
+    """Per-subject ordinary least-squares intercepts and slopes of many outcomes
+    against time, the same fits as R's lmList(y ~ time | subject). All subjects
+    and outcomes are solved together from grouped sums. Rows missing an outcome
+    are left out of that outcome's fit only.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        Long table such as NPtbl
+    subcol : string
+        Name of column containing subject ID
+    timecol : string
+        Name of column containing time, e.g. 'NP_YrsRelBL'
+    ycols : list
+        Names of outcome columns
+    mintps : int
+        Fewest non-missing timepoints needed to fit a subject. Default 2.
+
+    Returns
+    -------
+    slopetbl : pandas DataFrame
+        One row per subject with columns '<y>_lmList_int' and '<y>_lmList_sl'
+    """
+    slopetbl = cf.subject_slopes(tbl, subcol, timecol, ycols, mintps)
+    names = {}
+    for ycol in ycols:
+        names['%s_int' %ycol] = '%s_lmList_int' %ycol
+        names['%s_sl' %ycol] = '%s_lmList_sl' %ycol
+    slopetbl = slopetbl.rename(columns=names)
+    return slopetbl
+
+
+# In[4]:
+
+def _group_sums(arr, starts):
+    """Sums rows of arr (already sorted by group) within each group
+    """
+    return np.add.reduceat(arr, starts, axis=0)
+
+
+def _reml_parts(theta, s):
+    """Evaluates the profiled REML criterion of a random intercept and slope
+    model at relative covariance factor theta, from per-subject sums in s.
+    """
+    L = np.array([[theta[0], 0.], [theta[1], theta[2]]])
+    LtZtZL = np.einsum('ka,gkl,lb->gab', L, s['ZtZ'], L)
+    M = LtZtZL + np.eye(2)
+    Minv = np.linalg.inv(M)
+    LtZtX = np.einsum('ka,gkj->gaj', L, s['ZtX'])
+    LtZty = np.einsum('ka,gk->ga', L, s['Zty'])
+    A = s['XtX'] - np.einsum('gki,gkl,glj->ij', LtZtX, Minv, LtZtX)
+    b = s['Xty'] - np.einsum('gki,gkl,gl->i', LtZtX, Minv, LtZty)
+    c = s['yty'] - np.einsum('gk,gkl,gl->', LtZty, Minv, LtZty)
+    beta = np.linalg.solve(A, b)
+    dof = s['n'] - len(beta)
+    sigma2 = max((c - b.dot(beta)) / dof, 1e-300)
+    logdetM = np.linalg.slogdet(M)[1].sum()
+    logdetA = np.linalg.slogdet(A)[1]
+    crit = dof * (1 + np.log(2 * np.pi * sigma2)) + logdetM + logdetA
+    return crit, {'L': L, 'Minv': Minv, 'A': A, 'beta': beta, 'sigma2': sigma2}
+
+
+def fit_lmm(y, X, t, groups, names=None):
+    """Fits y ~ X + (t | groups) by restricted maximum likelihood, as lmer does.
+    The random intercept and slope covariance is profiled through per-subject
+    sums, so every likelihood evaluation is a handful of batched 2x2 operations
+    over subjects rather than a pass over the data.
+
+    Parameters
+    ----------
+    y : numpy array
+        Outcome, one value per observation
+    X : numpy array
+        Fixed-effects design matrix, one row per observation
+    t : numpy array
+        Time covariate with a random slope
+    groups : numpy array
+        Subject of each observation
+    names : list
+        Names of the columns of X
+
+    Returns
+    -------
+    fit : dict
+        'fixed' is a DataFrame of estimates, standard errors, t values and
+        p values. 'varcomp' is a Series of random-effect standard deviations,
+        their correlation and the residual standard deviation. 'resid' holds
+        conditional residuals in input order, and 'reml', 'nobs', 'ngroups'
+        and 'converged' describe the fit.
+    """
+    from scipy import optimize, stats
+
+    order = np.argsort(groups, kind='mergesort')
+    y, X, t, g = y[order], X[order], t[order], np.asarray(groups)[order]
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    Z = np.column_stack([np.ones(len(t)), t])
+    s = {'n': len(y), 'XtX': X.T.dot(X), 'Xty': X.T.dot(y), 'yty': y.dot(y),
+         'ZtZ': _group_sums(np.einsum('ni,nj->nij', Z, Z), starts),
+         'ZtX': _group_sums(np.einsum('ni,nj->nij', Z, X), starts),
+         'Zty': _group_sums(Z * y[:, None], starts)}
+
+    res = optimize.minimize(lambda th: _reml_parts(th, s)[0], [1., 0., 1.],
+                            method='L-BFGS-B', bounds=[(0, None), (None, None), (0, None)])
+    crit, p = _reml_parts(res.x, s)
+    beta, sigma2, L = p['beta'], p['sigma2'], p['L']
+
+    #fixed effects, with p values from t on the residual degrees of freedom
+    dof = len(y) - len(beta)
+    se = np.sqrt(np.diag(sigma2 * np.linalg.inv(p['A'])))
+    tval = beta / se
+    fixed = pd.DataFrame({'estimate': beta, 'std_err': se, 't_value': tval,
+                          'p_value': 2 * stats.t.sf(np.abs(tval), dof)},
+                         index=names if names is not None else range(len(beta)))
+
+    #variance components
+    D = sigma2 * L.dot(L.T)
+    sd = np.sqrt(np.diag(D))
+    corr = D[0, 1] / (sd[0] * sd[1]) if sd[0] > 0 and sd[1] > 0 else np.nan
+    varcomp = pd.Series({'sd_intercept': sd[0], 'sd_slope': sd[1],
+                         'corr_intercept_slope': corr, 'sd_residual': np.sqrt(sigma2)})
+
+    #conditional residuals y - X*beta - Z*b, where b = L M^-1 L' Z'(y - X*beta)
+    Ztr = s['Zty'] - np.einsum('gkj,j->gk', s['ZtX'], beta)
+    u = np.einsum('gkl,lm,gm->gk', p['Minv'], L.T, Ztr)
+    bsub = u.dot(L.T)
+    gi = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(y)]))
+    resid_sorted = y - X.dot(beta) - (Z * bsub[gi]).sum(axis=1)
+    resid = np.empty_like(resid_sorted)
+    resid[order] = resid_sorted
+
+    return {'fixed': fixed, 'varcomp': varcomp, 'resid': resid, 'reml': -crit / 2,
+            'nobs': len(y), 'ngroups': len(starts), 'converged': bool(res.success)}
+
+
+# In[5]:
+
+def _fit_outcome(args):
+    """Fits one outcome; top level so it can run in a worker process
+    """
+    outcome, y, X, t, groups, names = args
+    keep = ~np.isnan(y) & ~np.isnan(X).any(axis=1) & ~np.isnan(t)
+    try:
+        fit = fit_lmm(y[keep], X[keep], t[keep], groups[keep], names)
+    except (np.linalg.LinAlgError, ValueError) as e:
+        return outcome, None, keep, str(e)
+    return outcome, fit, keep, None
+
+
+def _long_results(outcome, fit):
+    fixed = fit['fixed'].reset_index().rename(columns={'index': 'term'})
+    fixed['kind'] = 'fixed'
+    varcomp = fit['varcomp'].reset_index()
+    varcomp.columns = ['term', 'estimate']
+    varcomp['kind'] = 'varcomp'
+    tbl = pd.concat([fixed, varcomp], ignore_index=True)
+    tbl.insert(0, 'outcome', outcome)
+    for key in ['reml', 'nobs', 'ngroups', 'converged']:
+        tbl[key] = fit[key]
+    return tbl
+
+
+@instrument.profiled
+def mixedmodels_run(NPtbl, outcomes, fixed, subcol='codeb', timecol='NP_YrsRelBL',
+                    mintps=3, jobs=1, outdir=None):
+    """Fits random intercept and slope models, lmer(y ~ fixed + (time | subject)),
+    for many outcomes in parallel, and the per-subject lmList slopes of the same
+    outcomes. Replaces rscripts/mixedmodels.R without the .xls round-trip.
+
+    Parameters
+    ----------
+    NPtbl : pandas DataFrame
+        DataFrame where each row is a single subject's single cognitive testing
+        session, as returned by datamerge_run
+    outcomes : list
+        Names of outcome columns, e.g. ['F0', 'F1', 'F2'] plus the roc_cols tests
+    fixed : string
+        Right-hand side of the fixed-effects formula, e.g.
+        'NP_YrsRelBL + PIB_Pos*NP_YrsRelBL'
+    subcol : string
+        Name of column containing subject ID. Default 'codeb'.
+    timecol : string
+        Name of column holding time, which gets a random slope. Default 'NP_YrsRelBL'.
+    mintps : int
+        Subjects with fewer sessions are left out, as mixedmodels.R does with
+        merge_3tp. Default 3.
+    jobs : int
+        Number of outcomes to fit at the same time in separate processes. Default 1.
+    outdir : string
+        If given, full path where the three outputs are saved with save_xls_and_pkl
+
+    Returns
+    -------
+    lmmtbl : pandas DataFrame
+        One row per outcome and term, holding fixed effects (kind 'fixed') and
+        variance components (kind 'varcomp') with fit statistics
+    restbl : pandas DataFrame
+        Subject, time and one '<outcome>_resid' column of conditional residuals
+        per outcome, aligned with the rows of NPtbl that were modeled
+    slopetbl : pandas DataFrame
+        Per-subject lmList intercepts and slopes of each outcome against time
+    """
+    ntps = NPtbl.groupby(subcol)[subcol].transform('count')
+    tbl = NPtbl[(ntps >= mintps).values]
+    terms = parse_terms(fixed)
+    X, names = design_matrix(tbl, terms)
+    t = tbl[timecol].astype(float).values
+    groups = tbl[subcol].values
+
+    tasks = [(o, tbl[o].astype(float).values, X, t, groups, names) for o in outcomes]
+    if jobs is not None and jobs > 1:
+        from concurrent import futures
+        with futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            fits = list(pool.map(_fit_outcome, tasks))
+    else:
+        fits = [_fit_outcome(task) for task in tasks]
+
+    restbl = tbl[[subcol, timecol]].copy()
+    parts = []
+    for outcome, fit, keep, err in fits:
+        restbl['%s_resid' %outcome] = np.nan
+        if fit is None:
+            print('Model for %s failed: %s' %(outcome, err))
+            continue
+        restbl.loc[keep, '%s_resid' %outcome] = fit['resid']
+        parts.append(_long_results(outcome, fit))
+    lmmtbl = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+    slopetbl = lmlist_slopes(tbl, subcol, timecol, outcomes, mintps=2).reset_index()
+
+    if outdir is not None:
+        cf.save_xls_and_pkl(lmmtbl, 'lmm_effects', outdir)
+        cf.save_xls_and_pkl(restbl, 'lmm_resid', outdir)
+        cf.save_xls_and_pkl(slopetbl, 'lmList_slopes', outdir)
+
+    return lmmtbl, restbl, slopetbl
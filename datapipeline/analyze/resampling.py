@@ -0,0 +1,311 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import warnings
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+def _map(func, tasks, jobs):
+    """Runs func over tasks in a process pool, or serially if jobs is 1
+    """
+    if jobs is None or jobs <= 1:
+        return [func(task) for task in tasks]
+    from concurrent import futures
+    with futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(func, tasks))
+
+
+def _seeds(seed, nchunks):
+    """One independent random stream per chunk, so results depend on seed and
+    chunk layout but not on the number of jobs
+    """
+    return np.random.SeedSequence(seed).spawn(nchunks)
+
+
+def pad_subjects(tbl, subcol, timecol, ycol):
+    """Lays out each subject's observations as one row of a padded array
+
+    Returns
+    -------
+    subs : pandas Index
+        Subject IDs, one per row
+    n : numpy array
+        Number of observations of each subject
+    T, Y : numpy arrays
+        Subjects by largest number of observations, padded with 0
+    """
+    d = tbl[[subcol, timecol, ycol]].dropna()
+    codes, subs = pd.factorize(d[subcol], sort=True)
+    order = np.argsort(codes, kind='mergesort')
+    codes = codes[order]
+    n = np.bincount(codes, minlength=len(subs))
+    pos = np.arange(len(codes)) - np.repeat(np.cumsum(n) - n, n)
+    T = np.zeros((len(subs), max(n.max(), 1) if len(n) else 1))
+    Y = np.zeros_like(T)
+    T[codes, pos] = d[timecol].astype(float).values[order]
+    Y[codes, pos] = d[ycol].astype(float).values[order]
+    return subs, n, T, Y
+
+
+def batched_slopes(T, Y, M):
+    """Least-squares slopes of Y on T along the last axis, counting only
+    entries where M is True. Leading axes can hold subjects and resamples.
+    """
+    nn = M.sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tm = (T * M).sum(axis=-1, keepdims=True) / nn[..., None]
+        ym = (Y * M).sum(axis=-1, keepdims=True) / nn[..., None]
+        dt = (T - tm) * M
+        sxx = (dt * dt).sum(axis=-1)
+        slope = (dt * (Y - ym)).sum(axis=-1) / sxx
+    slope[~(sxx > 1e-12)] = np.nan
+    return slope
+
+
+# In[3]:
+
+def _subject_chunk(args):
+    """Bootstraps the slopes of one chunk of subjects; top level so it can run
+    in a worker process
+    """
+    T, Y, n, nboot, method, seedseq, alpha, block = args
+    rng = np.random.default_rng(seedseq)
+    M = np.arange(T.shape[1])[None, :] < n[:, None]
+    slope = batched_slopes(T, Y, M)
+    tm = (T * M).sum(axis=1) / n
+    ym = (Y * M).sum(axis=1) / n
+    resid = (Y - ym[:, None] - slope[:, None] * (T - tm[:, None])) * M
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = (T - tm[:, None]) * M
+        w = w / (w * w).sum(axis=1, keepdims=True)
+        #modified residuals: raw residuals shrink by sqrt(1 - leverage), which
+        #leaves the resampled slopes too narrow with few timepoints
+        lev = (1. / n[:, None] + w * (T - tm[:, None])) * M
+        resid = np.where(lev < 1. - 1e-12, resid / np.sqrt(1. - lev), 0.) * M
+        resid = (resid - (resid.sum(axis=1) / n)[:, None]) * M
+
+    boot = np.empty((len(n), nboot))
+    for start in range(0, nboot, block):
+        b = min(block, nboot - start)
+        #resample index matrix: subjects x resamples x observations
+        idx = (rng.random((len(n), b, T.shape[1])) * n[:, None, None]).astype(np.intp)
+        if method == 'residual':
+            estar = np.take_along_axis(resid[:, None, :], idx, axis=2) * M[:, None, :]
+            boot[:, start:start + b] = slope[:, None] + (w[:, None, :] * estar).sum(axis=2)
+        else:
+            Tb = np.take_along_axis(T[:, None, :], idx, axis=2)
+            Yb = np.take_along_axis(Y[:, None, :], idx, axis=2)
+            boot[:, start:start + b] = batched_slopes(Tb, Yb, M[:, None, :])
+
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        #subjects with too few timepoints have no valid resamples
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lo, hi = np.nanpercentile(boot, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+        se = np.nanstd(boot, axis=1, ddof=1)
+    bad = n < 3 if method == 'residual' else n < 2
+    lo[bad], hi[bad], se[bad] = np.nan, np.nan, np.nan
+    return slope, lo, hi, se
+
+
+def subject_slope_ci(tbl, subcol, timecol, ycol, nboot=10000, method='residual',
+                     alpha=0.05, seed=0, subjects_per_chunk=500, block=None, jobs=1):
+    """Bootstrap confidence intervals on every subject's rate of change, the
+    slope that rate_of_change and lmList estimate. All resamples of a chunk of
+    subjects are drawn as one index array and their slopes computed together.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        Long table with one row per subject per timepoint
+    subcol : string
+        Name of column containing subject ID
+    timecol : string
+        Name of column holding time in years, e.g. 'NP_YrsRelBL'
+    ycol : string
+        Name of column to calculate the rate of change of
+    nboot : int
+        Number of bootstrap resamples. Default 10000.
+    method : string
+        'residual' resamples each subject's modified regression residuals
+        (divided by sqrt(1 - leverage) and recentered), which needs at least
+        3 timepoints. 'case' resamples (time, value) pairs, which needs at
+        least 2 distinct times in a resample. Default 'residual'. With few
+        timepoints the standard error is estimated from very few residuals,
+        so intervals are too narrow: with 3 timepoints the residuals have 1
+        degree of freedom and a 95% interval covers far less than 95%.
+    alpha : float
+        Intervals cover 1 - alpha. Default 0.05.
+    seed : int
+        Seed for the random number generator, for reproducible intervals
+    subjects_per_chunk : int
+        Number of subjects handled by each task. Default 500.
+    block : int
+        Number of resamples drawn at once within a task. Default None keeps each
+        block to about 8 million values.
+    jobs : int
+        Number of processes. Default 1.
+
+    Returns
+    -------
+    slopeci : pandas DataFrame
+        One row per subject with the slope, its bootstrap standard error and
+        the lower and upper interval bounds. Bounds are NaN for subjects with
+        too few timepoints.
+    """
+    subs, n, T, Y = pad_subjects(tbl, subcol, timecol, ycol)
+    chunks = list(range(0, len(subs), subjects_per_chunk))
+    if block is None:
+        block = max(1, int(8e6 // (subjects_per_chunk * T.shape[1])))
+    tasks = [(T[c:c + subjects_per_chunk], Y[c:c + subjects_per_chunk],
+              n[c:c + subjects_per_chunk], nboot, method, ss, alpha, block)
+             for c, ss in zip(chunks, _seeds(seed, len(chunks)))]
+    out = _map(_subject_chunk, tasks, jobs)
+
+    slope, lo, hi, se = [np.concatenate([o[i] for o in out]) if out else []
+                         for i in range(4)]
+    slopeci = pd.DataFrame({'%s_sl' %ycol: slope, '%s_sl_se' %ycol: se,
+                            '%s_sl_lo' %ycol: lo, '%s_sl_hi' %ycol: hi,
+                            '%s_ntps' %ycol: n}, index=subs)
+    slopeci.index.name = subcol
+    return slopeci
+
+
+# In[4]:
+
+def _group_chunk(args):
+    """Draws one chunk of bootstrap or permutation differences in mean slope
+    """
+    a, b, size, kind, seedseq = args
+    rng = np.random.default_rng(seedseq)
+    if kind == 'boot':
+        ia = rng.integers(0, len(a), (size, len(a)))
+        ib = rng.integers(0, len(b), (size, len(b)))
+        return a[ia].mean(axis=1) - b[ib].mean(axis=1)
+    pooled = np.concatenate([a, b])
+    perm = np.argsort(rng.random((size, len(pooled))), axis=1)
+    shuffled = pooled[perm]
+    return shuffled[:, :len(a)].mean(axis=1) - shuffled[:, len(a):].mean(axis=1)
+
+
+def group_slope_difference(slopes, groups, nboot=10000, nperm=10000, alpha=0.05, seed=0,
+                           chunksize=1000, jobs=1):
+    """Difference in mean slope between two groups of subjects, e.g. PIB+ vs PIB-
+    or APOE4 carriers vs non-carriers, with a bootstrap interval and a
+    permutation p value. Resamples are drawn as index matrices in chunks of
+    chunksize.
+
+    Parameters
+    ----------
+    slopes : pandas Series
+        One slope per subject, indexed by subject
+    groups : pandas Series
+        Group of each subject, indexed by subject. True or 1 marks the first group.
+    nboot : int
+        Number of bootstrap resamples within groups. Default 10000.
+    nperm : int
+        Number of label permutations. Default 10000.
+    alpha : float
+        Interval covers 1 - alpha. Default 0.05.
+    seed : int
+        Seed for the random number generator
+    chunksize : int
+        Number of resamples per task. Default 1000.
+    jobs : int
+        Number of processes. Default 1.
+
+    Returns
+    -------
+    result : pandas Series
+        Group sizes, mean slopes, their difference, interval bounds and p value
+    """
+    d = pd.concat([slopes.rename('sl'), groups.rename('grp')], axis=1, join='inner').dropna()
+    ingrp = d['grp'].astype(bool).values
+    a, b = d['sl'].values[ingrp], d['sl'].values[~ingrp]
+    diff = a.mean() - b.mean() if len(a) and len(b) else np.nan
+    result = pd.Series({'n_grp1': len(a), 'n_grp0': len(b), 'mean_grp1': np.nan,
+                        'mean_grp0': np.nan, 'diff': diff, 'diff_lo': np.nan,
+                        'diff_hi': np.nan, 'p_perm': np.nan})
+    if len(a) < 2 or len(b) < 2:
+        return result
+    result['mean_grp1'], result['mean_grp0'] = a.mean(), b.mean()
+
+    sizes = {'boot': nboot, 'perm': nperm}
+    tasks = []
+    for kind in ['boot', 'perm']:
+        starts = list(range(0, sizes[kind], chunksize))
+        streams = _seeds([seed, int(kind == 'perm')], len(starts))
+        tasks += [(a, b, min(chunksize, sizes[kind] - s), kind, ss)
+                  for s, ss in zip(starts, streams)]
+    out = _map(_group_chunk, tasks, jobs)
+    boot = np.concatenate([o for o, t in zip(out, tasks) if t[3] == 'boot'])
+    perm = np.concatenate([o for o, t in zip(out, tasks) if t[3] == 'perm'])
+
+    result['diff_lo'], result['diff_hi'] = np.percentile(boot, [100 * alpha / 2,
+                                                                100 * (1 - alpha / 2)])
+    result['p_perm'] = (1 + (np.abs(perm) >= abs(diff)).sum()) / (1. + len(perm))
+    return result
+
+
+# In[5]:
+
+@instrument.profiled
+def resampling_run(tbl, datacols, groupcols, subcol='codeb', timecol='NP_YrsRelBL',
+                   nboot=10000, nperm=10000, alpha=0.05, seed=0, jobs=1, outdir=None):
+    """Main function for resampling inference on rates of change. Bootstraps each
+    subject's slope of every column in datacols, then compares mean slopes
+    between the groups in each of groupcols.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        Long table such as NPtbl or aseg_change
+    datacols : list
+        Names of columns to calculate rates of change of
+    groupcols : list
+        Names of binary subject-level columns, e.g. ['PIB_Pos', 'APOE_presence'].
+        A subject's group is its first non-missing value.
+    subcol : string
+        Name of column containing subject ID. Default 'codeb'.
+    timecol : string
+        Name of column holding time in years. Default 'NP_YrsRelBL'.
+    nboot, nperm, alpha, seed, jobs
+        As in subject_slope_ci and group_slope_difference
+    outdir : string
+        If given, full path where both outputs are saved with save_xls_and_pkl
+
+    Returns
+    -------
+    slopeci : pandas DataFrame
+        One row per subject with slope, standard error and interval of each column
+    groupdiff : pandas DataFrame
+        One row per data column and group column comparing mean slopes
+    """
+    cis = [subject_slope_ci(tbl, subcol, timecol, col, nboot=nboot, alpha=alpha,
+                            seed=seed, jobs=jobs) for col in datacols]
+    slopeci = pd.concat(cis, axis=1) if cis else pd.DataFrame()
+    grouping = tbl.groupby(subcol)[groupcols].first()
+
+    rows = []
+    for col in datacols:
+        for grp in groupcols:
+            res = group_slope_difference(slopeci['%s_sl' %col], grouping[grp], nboot=nboot,
+                                         nperm=nperm, alpha=alpha, seed=seed, jobs=jobs)
+            res['datacol'], res['groupcol'] = col, grp
+            rows.append(res)
+    groupdiff = pd.DataFrame(rows)
+    if rows:
+        groupdiff = groupdiff[['datacol', 'groupcol'] + [c for c in groupdiff.columns
+                                                         if c not in ('datacol', 'groupcol')]]
+    slopeci = slopeci.reset_index()
+
+    if outdir is not None:
+        cf.save_xls_and_pkl(slopeci, 'slope_ci', outdir)
+        cf.save_xls_and_pkl(groupdiff, 'slope_groupdiff', outdir)
+    return slopeci, groupdiff
@@ -5,7 +5,8 @@
 
 import pandas as pd
 import os, sys
-from tools import common_funcs as cf
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
 
 
 # In[10]:
@@ -37,6 +38,7 @@ def codea_to_codeb(codetbl):
 
 # In[11]:
 
+@instrument.profiled
 def codetranslator_run(codetblpath, outdir):
     """Takes an excel file as input and generates a pandas dataframe containing only
     matched pairs of codea and codeb.
@@ -53,6 +55,7 @@ def codetranslator_run(codetblpath, outdir):
     to outdir.
     """
     
+    instrument.note_read(codetblpath)
     codetblin = pd.read_excel(codetblpath)
     codetbl = codetblin[['codeaGRAB','codeb']]
     codetbl = codetbl.rename(columns={'codeaGRAB' : 'codeb'})
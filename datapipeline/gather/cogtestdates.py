@@ -9,7 +9,8 @@ import glob
 import os, sys
 import re, string
 import time
-from tools import common_funcs as cf
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
 
 
 # In[3]:
@@ -85,6 +86,7 @@ def APOE_dose(row):
 
 # In[9]:
 
+@instrument.profiled
 def cogtestdates_run(path_cogdates, staticrename, outdir):
     """Reads cognitive testing dates into a dataframe
     
@@ -108,9 +110,10 @@ def cogtestdates_run(path_cogdates, staticrename, outdir):
     """
     
     #import data with neuropsych test dates
+    instrument.note_read(path_cogdates)
     cogdates = pd.read_excel(path_cogdates)
     cogdates.rename(columns=staticrename, inplace=True)
-    staticcols = staticrename.values()
+    staticcols = list(staticrename.values())
 
     #split table into basic subject variables, and ones that change with testing session
     subjinfo = cogdates[['codea'] + staticcols]
@@ -151,7 +154,7 @@ def cogtestdates_run(path_cogdates, staticrename, outdir):
     timecalc.drop(['NP_Tp'], axis=1, inplace=True)
     testing_out = pd.merge(testing_out, timecalc, on='codea')
     testing_out['NP_YrsRelBL'] = pd.to_datetime(testing_out['NP_Date'])- pd.to_datetime(testing_out['NP_DateBL'])
-    testing_out['NP_YrsRelBL'] = (testing_out['NP_YrsRelBL'].astype('timedelta64[D]'))/365.25
+    testing_out['NP_YrsRelBL'] = testing_out['NP_YrsRelBL'].dt.days/365.25
     
     cf.save_xls_and_pkl(testing_out, 'cogtestdates', outdir)
     cf.save_xls_and_pkl(subjinfo, 'subjinfo', outdir)
@@ -0,0 +1,309 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import json
+import functools
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+
+
+# In[2]:
+
+def scan_index(scans):
+    """Builds the index of a cohort array from a list of scan paths, reading the
+    subject id and timepoint from each path with get_id and get_tp
+
+    Parameters
+    ----------
+    scans : list or pandas DataFrame
+        Full paths of spatially normalized scans, or a DataFrame with a 'path'
+        column and optionally 'codea' and 'Tp' columns
+
+    Returns
+    -------
+    index : pandas DataFrame
+        One row per scan with columns codea, Tp and path, sorted by subject and
+        timepoint. Row i of the index is row i of the cohort array.
+    """
+    if isinstance(scans, pd.DataFrame):
+        index = scans.copy()
+    else:
+        index = pd.DataFrame({'path': list(scans)})
+    if 'codea' not in index.columns:
+        index['codea'] = [cf.get_id(os.path.basename(p)) for p in index['path']]
+    if 'Tp' not in index.columns:
+        index['Tp'] = pd.to_numeric([cf.get_tp(os.path.basename(p)) for p in index['path']])
+    index = index.sort_values(['codea', 'Tp', 'path']).reset_index(drop=True)
+    return index[['codea', 'Tp', 'path'] + [c for c in index.columns
+                                            if c not in ('codea', 'Tp', 'path')]]
+
+
+def _load_volume(path):
+    import nibabel as nb
+    img = nb.load(path)
+    instrument.note_read(path)
+    return img, np.asarray(img.dataobj, dtype=np.float32).squeeze()
+
+
+def _check_grid(path, img, vol, shape, affine):
+    if vol.shape != shape:
+        raise ValueError('%s has shape %s, expected %s' %(path, vol.shape, shape))
+    if not np.allclose(img.affine, affine, atol=1e-4):
+        raise ValueError('%s has affine %s, expected %s'
+                         %(path, img.affine.tolist(), np.asarray(affine).tolist()))
+
+
+def _fill_row(item, datapath, mask, affine):
+    """Reads one scan into its row of a cohort array saved at datapath, after
+    checking that it is on the grid of the array
+    """
+    row, path = item
+    img, vol = _load_volume(path)
+    _check_grid(path, img, vol, mask.shape, affine)
+    data = np.load(datapath, mmap_mode='r+')
+    data[row] = vol[mask]
+    data.flush()
+
+
+def _paths(outdir, name):
+    return dict((key, '%s%s_%s' %(outdir, name, key))
+                for key in ['data.npy', 'mask.npy', 'index.pkl', 'meta.json'])
+
+
+# In[3]:
+
+@instrument.profiled
+def build_cohort_array(scans, outdir, name='fdg', maskpath=None, jobs=1, failures=None):
+    """Stacks spatially normalized scans into one memory-mapped float32 array
+    with a row per scan and a column per brain voxel, so regional and voxelwise
+    questions can be answered without opening every scan again. The array is
+    the 4D cohort (x, y, z, scan) with non-brain voxels left out; unmask puts
+    rows back on the image grid.
+
+    Writes name_data.npy (the array), name_mask.npy (the 3D brain mask),
+    name_index.pkl (subject and timepoint of each row) and name_meta.json (grid
+    shape and affine) to outdir.
+
+    Parameters
+    ----------
+    scans : list or pandas DataFrame
+        Scans to stack, passed to scan_index. All must be on the same grid:
+        scans whose shape or affine differs from the first scan's fail.
+    outdir : string
+        Full path where the cohort array is saved
+    name : string
+        Base name of the saved files, e.g. 'fdg' or 'pib'. Default 'fdg'.
+    maskpath : string
+        Full path to a brain mask on the same grid as the scans. Default None
+        keeps voxels that are finite and nonzero in the first scan.
+    jobs : int
+        Number of processes reading scans. Default 1.
+    failures : list
+        If given, the table of scans that failed is appended to it. Their rows
+        of the array are left NaN. Default None prints them.
+
+    Returns
+    -------
+    index : pandas DataFrame
+        Subject, timepoint and path of each row of the array
+    """
+    index = scan_index(scans)
+    if len(index) == 0:
+        raise ValueError('no scans to stack')
+    img0, vol0 = _load_volume(index['path'].iloc[0])
+    if maskpath is not None:
+        maskimg, mask = _load_volume(maskpath)
+        _check_grid(maskpath, maskimg, mask, vol0.shape, img0.affine)
+        mask = mask > 0
+    else:
+        mask = np.isfinite(vol0) & (vol0 != 0)
+
+    files = _paths(outdir, name)
+    data = np.lib.format.open_memmap(files['data.npy'], mode='w+', dtype=np.float32,
+                                     shape=(len(index), int(mask.sum())))
+    del data
+
+    #each worker opens the array and writes its own rows
+    rows = list(enumerate(index['path']))
+    _, failed = shards.shard_map(functools.partial(_fill_row, datapath=files['data.npy'],
+                                                   mask=mask, affine=img0.affine), rows, jobs,
+                                 key=lambda row: index['codea'].iloc[row[0]])
+    shards.keep_failures(failed, failures, 'build_cohort_array')
+    if len(failed):
+        data = np.load(files['data.npy'], mmap_mode='r+')
+        data[[row for row, _ in failed['item']]] = np.nan
+        data.flush()
+        del data
+
+    np.save(files['mask.npy'], mask)
+    index.to_pickle(files['index.pkl'])
+    with open(files['meta.json'], 'w') as f:
+        json.dump({'shape': list(mask.shape), 'affine': img0.affine.tolist(),
+                   'nscans': len(index), 'nvoxels': int(mask.sum())}, f)
+    for path in files.values():
+        instrument.note_written(path)
+    return index
+
+
+def load_cohort_array(outdir, name='fdg', mode='r'):
+    """Opens a cohort array saved by build_cohort_array without reading it into
+    memory
+
+    Parameters
+    ----------
+    outdir : string
+        Full path where the cohort array was saved
+    name : string
+        Base name of the saved files. Default 'fdg'.
+    mode : string
+        numpy memmap mode. Default 'r' opens read only.
+
+    Returns
+    -------
+    data : numpy memmap
+        float32 array with a row per scan and a column per brain voxel
+    index : pandas DataFrame
+        Subject, timepoint and path of each row
+    mask : numpy array
+        3D boolean brain mask
+    affine : numpy array
+        4x4 affine of the image grid
+    """
+    files = _paths(outdir, name)
+    for path in files.values():
+        instrument.note_read(path)
+    data = np.load(files['data.npy'], mmap_mode=mode)
+    index = pd.read_pickle(files['index.pkl'])
+    mask = np.load(files['mask.npy'])
+    with open(files['meta.json']) as f:
+        affine = np.array(json.load(f)['affine'])
+    return data, index, mask, affine
+
+
+def unmask(values, mask, fill=np.nan):
+    """Puts a row of a cohort array, or any vector with one value per brain
+    voxel, back on the 3D image grid
+    """
+    vol = np.full(mask.shape, fill, dtype=np.float32)
+    vol[mask] = values
+    return vol
+
+
+# In[4]:
+
+def _label_groups(atlas, mask, lut=None):
+    """Orders brain voxels by atlas label so per-label sums are contiguous
+    slices. Returns the voxel order, slice starts and column names.
+    """
+    labels = np.asarray(atlas).squeeze()[mask].astype(np.int64)
+    if lut is not None:
+        names = list(lut)
+        keep = np.isin(labels, [lut[n] for n in names])
+        values = np.array([lut[n] for n in names])
+    else:
+        keep = labels != 0
+        values = np.unique(labels[keep])
+        names = values.tolist()
+    vox = np.nonzero(keep)[0]
+    order = vox[np.argsort(labels[vox], kind='stable')]
+    sorted_labels = labels[order]
+    starts = np.searchsorted(sorted_labels, values)
+    ends = np.searchsorted(sorted_labels, values, side='right')
+    return order, starts, ends, names
+
+
+@instrument.profiled
+def roi_means(data, mask, atlas, lut=None, chunksize=64):
+    """Mean of each atlas region in every scan of a cohort array, reading the
+    array chunksize rows at a time. Non-finite voxels are left out of the means.
+
+    Parameters
+    ----------
+    data : numpy array or memmap
+        Cohort array with a row per scan and a column per brain voxel
+    mask : numpy array
+        3D boolean brain mask of the cohort array
+    atlas : numpy array
+        3D integer label volume on the same grid, such as a resampled
+        aparc+aseg or a binary meta-ROI
+    lut : dictionary
+        Regions and their label values, as from FS_make_lut. Default None uses
+        every nonzero label, named by its value.
+    chunksize : int
+        Number of scans reduced at once. Default 64.
+
+    Returns
+    -------
+    means : pandas DataFrame
+        One row per scan, in the order of the cohort index, and one column per
+        region
+    """
+    order, starts, ends, names = _label_groups(atlas, mask, lut)
+    means = np.full((data.shape[0], len(names)), np.nan)
+    nonempty = ends > starts
+    for start in range(0, data.shape[0], chunksize):
+        chunk = np.asarray(data[start:start + chunksize], dtype=np.float64)[:, order]
+        finite = np.isfinite(chunk)
+        chunk[~finite] = 0
+        #cumulative sums turn each region's sum into a difference of two columns
+        csum = np.concatenate([np.zeros((len(chunk), 1)), np.cumsum(chunk, axis=1)], axis=1)
+        ccnt = np.concatenate([np.zeros((len(chunk), 1)), np.cumsum(finite, axis=1)], axis=1)
+        sums = csum[:, ends] - csum[:, starts]
+        counts = ccnt[:, ends] - ccnt[:, starts]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[start:start + chunksize] = np.where(counts > 0, sums / counts, np.nan)
+    means[:, ~nonempty] = np.nan
+    return pd.DataFrame(means, columns=names)
+
+
+# In[5]:
+
+@instrument.profiled
+def cohortarray_run(scans, outdir, name='fdg', maskpath=None, atlaspath=None, lut=None,
+                    jobs=1):
+    """Main function to stack a cohort of scans and, optionally, tabulate
+    atlas region means from the stacked array
+
+    Parameters
+    ----------
+    scans : list or pandas DataFrame
+        Full paths of spatially normalized scans, passed to scan_index
+    outdir : string
+        Full path where the cohort array and tables are saved
+    name : string
+        Base name of the saved files, e.g. 'fdg' or 'pib'. Default 'fdg'.
+    maskpath : string
+        Full path to a brain mask. Default None, see build_cohort_array.
+    atlaspath : string
+        Full path to a label volume on the same grid. Default None skips the
+        region table.
+    lut : dictionary
+        Regions and their label values. Default None uses every label.
+    jobs : int
+        Number of processes reading scans. Scans that fail are saved to
+        name_failures. Default 1.
+
+    Returns
+    -------
+    index : pandas DataFrame
+        Subject, timepoint and path of each row of the array
+    roitbl : pandas DataFrame
+        index joined with the region means, or None without an atlas
+    """
+    failures = []
+    index = build_cohort_array(scans, outdir, name, maskpath, jobs, failures)
+    cf.report_failures(failures, name, outdir)
+    roitbl = None
+    if atlaspath is not None:
+        data, index, mask, _ = load_cohort_array(outdir, name)
+        _, atlas = _load_volume(atlaspath)
+        means = roi_means(data, mask, atlas, lut)
+        roitbl = pd.concat([index[['codea', 'Tp']], means], axis=1)
+        cf.save_xls_and_pkl(roitbl, '%s_roimeans' %name, outdir)
+    return index, roitbl
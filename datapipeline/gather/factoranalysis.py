@@ -9,7 +9,8 @@ import difflib
 from glob import glob
 from copy import deepcopy
 import pandas as pd
-from tools import common_funcs as cf
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
 
 
 # In[19]:
@@ -32,7 +33,7 @@ def assign_row_index(tbldict, rowind):
         Each DataFrame now has rowind as index
     """
     
-    for sess,table_cur in tbldict.iteritems():
+    for sess,table_cur in tbldict.items():
         #find column name that matches the rowind defined above
         rowind_found = [col for col in table_cur.columns if rowind in col]
         rowind_found = rowind_found[0]
@@ -68,7 +69,7 @@ def rename_columns(table, refstrings):
     bad = []
     good = []
     #save original data
-    for test,col in table.iteritems():
+    for test,col in table.items():
         #compare the column header to the master list of cognitive tests and extract best match
         match = difflib.get_close_matches(test, refstrings, 1, 0)
         bad.append(test)
@@ -80,6 +81,7 @@ def rename_columns(table, refstrings):
 
 # In[8]:
 
+@instrument.profiled
 def cogprep(data_list, cogtests_master, rowind='codeb', combine_this=({'trl': ['tr','tl']}), 
             invert_this=({'T_Inverted': 'T'})):
     """Process cognitive tests that need to be either combined or inverted.
@@ -111,20 +113,21 @@ def cogprep(data_list, cogtests_master, rowind='codeb', combine_this=({'trl': ['
     #import all subject data
     subjdata = {}
     for i,tp in enumerate(data_list):
+        instrument.note_read(tp)
         datain = pd.read_excel(tp)
         subjdata.update({'sess%s'%(i+1): datain}) 
         
     #assign new row idices for the subject data
     subjdata = assign_row_index(subjdata, rowind)
 
-    for sess,table_cur in subjdata.iteritems():
+    for sess,table_cur in subjdata.items():
         #rename columns
         table_cur = rename_columns(table_cur, cogtests_master)
         #iterate over items that need to be combined
-        for col_summed, col_unsummed in combine_this.iteritems():
+        for col_summed, col_unsummed in combine_this.items():
             table_cur[col_summed] = (table_cur[col_unsummed]).sum(axis = 1)
         #iterate over items that need to be inverted
-        for col_inv, col_uninv in invert_this.iteritems():
+        for col_inv, col_uninv in invert_this.items():
             table_cur[col_inv] = table_cur[col_uninv] * -1
             
     return subjdata
@@ -132,6 +135,7 @@ def cogprep(data_list, cogtests_master, rowind='codeb', combine_this=({'trl': ['
 
 # In[40]:
 
+@instrument.profiled
 def zscore(blpth, subjdata, cogtests_master):
     """Calculates Z scores for all cognitive data based on a reference dataset
     
@@ -154,6 +158,7 @@ def zscore(blpth, subjdata, cogtests_master):
     """
 
     #import baseline data
+    instrument.note_read(blpth)
     bldata_import = pd.read_excel(blpth)
 
     #rename cognitive test column headers based on master list
@@ -168,7 +173,7 @@ def zscore(blpth, subjdata, cogtests_master):
     zscored = deepcopy(subjdata)
 
     #iterate over session
-    for sess, table_cur in zscored.iteritems():
+    for sess, table_cur in zscored.items():
         #iterate over cognitive test and create z scores
         for test in bl_tests:
             z1 = table_cur[test] - bl_mean[test]
@@ -187,6 +192,7 @@ def zscore(blpth, subjdata, cogtests_master):
 
 # In[61]:
 
+@instrument.profiled
 def factorscores(subjdata, wpth, cogtests_master):
     """Takes z-scored cognitive data and calculates factor scores using designated
     factor weights
@@ -211,6 +217,7 @@ def factorscores(subjdata, wpth, cogtests_master):
     """
 
     #import weights
+    instrument.note_read(wpth)
     weights_import = pd.read_excel(wpth)
     weights = rename_columns(weights_import, cogtests_master)
     #extract weights
@@ -221,7 +228,7 @@ def factorscores(subjdata, wpth, cogtests_master):
     for factor,i in weights.iterrows():
         subjdata_w = subjdata.copy()
         for ii,test in enumerate(weights_tests):
-            subjdata_w[test] = subjdata_w[test].values * weights.ix[factor,test]
+            subjdata_w[test] = subjdata_w[test].values * weights.loc[factor,test]
         factors.update({factor: subjdata_w})
 
     #initiate tables to summarize factor scores
@@ -251,6 +258,7 @@ def factorscores(subjdata, wpth, cogtests_master):
 
 # In[5]:
 
+@instrument.profiled
 def factoranalysis_run(cogpth, blpth, wpth, outdir, rowind, cogtests_master, **kwargs):
     """Takes cognitive data output from filemaker pro database and applies weights from
     a factor analysis. Outputs data for each subject for each cognitive session that has
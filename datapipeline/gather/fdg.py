@@ -4,17 +4,46 @@
 # In[1]:
 
 import os, sys
-from tools import common_funcs as cf
+import functools
+import hashlib
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+from datapipeline.tools import journal
+from datapipeline.tools import dedup
 import shutil
 import glob
 import subprocess
 import pandas as pd
+import numpy as np
 import re
 
 
 # In[2]:
 
-def find_and_copy(datadir, FDG_warpfold, filenm='pn*'):
+def find_warped(datadir, filenm='pn*'):
+    """Full paths of the warped FDG scans in datadir and its subfolders whose
+    names match filenm, leaving out MRI and M15 files
+    """
+    shellfilelist = subprocess.check_output('find . -type f -name \'%s\'' %filenm, shell=True,
+                                            cwd=datadir, universal_newlines=True)
+
+    filelist = shellfilelist.split()
+    filelist = [s for s in filelist if not (re.search('mr',s) or re.search('M15',s))]
+    return [datadir + s[2:] for s in filelist]
+
+
+def copy_name(path):
+    """File name of the copy of a scan in the processing directory, prefixed
+    with a hash of its folder so scans with the same file name in different
+    folders do not overwrite each other
+    """
+    folder = hashlib.md5(os.path.dirname(str(path)).encode()).hexdigest()[:8]
+    return '%s_%s' %(folder, os.path.basename(str(path)))
+
+
+@instrument.profiled
+def find_and_copy(datadir, FDG_warpfold, filenm='pn*', exclude=None, paths=None):
     """Searches datadir for warped FDG scans and copies them to a processing directory
     
     Parameters
@@ -22,28 +51,34 @@ def find_and_copy(datadir, FDG_warpfold, filenm='pn*'):
     datadir : string
         Full path of directory containing files
     FDG_warpfold : string
-        Full path of directory to copy files to
+        Full path of directory to copy files to, named by copy_name
     filenm : string
         General name of warped files. Default is 'pn*'
+    exclude : set
+        Full paths not to copy, e.g. scans measured by an earlier run that
+        died. Default None copies every file found.
+    paths : list
+        Full paths of the warped files to copy, e.g. the unique scans from
+        dedup.find_duplicates. Default None searches datadir.
     
     Returns
     -------
     filepaths : list
-        List of warped files that were copied
+        List of full paths of the warped files found in datadir, or paths,
+        including those in exclude
     warp_subs : list
         List of subject ids for the files that were copied
     """
-    os.chdir(datadir)
+    fullpathfilelist = find_warped(datadir, filenm) if paths is None else list(paths)
 
-    shellfilelist = subprocess.check_output('find . -type f -name \'%s\'' %filenm, shell=True)
-
-    filelist = shellfilelist.split()
-    filelist = [s for s in filelist if not (re.search('mr',s) or re.search('M15',s))]
-    fullpathfilelist = [datadir + s[2:] for s in filelist]
-
-    _ = [shutil.copy2(s, FDG_warpfold) for s in fullpathfilelist]
+    for s in fullpathfilelist:
+        if exclude and s in exclude:
+            continue
+        shutil.copy2(s, FDG_warpfold + copy_name(s))
+        instrument.note_read(s)
+        instrument.note_written(FDG_warpfold + copy_name(s))
     
-    filepaths = glob.glob(FDG_warpfold +'*')
+    filepaths = fullpathfilelist
     warp_subs = os.listdir(FDG_warpfold)
     
     return filepaths, warp_subs
@@ -51,7 +86,37 @@ def find_and_copy(datadir, FDG_warpfold, filenm='pn*'):
 
 # In[3]:
 
-def create_masks(warp_subs, FDG_warpfold, FDG_maskfold, template):
+#extensions of image files, longest first. fslmaths names its output by
+#FSLOUTPUTTYPE, so a masked .nii scan can come out as .nii.gz
+IMAGE_EXTENSIONS = ('.nii.gz', '.hdr.gz', '.img.gz', '.nii', '.hdr', '.img')
+
+
+def scan_stem(path):
+    """File name of a scan or of its masked copy without the folders, the
+    image extension and the mi_ prefix, so the two can be matched whatever
+    extension fslmaths gave the copy
+    """
+    name = os.path.basename(path)
+    if name.startswith('mi_'):
+        name = name[3:]
+    for ext in IMAGE_EXTENSIONS:
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def mask_scan(sub, FDG_warpfold, FDG_maskfold, template):
+    """Masks one warped scan with the template using fslmaths
+    """
+    instrument.note_read(FDG_warpfold+sub)
+    status = os.system('fslmaths '+FDG_warpfold+sub+' -mas '+template+' '+FDG_maskfold+'mi_'+sub)
+    if status != 0:
+        raise RuntimeError('fslmaths exited with status %d' %status)
+    instrument.note_written(FDG_maskfold+'mi_'+sub)
+
+
+@instrument.profiled
+def create_masks(warp_subs, FDG_warpfold, FDG_maskfold, template, jobs=1, failures=None):
     """For each subject in warp_subs, creates a binary mask using the 
     template and applies it over the subject. The extracted values from 
     the mask are then deposited into FDG_maskfold
@@ -66,18 +131,37 @@ def create_masks(warp_subs, FDG_warpfold, FDG_maskfold, template):
         Full path to folder that will hold processed data
     template : string
         Full path to template brain scan containing mask
+    jobs : int
+        Number of scans to mask at the same time. Default 1.
+    failures : list
+        If given, the table of scans that failed is appended to it. Default
+        None prints them.
     """
-    pth,_ = os.path.split(template)
-    
-    os.chdir(FDG_warpfold)
-    
-    for sub in warp_subs:
-        os.system('fslmaths '+sub+' -mas '+template+' '+FDG_maskfold+'mi_'+sub)
+    #fslmaths does the work in its own process, so threads are enough
+    _, failed = shards.shard_map(functools.partial(mask_scan, FDG_warpfold=FDG_warpfold,
+                                                   FDG_maskfold=FDG_maskfold, template=template),
+                                 warp_subs, jobs, key=cf.get_id, processes=False)
+    shards.keep_failures(failed, failures, 'create_masks')
 
 
 # In[4]:
 
-def generate_values(mask_dir):
+def measure_mask(mask):
+    """Mean value of one masked scan using fslstats, ignoring NaNs
+    """
+    instrument.note_read(mask)
+    roi_value = subprocess.check_output('fslstats '+mask+' -M', shell = True,
+                                        universal_newlines=True)
+    if 'nan' in roi_value:
+        os.system('fslmaths '+mask+' -nan '+mask+'_nonan')
+        roi_value = subprocess.check_output('fslstats '+mask+'_nonan -M', shell = True,
+                                            universal_newlines=True)
+    return roi_value
+
+
+@instrument.profiled
+def generate_values(mask_dir, jobs=1, failures=None, journal=None, journaltag='',
+                    sources=None):
     """Extracts the mean value from each mask in the roi_mask directory. 
     Returns these values as a dict.
     
@@ -85,6 +169,19 @@ def generate_values(mask_dir):
     ----------
     mask_dir : string
         Full path to masked data
+    jobs : int
+        Number of masks to measure at the same time. Default 1.
+    failures : list
+        If given, the table of masks that failed is appended to it. Failed
+        masks are left out of metaroi_vals. Default None prints them.
+    journal : string
+        Full path of a checkpoint journal each value is saved to, keyed by the
+        path of the scan in sources it was masked from. Default None.
+    journaltag : string
+        Description of the work, see shards.shard_map. Default ''.
+    sources : list
+        Full paths of the scans in datadir, from find_and_copy. Default None
+        keys the journal by the mask names without prefix or extension.
     
     Returns
     -------
@@ -93,20 +190,132 @@ def generate_values(mask_dir):
         FDG value
     """
     masklist = [mask_dir + fl for fl in os.listdir(mask_dir)]
-    metaroi_vals = {}
-    for mask in masklist:
-        roi_value = subprocess.check_output('fslstats '+mask+' -M', shell = True)
-        if 'nan' in roi_value:
-            os.system('fslmaths '+mask+' -nan '+mask+'_nonan')
-            roi_value = subprocess.check_output('fslstats '+mask+'_nonan -M', shell = True)
-        metaroi_vals.update({mask: roi_value})
+    bysource = dict((scan_stem(copy_name(p)), p) for p in (sources or []))
+    values, failed = shards.shard_map(measure_mask, masklist, jobs,
+                                      key=lambda mask: cf.get_id(os.path.basename(mask)),
+                                      processes=False, journal=journal,
+                                      journaltag=journaltag,
+                                      ids=[bysource.get(scan_stem(m), scan_stem(m))
+                                           for m in masklist])
+    shards.keep_failures(failed, failures, 'generate_values')
+    metaroi_vals = dict((mask, value) for mask, value in zip(masklist, values)
+                        if value is not None)
     return metaroi_vals
 
 
 # In[5]:
 
-def generate_df(metaroi_vals, outdir):
-    """Generates a dataframe with the metaroi values for each subject
+#dates in scan paths and headers, e.g. 20150812 or 2015-08-12
+DATE_PATTERN = r'((?:19|20)\d{2}-?[01]\d-?[0-3]\d)'
+
+
+def _header_date(path):
+    """Searches the description field of an image header for a scan date
+    """
+    import nibabel as nb
+    try:
+        descrip = nb.load(path).header['descrip']
+    except Exception:
+        return None
+    datematch = re.search(DATE_PATTERN, str(np.asarray(descrip).astype(str)))
+    if datematch:
+        return datematch.group(1)
+
+
+def scan_info(paths, readheaders=True):
+    """Finds the subject id, timepoint and scan date of each FDG scan from its
+    path, reading the image header only for scans whose path holds no date.
+    Scans without a _v# timepoint are numbered by date within each subject.
+    
+    Parameters
+    ----------
+    paths : list
+        Full paths of FDG scans, preferably in datadir where directory names
+        may hold the scan date
+    readheaders : boolean
+        If TRUE, look for dates missing from paths in the image headers.
+        Default is TRUE.
+    
+    Returns
+    -------
+    info : pandas DataFrame
+        DataFrame with columns path, codea, FDG_Tp, FDG_Scandate and
+        FDG_YrsRelBL (years since the subject's first FDG scan)
+    """
+    paths = pd.Series([str(p) for p in paths], dtype=object)
+    names = paths.map(os.path.basename)
+    info = pd.DataFrame({'path': paths})
+    #same patterns as get_id and get_tp, looking in the file name first
+    idpattern = '(%s)' %cf.ID_PATTERN
+    info['codea'] = names.str.extract(idpattern, expand=False).fillna(
+        paths.str.extract(idpattern, expand=False))
+    info['FDG_Tp'] = pd.to_numeric(names.str.extract(r'\_v(\d)', expand=False))
+    dates = paths.str.extract(DATE_PATTERN, expand=False)
+    if readheaders and dates.isnull().any():
+        missing = dates.isnull()
+        dates[missing] = [_header_date(p) for p in paths[missing]]
+        for p in paths[missing]:
+            instrument.note_read(p)
+    info['FDG_Scandate'] = pd.to_datetime(dates.str.replace('-', '', regex=False),
+                                          format='%Y%m%d', errors='coerce')
+    
+    notp = info['FDG_Tp'].isnull() & info['FDG_Scandate'].notnull()
+    if notp.any():
+        bydate = info.groupby('codea')['FDG_Scandate'].rank(method='dense')
+        info.loc[notp, 'FDG_Tp'] = bydate[notp]
+    firstdate = info.groupby('codea')['FDG_Scandate'].transform('min')
+    info['FDG_YrsRelBL'] = (info['FDG_Scandate'] - firstdate).dt.days / 365.25
+    return info
+
+
+def fdg_slopes(tbl, valcols):
+    """Adds the rate of change per year of each FDG value to all rows of each
+    subject, fit by common_funcs.subject_slopes against FDG_YrsRelBL
+    
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame from scan_info with FDG values added
+    valcols : list
+        Names of columns in tbl to calculate rate of change of
+    
+    Returns
+    -------
+    tbl : pandas DataFrame
+        tbl with a '<valcol>_sl' column for each valcol
+    """
+    slopes = cf.subject_slopes(tbl, 'codea', 'FDG_YrsRelBL', valcols)
+    slopes = slopes[['%s_sl' %col for col in valcols]]
+    return tbl.merge(slopes, how='left', left_on='codea', right_index=True)
+
+
+def resolve_duplicates(vals, dups):
+    """Adds a row for each scan that dedup.find_duplicates left out as a copy
+    of a measured scan, with the values of the copy that was measured
+    
+    Parameters
+    ----------
+    vals : pandas DataFrame
+        DataFrame with a path column holding the full paths of the measured
+        scans in datadir and a column for each of their values
+    dups : pandas DataFrame
+        Output of dedup.find_duplicates on the scans in datadir
+    
+    Returns
+    -------
+    vals : pandas DataFrame
+        vals with the duplicates of its scans added after them, each under its
+        own path so scan_info reads its subject, timepoint and date
+    """
+    aliases = dups.loc[dups['duplicate'] & dups['canonical'].isin(vals['path'])]
+    copied = vals.set_index('path').loc[list(aliases['canonical'])]
+    copied.index = pd.Index(list(aliases['path']), name='path')
+    return pd.concat([vals, copied.reset_index()], ignore_index=True)
+
+
+@instrument.profiled
+def generate_df(metaroi_vals, outdir, sources=None, duplicates=None):
+    """Generates a dataframe with the metaroi values for each scan
     
     Parameters    
     ----------
@@ -115,25 +324,242 @@ def generate_df(metaroi_vals, outdir):
         FDG value
     outdir : string
         Full path where FDG output file should be saved
+    sources : list
+        Full paths of the scans in datadir, from find_and_copy, used to find
+        the scan dates. Default None uses the keys of metaroi_vals.
+    duplicates : pandas DataFrame
+        Output of dedup.find_duplicates on the scans in datadir. Copies that
+        were not measured are added with the values of the scan they copy.
+        Default None.
         
     Returns
     -------
     metaroi_df : pandas DataFrame
-        DataFrame where each row is an FDG scan
+        DataFrame where each row is an FDG scan, keyed by codea and FDG_Tp
     """
-    metaroi_df = pd.DataFrame.from_dict(metaroi_vals,orient='index')
-    metaroi_df.reset_index(level=0, inplace=True)
-    metaroi_df.rename(columns={0:'roi_vals','index':'path'},inplace=True)
-    metaroi_df['roi_vals'] = [float(x) for x in metaroi_df['roi_vals']]
-    metaroi_df['codea'] = [cf.get_id(x) for x in metaroi_df['path']]
-    metaroi_df = metaroi_df.rename(columns={'roi_vals':'FDG_val'})
-    metaroi_df = metaroi_df.drop('path', axis=1)
+    bysource = dict((scan_stem(copy_name(p)), p) for p in (sources or []))
+    paths = list(metaroi_vals)
+    vals = pd.DataFrame({'path': [bysource.get(scan_stem(p), p) for p in paths],
+                         'FDG_val': [float(metaroi_vals[p]) for p in paths]})
+    if duplicates is not None:
+        vals = resolve_duplicates(vals, duplicates)
+    metaroi_df = scan_info(vals['path'])
+    metaroi_df['FDG_val'] = vals['FDG_val']
+    metaroi_df = fdg_slopes(metaroi_df, ['FDG_val'])
+    metaroi_df = metaroi_df.drop('path', axis=1).sort_values(['codea', 'FDG_Tp'])
+    metaroi_df = metaroi_df.reset_index(drop=True)
     
     cf.save_xls_and_pkl(metaroi_df, 'fdg_metaroi', outdir)
     
     return metaroi_df
 
 
+# In[6]:
+
+def atlas_labels(atlaspath, lut=None):
+    """Reads a labeled atlas once and prepares it for atlas_stats
+
+    Parameters
+    ----------
+    atlaspath : string
+        Full path to a label volume on the same grid as the warped scans
+    lut : dictionary
+        Regions and their label values, as from FS_make_lut. Default None uses
+        every nonzero label, named by its value.
+
+    Returns
+    -------
+    atlas : dict
+        Flat indices of labeled voxels, the region number of each, region
+        names and the shape of the grid
+    """
+    import nibabel as nb
+    instrument.note_read(atlaspath)
+    labels = np.asarray(nb.load(atlaspath).dataobj).squeeze().astype(np.int64)
+    if lut is None:
+        values = np.unique(labels[labels != 0])
+        names = [str(v) for v in values]
+    else:
+        names = list(lut)
+        values = np.array([lut[n] for n in names])
+    flat = labels.ravel()
+    vox = np.nonzero(np.isin(flat, values))[0]
+    #region number of each labeled voxel, in the order of names
+    order = np.argsort(values)
+    ids = order[np.searchsorted(values[order], flat[vox])]
+    return {'vox': vox, 'ids': ids, 'names': names, 'shape': labels.shape}
+
+
+def atlas_stats(scanpath, atlas, refregion=None):
+    """Mean, median, standard deviation and voxel count of every atlas region
+    in a scan, from one read of the scan and a few bincounts. Non-finite voxels
+    are left out.
+
+    Parameters
+    ----------
+    scanpath : string
+        Full path to a warped scan
+    atlas : dict
+        Output of atlas_labels
+    refregion : string or list
+        Name(s) of regions whose pooled mean each region mean is divided by to
+        give an SUVR, e.g. 'Pons'. Default None skips the SUVR.
+
+    Returns
+    -------
+    stats : dict
+        Keys are '<region>_mean', '<region>_median', '<region>_std',
+        '<region>_nvox' and, with refregion, '<region>_suvr'
+    """
+    import nibabel as nb
+    instrument.note_read(scanpath)
+    vol = np.asarray(nb.load(scanpath).dataobj, dtype=np.float64).squeeze()
+    if vol.shape != atlas['shape']:
+        raise ValueError('%s has shape %s, atlas has shape %s' %(scanpath, vol.shape,
+                                                                 atlas['shape']))
+    vals = vol.ravel()[atlas['vox']]
+    finite = np.isfinite(vals)
+    ids, vals = atlas['ids'][finite], vals[finite]
+    nreg = len(atlas['names'])
+
+    nvox = np.bincount(ids, minlength=nreg)
+    sums = np.bincount(ids, weights=vals, minlength=nreg)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = sums / nvox
+        dev = vals - mean[ids]
+        std = np.sqrt(np.bincount(ids, weights=dev * dev, minlength=nreg) / (nvox - 1))
+    std[nvox < 2] = np.nan
+
+    #sorting by region then value puts each region's median in the middle of its run
+    srt = vals[np.lexsort((vals, ids))]
+    starts = np.concatenate([[0], np.cumsum(nvox)[:-1]])
+    median = np.full(nreg, np.nan)
+    has = nvox > 0
+    median[has] = (srt[(starts + (nvox - 1) // 2)[has]] + srt[(starts + nvox // 2)[has]]) / 2.
+
+    stats = {}
+    for i, name in enumerate(atlas['names']):
+        stats['%s_mean' %name] = mean[i]
+        stats['%s_median' %name] = median[i]
+        stats['%s_std' %name] = std[i]
+        stats['%s_nvox' %name] = nvox[i]
+    if refregion is not None:
+        refs = [refregion] if isinstance(refregion, str) else list(refregion)
+        refidx = [atlas['names'].index(str(r)) for r in refs]
+        refmean = sums[refidx].sum() / nvox[refidx].sum()
+        for i, name in enumerate(atlas['names']):
+            stats['%s_suvr' %name] = mean[i] / refmean
+    return stats
+
+
+@instrument.profiled
+def generate_atlas_values(scanpaths, atlaspath, lut=None, refregion=None, jobs=1,
+                          sources=None, failures=None, journal=None, journaltag='',
+                          duplicates=None):
+    """Extracts statistics of every atlas region from each scan, reading each
+    scan once instead of running fslmaths and fslstats per region
+
+    Parameters
+    ----------
+    scanpaths : list
+        Full paths to warped scans
+    atlaspath : string
+        Full path to a label volume on the same grid as the scans
+    lut : dictionary
+        Regions and their label values. Default None uses every label.
+    refregion : string or list
+        Reference region(s) for SUVR columns. Default None.
+    jobs : int
+        Number of processes reading scans. Default 1.
+    sources : list
+        Full paths of the scans in datadir, used to find the scan dates. Must be
+        in the same order as scanpaths. Default None uses scanpaths.
+    failures : list
+        If given, the table of scans that failed is appended to it. Failed scans
+        are left out of atlas_df. Default None prints them.
+    journal : string
+        Full path of a checkpoint journal each scan's statistics are saved to,
+        keyed by its path in sources. Scans already in it are not read again.
+        Default None.
+    journaltag : string
+        Description of the work, see shards.shard_map. Default ''.
+    duplicates : pandas DataFrame
+        Output of dedup.find_duplicates on the scans in sources. Copies that
+        were not read are added after the scans with the statistics of the
+        scan they copy. Default None.
+
+    Returns
+    -------
+    atlas_df : pandas DataFrame
+        One row per scan keyed by codea and FDG_Tp, with its scan date and
+        mean, median, std, voxel count and optional SUVR columns for each region
+    """
+    atlas = atlas_labels(atlaspath, lut)
+    rows, failed = shards.shard_map(functools.partial(atlas_stats, atlas=atlas,
+                                                      refregion=refregion),
+                                    scanpaths, jobs,
+                                    key=lambda scan: cf.get_id(os.path.basename(scan)),
+                                    journal=journal, journaltag=journaltag,
+                                    ids=sources if sources is not None else scanpaths)
+    shards.keep_failures(failed, failures, 'atlas_stats')
+    srcpaths = sources if sources is not None else scanpaths
+    vals = pd.DataFrame([row for row in rows if row is not None])
+    vals.insert(0, 'path', [p for p, row in zip(srcpaths, rows) if row is not None])
+    if duplicates is not None:
+        vals = resolve_duplicates(vals, duplicates)
+    info = scan_info(vals['path'])
+    atlas_df = pd.concat([info.drop('path', axis=1), vals.drop('path', axis=1)], axis=1)
+    return atlas_df
+
+
+# In[7]:
+
+def report_duplicates(dups, metaroi_vals, copyname, outdir):
+    """Maps the values measured for each scan back to its duplicate copies,
+    which were not measured again, and saves them as fdg_duplicates
+
+    Parameters
+    ----------
+    dups : pandas DataFrame
+        Output of dedup.find_duplicates on the scans in datadir
+    metaroi_vals : dict
+        Values of the unique scans, from fdg_run
+    copyname : function
+        Function of a path in datadir returning its key in metaroi_vals
+    outdir : string
+        Full path where fdg_duplicates should be saved
+
+    Returns
+    -------
+    aliases : pandas DataFrame
+        One row per duplicate with columns path, canonical (the copy that was
+        measured), codea and FDG_Tp read from each, same_id (FALSE when the
+        copies are named for different subjects or timepoints) and the values
+        of the canonical copy
+    """
+    aliases = dups.loc[dups['duplicate'], ['path', 'canonical']].reset_index(drop=True)
+    if len(aliases) == 0:
+        return aliases
+    for col, paths in [('', aliases['path']), ('canonical_', aliases['canonical'])]:
+        names = paths.map(os.path.basename)
+        aliases[col + 'codea'] = names.map(cf.get_id)
+        aliases[col + 'FDG_Tp'] = pd.to_numeric(names.map(cf.get_tp))
+    aliases['same_id'] = ((aliases['codea'] == aliases['canonical_codea'])
+                          & (aliases['FDG_Tp'].fillna(-1) == aliases['canonical_FDG_Tp'].fillna(-1)))
+    vals = [metaroi_vals.get(copyname(p)) for p in aliases['canonical']]
+    if any(isinstance(v, dict) for v in vals):
+        vals = pd.DataFrame([v if v is not None else {} for v in vals])
+    else:
+        vals = pd.DataFrame({'FDG_val': [float(v) if v is not None else np.nan for v in vals]})
+    aliases = pd.concat([aliases, vals], axis=1)
+
+    print('%d FDG scan(s) are copies of another scan and were not measured again:'
+          %len(aliases))
+    print(aliases[['path', 'canonical', 'same_id']].to_string(index=False))
+    cf.save_xls_and_pkl(aliases, 'fdg_duplicates', outdir)
+    return aliases
+
+
 # In[15]:
 
 def clean_up(fdgdirs):
@@ -152,7 +578,9 @@ def clean_up(fdgdirs):
 
 # In[17]:
 
-def fdg_run(datadir, FDGfold, template, outdir, filenm, cleanup=False):
+@instrument.profiled
+def fdg_run(datadir, FDGfold, template, outdir, filenm, cleanup=False, jobs=1,
+            atlas=None, lut=None, refregion=None, resume=True, dedupe=True):
     """Main function to college FDG metaroi values
     
     Parameters    
@@ -160,8 +588,9 @@ def fdg_run(datadir, FDGfold, template, outdir, filenm, cleanup=False):
     datadir : string
         Full path of directory containing files
     FDGfold : string
-        Full path of directory where FDG files will be copied. There
-        should be two folders here named W and M
+        Full path of directory where FDG files will be copied. Each run copies
+        and masks scans in W and J folders of its own run_* directory here, so
+        runs never see each other's files.
     template : string
         Full path to the metaroi mask file ex: rcomposite_ROI.nii
     outdir : string
@@ -169,34 +598,95 @@ def fdg_run(datadir, FDGfold, template, outdir, filenm, cleanup=False):
     filenm : string
         General name of warped files. Default is 'pn*'
     cleanup : boolean
-        If TRUE, runs clean_up to delete files created during FDG processsing.
-        Default is FALSE.
+        If TRUE, deletes the run's directory of files created during FDG
+        processsing. Default is FALSE keeps it.
+    jobs : int
+        Number of scans to process at the same time, see shards.shard_map. Scans
+        that fail are left out and saved to fdg_failures. Default 1.
+    atlas : string
+        Full path to a label volume on the same grid as the warped scans. If
+        given, statistics of every atlas region are read from the warped scans
+        with generate_atlas_values instead of masking with template and FSL.
+        Default None.
+    lut : dictionary
+        Regions and their label values in atlas. Default None uses every label.
+    refregion : string or list
+        Reference region(s) of atlas for SUVR columns. Default None.
+    resume : boolean
+        Each scan's value is saved to a journal in outdir as soon as it is
+        measured, and the journal is deleted once fdg_metaroi is saved. If
+        TRUE, scans in the journal of an earlier run that died are not copied
+        or measured again. Default is TRUE.
+    dedupe : boolean
+        If TRUE, scans in datadir with identical content are found with
+        dedup.find_duplicates and only one copy of each is measured. The
+        others are added to fdg_metaroi with its values and listed in
+        fdg_duplicates. Default is TRUE.
         
     Returns
     -------
     metaroi_vals : dict
         Dictionary where keys are the filename and values are the mean
-        value
+        value, or the region statistics when atlas is given
     metaroi_df : pandas DataFrame
         DataFrame where each row is a scan
     """
     
-    if not os.path.exists(FDGfold):
-        os.makedirs(FDGfold)
-    FDG_warpfold = FDGfold +'W/'
-    if not os.path.exists(FDG_warpfold):
+    if atlas is not None:
+        journalpath = '%sfdg_atlas.journal' %outdir
+        journaltag = repr(('atlas', atlas, os.path.getmtime(atlas),
+                           sorted(lut.items()) if lut else None, refregion))
+    else:
+        journalpath = '%sfdg_metaroi.journal' %outdir
+        journaltag = repr(('metaroi', template, os.path.getmtime(template)))
+    if not resume:
+        journal.remove(journalpath)
+    done = journal.load(journalpath, journaltag)
+    
+    with journal.scratch_dir(FDGfold, keep=not cleanup) as rundir:
+        FDG_warpfold = rundir +'W/'
         os.makedirs(FDG_warpfold)
-    FDG_maskfold = FDGfold +'J/'
-    if not os.path.exists(FDG_maskfold):
+        FDG_maskfold = rundir +'J/'
         os.makedirs(FDG_maskfold)
-    
-    filepaths, warp_subs = find_and_copy(datadir, FDG_warpfold, filenm)
-    create_masks(warp_subs, FDG_warpfold, FDG_maskfold, template)
-    metaroi_vals = generate_metaroi_values(FDG_maskfold)
-    metaroi_df = generate_df(metaroi_vals, outdir)
-    
-    if cleanup==True:
-        clean_up([FDG_warpfold, FDG_maskfold])
+        
+        failures = []
+        filepaths = find_warped(datadir, filenm)
+        dups = None
+        if dedupe:
+            dups = dedup.find_duplicates(filepaths, jobs, failures)
+            filepaths = list(dups.loc[~dups['duplicate'], 'path'])
+        filepaths, warp_subs = find_and_copy(datadir, FDG_warpfold, filenm, set(done),
+                                             filepaths)
+        if atlas is not None:
+            copies = [FDG_warpfold + copy_name(p) for p in filepaths]
+            metaroi_df = generate_atlas_values(copies, atlas, lut, refregion, jobs, filepaths,
+                                               failures, journalpath, journaltag, dups)
+            failed = set(item for tbl in failures for item in tbl['item'])
+            copies = [c for c in copies if c not in failed]
+            valcols = [c for c in metaroi_df.columns if c.endswith(('_mean', '_suvr'))]
+            #the duplicates come after the scans that were read
+            metaroi_vals = dict(zip(copies, metaroi_df[valcols].to_dict('records')))
+            metaroi_df = fdg_slopes(metaroi_df, valcols)
+            metaroi_df = metaroi_df.sort_values(['codea', 'FDG_Tp']).reset_index(drop=True)
+            cf.save_xls_and_pkl(metaroi_df, 'fdg_metaroi', outdir)
+        else:
+            create_masks(warp_subs, FDG_warpfold, FDG_maskfold, template, jobs, failures)
+            metaroi_vals = generate_values(FDG_maskfold, jobs, failures, journalpath,
+                                           journaltag, filepaths)
+            #scans measured before a restart, named like their masks
+            found = set(filepaths)
+            metaroi_vals.update((FDG_maskfold + 'mi_' + copy_name(src), value)
+                                for src, value in done.items() if src in found)
+            metaroi_df = generate_df(metaroi_vals, outdir, filepaths, dups)
+    if dedupe:
+        if atlas is not None:
+            copyname = lambda p: FDG_warpfold + copy_name(p)
+        else:
+            bystem = dict((scan_stem(m), m) for m in metaroi_vals)
+            copyname = lambda p: bystem.get(scan_stem(copy_name(p)))
+        report_duplicates(dups, metaroi_vals, copyname, outdir)
+    journal.remove(journalpath)
+    cf.report_failures(failures, 'fdg', outdir)
     
     return metaroi_vals, metaroi_df
 
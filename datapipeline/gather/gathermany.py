@@ -0,0 +1,204 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+from datapipeline.tools import dag
+from datapipeline.tools import instrument
+from datapipeline.gather import codetranslator
+from datapipeline.gather import pibparams
+from datapipeline.gather import pibdvr
+from datapipeline.gather import mri
+from datapipeline.gather import fdg
+from datapipeline.gather import inventory
+from datapipeline.gather import pvc
+from datapipeline.gather import cogtestdates
+from datapipeline.gather import factoranalysis
+from datapipeline.merge import datamerge
+
+
+# In[2]:
+
+def scan_inputs(scans, columns):
+    """Lists the files a stage reads scans from, for its fingerprint.
+
+    Parameters
+    ----------
+    scans : list or pandas DataFrame
+        Paths or tuples of paths, or a table with one scan per row
+    columns : list
+        Columns of a scan table that hold paths
+
+    Returns
+    -------
+    inputs : list
+        Paths of every scan, column by column for a table
+    """
+    if hasattr(scans, 'columns'):
+        return [path for col in columns if col in scans.columns for path in scans[col]]
+    return [path for scan in scans
+            for path in ([scan] if isinstance(scan, str) else scan)]
+
+
+# In[3]:
+
+def build_stages(config, jobs=1):
+    """Declares the gather and merge stages and the tables passed between them.
+    Replaces running the cells of gathermany.ipynb in order.
+
+    Parameters
+    ----------
+    config : dict
+        Dictionary holding 'outdir' and one dictionary per modality holding the
+        arguments of its *_run function, with keys 'codetranslator', 'pibdvr',
+        'pibparams', 'inventory', 'mri', 'fdg', 'pvc', 'cogtestdates',
+        'factoranalysis' and 'datamerge'. Modalities that are missing from config are left out of
+        the pipeline.
+    jobs : int
+        Number of subjects the mri and fdg stages may process at the same time.
+        Default 1.
+
+    Returns
+    -------
+    stages : dict
+        Dictionary where keys are stage names and values are made by dag.stage
+    """
+    outdir = config['outdir']
+    stages = {}
+
+    if 'codetranslator' in config:
+        c = config['codetranslator']
+        stages['codetranslator'] = dag.stage(codetranslator.codetranslator_run,
+                    'codetranslator', inputs=[c['codetblpath']],
+                    codetblpath=c['codetblpath'], outdir=outdir)
+
+    if 'pibdvr' in config:
+        c = config['pibdvr']
+        scans = c['scans']
+        inputs = [scans] if isinstance(scans, str) else scan_inputs(scans, ['path', 'atlas'])
+        inputs += [c['atlas']] if c.get('atlas') else []
+        stages['pibdvr'] = dag.stage(pibdvr.pibdvr_run, 'pibdvr',
+                    inputs=inputs, scans=scans, outdir=outdir, frametimes=c['frametimes'],
+                    atlas=c.get('atlas'), tstar=c.get('tstar', 35.), lut=c.get('lut'),
+                    refregion=c.get('refregion'), indexrois=c.get('indexrois'),
+                    k2ref=c.get('k2ref'), jobs=jobs, dvrdir=c.get('dvrdir'))
+
+    if 'pibparams' in config:
+        c = config['pibparams']
+        #regional DVRs computed from dynamic scans go into the PIB table
+        dvrneeds = ['pibdvr'] if 'pibdvr' in config else []
+        stages['pibparams'] = dag.stage(pibparams.pibparams_run, 'pibparams',
+                    needs=dvrneeds, tblarg='tbldict' if dvrneeds else None,
+                    inputs=[c['path_pib']], path_pib=c['path_pib'],
+                    pibrename=c['pibrename'], outdir=outdir, pibcutoff=c['pibcutoff'])
+
+    #with an inventory, the imaging stages wait for it, and a strict inventory
+    #stops them when a scan is unreadable or off the grid of its group
+    imgneeds = []
+    if 'inventory' in config:
+        c = config['inventory']
+        fdgdir = c.get('fdgdir', config.get('fdg', {}).get('datadir'))
+        fsdir = c.get('fsdir', config.get('mri', {}).get('datadir'))
+        stages['inventory'] = dag.stage(inventory.inventory_run, 'inventory',
+                    inputs=[d for d in [fdgdir, fsdir] if d], outdir=outdir,
+                    fdgdir=fdgdir, fsdir=fsdir,
+                    filenm=c.get('filenm', config.get('fdg', {}).get('filenm', 'pn*')),
+                    jobs=jobs, strict=c.get('strict', False), dbpath=c.get('dbpath'))
+        imgneeds = ['inventory']
+
+    if 'mri' in config:
+        c = config['mri']
+        stages['mri'] = dag.stage(mri.mri_run, ['aseg_stats', 'aseg_change'],
+                    needs=imgneeds, inputs=[c['datadir']], datadir=c['datadir'], outdir=outdir,
+                    rois=c['rois'], jobs=jobs, stream=c.get('stream', 'cross'))
+
+    if 'fdg' in config:
+        c = config['fdg']
+        inputs = [c['datadir']] + [c[k] for k in ['template', 'atlas'] if c.get(k)]
+        stages['fdg'] = dag.stage(fdg.fdg_run, ['fdg_vals', 'fdg_metaroi'],
+                    needs=imgneeds, inputs=inputs, datadir=c['datadir'],
+                    FDGfold=c.get('FDGfold', outdir + 'FDG/'), template=c.get('template'),
+                    outdir=outdir, filenm=c.get('filenm', 'pn*'),
+                    cleanup=c.get('cleanup', False), jobs=jobs, atlas=c.get('atlas'),
+                    lut=c.get('lut'), refregion=c.get('refregion'),
+                    dedupe=c.get('dedupe', True))
+
+    if 'pvc' in config:
+        c = config['pvc']
+        stages['pvc'] = dag.stage(pvc.pvc_run, 'pvc',
+                    inputs=scan_inputs(c['scans'], ['path', 'aparc']),
+                    scans=c['scans'], outdir=outdir, fwhm=c['fwhm'], name=c.get('name', 'fdg'),
+                    lut=c.get('lut'), labelcache=c.get('labelcache'),
+                    refregion=c.get('refregion'), indexrois=c.get('indexrois'), jobs=jobs)
+
+    if 'cogtestdates' in config:
+        c = config['cogtestdates']
+        stages['cogtestdates'] = dag.stage(cogtestdates.cogtestdates_run,
+                    ['cogtestdates', 'subjinfo'], inputs=[c['path_cogdates']],
+                    path_cogdates=c['path_cogdates'], staticrename=c['staticrename'],
+                    outdir=outdir)
+
+    if 'factoranalysis' in config:
+        c = config['factoranalysis']
+        stages['factoranalysis'] = dag.stage(factoranalysis.factoranalysis_run,
+                    ['cogsubjdata', 'cogsubjdata_z', 'cogdata'],
+                    inputs=[c['cogpth'], c['blpth'], c['wpth']],
+                    cogpth=c['cogpth'], blpth=c['blpth'], wpth=c['wpth'],
+                    outdir=outdir, rowind=c.get('rowind', 'codeb'),
+                    cogtests_master=c['cogtests_master'])
+
+    if 'datamerge' in config:
+        c = config['datamerge']
+        filenames = ['cogtestdates', 'subjinfo', 'cogdata', 'pibparams', 'aseg_change',
+                     'fdg_metaroi', 'codetranslator']
+        #tables no stage here makes are read from earlier runs in outdir
+        made_by = dag.producers(stages)
+        needs = [fn for fn in filenames if fn in made_by]
+        #the summary of every stage is printed by the command line instead
+        stages['datamerge'] = dag.stage(datamerge.datamerge_run,
+                    ['tbldict', 'NPtbl', 'subjtbl'], needs=needs, tblarg='tbldict',
+                    inputs=[outdir + fn + '*.pkl' for fn in filenames if fn not in made_by],
+                    filenames=filenames, outdir=outdir, roc_cols=c.get('roc_cols', []),
+                    visit_tolerance=c.get('visit_tolerance'), dbpath=c.get('dbpath'),
+                    report=False)
+
+    return stages
+
+
+# In[4]:
+
+@instrument.profiled
+def gathermany_run(config, targets=None, jobs=1, stagejobs=1, force=False, verbose=True):
+    """Main function to gather all data modalities and merge them together.
+    Independent gather stages run concurrently, tables are passed to datamerge
+    in memory, and stages whose inputs have not changed since the last run are
+    loaded from outdir/.dagcache instead of being run again.
+
+    Parameters
+    ----------
+    config : dict
+        Paths and arguments for each modality. See build_stages.
+    targets : list
+        Names of the stages to run, along with the stages they depend on.
+        Default None runs all stages in config.
+    jobs : int
+        Number of subjects each stage may process at the same time. Default 1.
+    stagejobs : int
+        Number of independent stages that may run at the same time. Up to
+        stagejobs * jobs workers run at once. Default 1.
+    force : boolean
+        If True, rerun stages even if their inputs are unchanged. Default False.
+    verbose : boolean
+        Default True. Prints which stages run or are skipped.
+
+    Returns
+    -------
+    tables : dict
+        Dictionary of every table made by the stages that ran, including
+        'NPtbl' and 'subjtbl' if datamerge ran
+    """
+    stages = build_stages(config, jobs)
+    cachedir = os.path.join(config['outdir'], '.dagcache')
+    return dag.run_dag(stages, targets=targets, jobs=stagejobs, cachedir=cachedir,
+                       force=force, verbose=verbose)
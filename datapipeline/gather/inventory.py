@@ -0,0 +1,241 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import io
+import os
+import gzip
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import subjindex
+from datapipeline.tools import shards
+from datapipeline.tools import tablestore
+from datapipeline.gather import fdg
+
+
+# In[2]:
+
+#enough bytes for a NIfTI-2 header, the largest header read
+HEADER_BYTES = 540
+#columns compared between scans of a group by flag_geometry
+GEOMETRY_COLS = ['shape', 'zooms', 'orientation']
+
+
+def _open(path):
+    if path.endswith(('.gz', '.mgz')):
+        #reading the first bytes only decompresses the first block
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def header_path(path):
+    """Path of the file holding an image's header: the .hdr next to the .img
+    of an Analyze or NIfTI pair, otherwise the image itself
+    """
+    for img, hdr in [('.img', '.hdr'), ('.img.gz', '.hdr.gz')]:
+        if path.endswith(img):
+            return path[:-len(img)] + hdr
+    return path
+
+
+def read_header(path):
+    """Reads the geometry of a NIfTI (.nii, .nii.gz, or a .hdr/.img pair),
+    Analyze or MGH (.mgz, .mgh) image from its header alone, without reading or
+    decompressing the image data. Headers written on big-endian machines are
+    read in their byte order.
+
+    Parameters
+    ----------
+    path : string
+        Full path to the image
+
+    Returns
+    -------
+    info : dict
+        Keys are format ('nifti1', 'nifti2', 'analyze' or 'mgh'), shape,
+        nframes, zooms, dtype, orientation (axis codes such as 'RAS'), affine
+        (16 numbers, row by row) and filesize (bytes on disk of path, compressed
+        for .gz and .mgz)
+    """
+    import nibabel as nb
+    from nibabel.freesurfer.mghformat import MGHHeader
+    hdrpath = header_path(path)
+    instrument.note_read(hdrpath)
+    with _open(hdrpath) as f:
+        block = f.read(HEADER_BYTES)
+    name = path.lower()
+    if name.endswith(('.mgz', '.mgh')):
+        hdr = MGHHeader(block[:MGHHeader._hdrdtype.itemsize], check=False)
+        fmt = 'mgh'
+    else:
+        sizeof_hdr = [int(np.frombuffer(block[:4], dtype=end + 'i4')[0]) for end in '<>']
+        #from_fileobj takes the byte order from sizeof_hdr
+        if 540 in sizeof_hdr:
+            hdr = nb.Nifti2Header.from_fileobj(io.BytesIO(block), check=False)
+            fmt = 'nifti2'
+        elif 348 in sizeof_hdr:
+            hdr = nb.Nifti1Header.from_fileobj(io.BytesIO(block), check=False)
+            fmt = 'nifti1' if hdr['magic'] in (b'n+1', b'ni1') else 'analyze'
+        else:
+            raise ValueError('%s is not a NIfTI or MGH image' %path)
+    shape = tuple(int(d) for d in hdr.get_data_shape())
+    affine = hdr.get_best_affine() if fmt != 'mgh' else hdr.get_affine()
+    return {'format': fmt,
+            'shape': 'x'.join(str(d) for d in shape[:3]),
+            'nframes': int(np.prod(shape[3:])) if len(shape) > 3 else 1,
+            'zooms': 'x'.join('%.4g' %z for z in hdr.get_zooms()[:3]),
+            'dtype': str(hdr.get_data_dtype()),
+            'orientation': ''.join(nb.aff2axcodes(affine)),
+            'affine': ' '.join('%.6g' %a for a in np.asarray(affine).ravel()),
+            'filesize': os.path.getsize(path)}
+
+
+# In[3]:
+
+@instrument.profiled
+def scan_headers(paths, jobs=1):
+    """Reads the headers of many images, using a thread pool
+
+    Parameters
+    ----------
+    paths : list
+        Full paths to the images
+    jobs : int
+        Number of headers to read at the same time. Default 1.
+
+    Returns
+    -------
+    inv : pandas DataFrame
+        One row per path with the columns of read_header and error, which holds
+        why the header could not be read, or None
+    """
+    paths = list(paths)
+    infos, failed = shards.shard_map(read_header, paths, jobs, processes=False)
+    inv = pd.DataFrame([info or {} for info in infos],
+                       columns=['format', 'shape', 'nframes', 'zooms', 'dtype', 'orientation',
+                                'affine', 'filesize'])
+    inv.insert(0, 'path', paths)
+    errors = dict(zip(failed['item'], failed['error']))
+    inv['error'] = [errors.get(p) for p in paths]
+    return inv
+
+
+def flag_geometry(inv, groupcol='group', cols=GEOMETRY_COLS):
+    """Flags scans whose geometry differs from the most common geometry of
+    their group, e.g. an FDG scan that was not warped to the template grid
+
+    Parameters
+    ----------
+    inv : pandas DataFrame
+        Inventory from scan_headers with a group column
+    groupcol : string
+        Column naming the group each scan is compared within. Default 'group'.
+    cols : list or dict
+        Columns compared, or a dict of the columns compared for each group.
+        Default GEOMETRY_COLS.
+
+    Returns
+    -------
+    inv : pandas DataFrame
+        inv with a mismatch column listing the columns that differ from the
+        group, and geometry_ok, which is False for mismatched or unreadable scans
+    """
+    inv = inv.copy()
+    inv['mismatch'] = ''
+    readable = inv['error'].isnull()
+    for group, rows in inv[readable].groupby(groupcol):
+        groupcols = cols.get(group, GEOMETRY_COLS) if isinstance(cols, dict) else cols
+        for col in groupcols:
+            common = rows[col].mode().iloc[0]
+            differs = rows.index[rows[col] != common]
+            inv.loc[differs, 'mismatch'] += col + ','
+    inv['mismatch'] = inv['mismatch'].str.rstrip(',')
+    inv['geometry_ok'] = readable & (inv['mismatch'] == '')
+    return inv
+
+
+# In[4]:
+
+@instrument.profiled
+def inventory_run(outdir, fdgdir=None, fsdir=None, filenm='pn*',
+                  fsfiles=('mri/aparc+aseg.mgz',), jobs=1, strict=False, dbpath=None,
+                  indexcache=None):
+    """Main function to take stock of the FDG and FreeSurfer images before they
+    are gathered. Only image headers are read.
+
+    Parameters
+    ----------
+    outdir : string
+        Full path to directory where the inventory will be saved
+    fdgdir : string
+        Full path of the FDG data directory searched by fdg_run. Default None.
+    fsdir : string
+        Full path to root directory of freesurfer processed data. Default None.
+    filenm : string
+        General name of warped FDG files. Default is 'pn*'.
+    fsfiles : list
+        Images to check in each freesurfer subject directory, relative to it.
+        Default ['mri/aparc+aseg.mgz'].
+    jobs : int
+        Number of headers to read at the same time. Default 1.
+    strict : boolean
+        If TRUE, raises ValueError when any scan is mismatched or unreadable, so
+        stages that depend on the inventory do not run. Default is FALSE.
+    dbpath : string
+        If given, the inventory is also written to this tablestore database.
+        Default None.
+    indexcache : string
+        Full path of the file the index of subject directories in fsdir is kept
+        in. Default None uses outdir/subjindex.pkl.
+
+    Returns
+    -------
+    inv : pandas DataFrame
+        One row per image with columns group ('fdg' or the freesurfer file),
+        codea, Tp, path, the header fields, error, mismatch and geometry_ok
+    """
+    parts = []
+    if fdgdir is not None:
+        paths = fdg.find_warped(fdgdir, filenm)
+        #a .hdr/.img pair is one image, listed by its .img
+        pairhdrs = set(header_path(p) for p in paths if header_path(p) != p)
+        paths = [p for p in paths if p not in pairhdrs]
+        names = [os.path.basename(p) for p in paths]
+        parts.append(pd.DataFrame({'group': 'fdg', 'codea': [cf.get_id(n) for n in names],
+                                   'Tp': pd.to_numeric([cf.get_tp(n) for n in names]),
+                                   'path': paths}))
+    if fsdir is not None:
+        if indexcache is None:
+            indexcache = '%ssubjindex.pkl' %outdir
+        index = subjindex.subject_index(fsdir, indexcache)
+        index = index[index['codea'].notnull()]
+        for relpath in fsfiles:
+            paths = ['%s%s/%s' %(fsdir, sub, relpath) for sub in index['sub']]
+            found = [os.path.isfile(p) for p in paths]
+            parts.append(pd.DataFrame({'group': relpath, 'codea': index['codea'].values[found],
+                                       'Tp': pd.to_numeric(index['Tp'].values[found]),
+                                       'path': np.array(paths, dtype=object)[found]}))
+    if not parts:
+        raise ValueError('give fdgdir, fsdir or both')
+    files = pd.concat(parts, ignore_index=True)
+
+    inv = scan_headers(files['path'], jobs)
+    inv = pd.concat([files[['group', 'codea', 'Tp']], inv], axis=1)
+    #scans warped to a template must also share its affine
+    inv = flag_geometry(inv, cols={'fdg': GEOMETRY_COLS + ['affine']})
+    inv = inv.sort_values(['group', 'codea', 'Tp']).reset_index(drop=True)
+
+    cf.save_xls_and_pkl(inv, 'inventory', outdir)
+    if dbpath is not None:
+        tablestore.write_table(inv, 'inventory', dbpath, keycols=['codea', 'group'])
+    bad = inv[~inv['geometry_ok']]
+    if len(bad):
+        print('%d of %d images are unreadable or do not match their group:' %(len(bad), len(inv)))
+        print(bad[['group', 'path', 'error', 'mismatch']].to_string(index=False))
+        if strict:
+            raise ValueError('%d images failed the inventory, see inventory in %s'
+                             %(len(bad), outdir))
+    return inv
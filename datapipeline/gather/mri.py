@@ -5,7 +5,12 @@
 
 import pandas as pd
 import sys, os
-from tools import common_funcs as cf
+import functools
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import subjindex
+from datapipeline.tools import shards
+from datapipeline.tools import journal
 import subprocess
 
 
@@ -40,6 +45,7 @@ def bacs_pet_mri_date(rootpath, sub, verbose=False):
             print('No recon-all.log file found in %s' %reconlog_path)
         return
     try:
+        instrument.note_read(reconlog_path)
         with open(reconlog_path) as f:
             lines = f.read().splitlines()
         iline = lines[3]
@@ -62,7 +68,9 @@ def bacs_pet_mri_date(rootpath, sub, verbose=False):
 
 # In[21]:
 
-def bacs_pet_mri_date_batch(rootpath):
+@instrument.profiled
+def bacs_pet_mri_date_batch(rootpath, jobs=1, indexcache=None, failures=None,
+                            journalpath=None):
     """Given a path, this function finds subject folders there and finds 
     the date of the freesurfer processed data.
 
@@ -70,31 +78,43 @@ def bacs_pet_mri_date_batch(rootpath):
     ----------
     rootpath : string
         Path where subject directories lie
+    jobs : int
+        Number of processes reading recon-all.log files. Default 1.
+    indexcache : string
+        Full path of the file subjindex.subject_index keeps its index in.
+        Default None.
+    failures : list
+        If given, the table of subjects that failed is appended to it. Default
+        None prints them.
+    journalpath : string
+        Full path of a checkpoint journal each date is saved to. Subjects
+        already in it are not read again. Default None.
 
     Returns
     -------
     datetbl : DataFrame
         Holds codea, MRI_Tp, and MRI_Scandate fields
     """
-    subs, _ = cf.lbls_infold(rootpath)
-    datetbl = pd.DataFrame(columns=['sub'], data=subs)
-    datetbl['MRI_Scandate'] = float('NaN')
-
-    for sub in subs:
-        dateout = bacs_pet_mri_date(rootpath, sub)
-        datetbl.loc[datetbl['sub']==sub,'MRI_Scandate'] = dateout
-
-    datetbl['codea'] = [cf.get_lbl_id(sub) for sub in datetbl['sub'].tolist()]
-    datetbl['MRI_Tp'] = [cf.get_tp(sub) for sub in datetbl['sub'].tolist()]
-
-    datetbl.drop('sub', axis=1, inplace=True)
-    datetbl = datetbl[datetbl['MRI_Tp'].notnull()]
+    index = subjindex.subject_index(rootpath, indexcache)
+    index = index[index['codea'].notnull() & index['cross']]
+    
+    #only read recon-all.log files the index found
+    haslog = index[index['has_reconlog']]['sub'].tolist()
+    found, failed = shards.shard_map(functools.partial(bacs_pet_mri_date, rootpath), haslog,
+                                     jobs, key=cf.get_id, journal=journalpath,
+                                     journaltag=repr(('dates', rootpath)))
+    shards.keep_failures(failed, failures, 'bacs_pet_mri_date')
+    dates = dict(zip(haslog, found))
+    datetbl = pd.DataFrame({'codea': index['codea'].values,
+                            'MRI_Tp': index['Tp'].astype(str).values})
+    datetbl['MRI_Scandate'] = pd.to_datetime([dates.get(sub) for sub in index['sub']])
     return datetbl
 
 
 # In[22]:
 
-def extractFSasegstats(directory, outfile):
+@instrument.profiled
+def extractFSasegstats(directory, outfile, indexcache=None):
     '''Generate a command-line command to extract freesurfer
     
     Parameters
@@ -104,6 +124,9 @@ def extractFSasegstats(directory, outfile):
         to be directory/sub/stats/aseg.stats
     outfile : string
         Full path to directory where summary file should be saved
+    indexcache : string
+        Full path of the file subjindex.subject_index keeps its index in.
+        Default None.
     
     Returns
     -------
@@ -114,16 +137,156 @@ def extractFSasegstats(directory, outfile):
     output : string
         Command line output
     '''
-    subs, _ = cf.lbls_infold(directory)
-    subs = [sub for sub in subs if 'long' not in sub]
+    index = subjindex.subject_index(directory, indexcache)
+    #subjects without aseg.stats would leave the table out of step with subs
+    index = index[index['codea'].notnull() & ~index['long'] & index['has_aseg_stats']]
+    subs = index['sub'].tolist()
     subpaths = ['%s%s/stats/aseg.stats' % (directory, sub) for sub in subs]
     sublist = ' '.join(subpaths)
     commandlinestr = 'asegstats2table --inputs %s --skip --tablefile %s' % (sublist, outfile)
     process = subprocess.Popen(commandlinestr.split(), stdout=subprocess.PIPE)
     output = process.communicate()[0]
+    instrument.note_written(outfile)
     return subs, commandlinestr, output
 
 
+# In[24]:
+
+#columns of the table in aseg.stats and ?h.aparc.stats files without a ColHeaders line
+ASEG_COLS = ['Index', 'SegId', 'NVoxels', 'Volume_mm3', 'StructName']
+APARC_COLS = ['StructName', 'NumVert', 'SurfArea', 'GrayVol', 'ThickAvg', 'ThickStd',
+              'MeanCurv', 'GausCurv', 'FoldInd', 'CurvInd']
+
+
+def read_statsfile(path, defaultcols):
+    """Reads a freesurfer .stats file
+    
+    Parameters
+    ----------
+    path : string
+        Full path to the .stats file
+    defaultcols : list
+        Names of the table columns, used if the file has no ColHeaders line
+    
+    Returns
+    -------
+    measures : dict
+        Values of the '# Measure' lines, keyed by their first field as in
+        asegstats2table, e.g. 'IntraCranialVol'
+    table : pandas DataFrame
+        The per-structure table
+    """
+    instrument.note_read(path)
+    measures = {}
+    cols = defaultcols
+    rows = []
+    with open(path) as f:
+        for line in f:
+            if line.startswith('# Measure'):
+                fields = [x.strip() for x in line[len('# Measure'):].split(',')]
+                measures[fields[0]] = float(fields[-2])
+            elif line.startswith('# ColHeaders'):
+                cols = line.split()[2:]
+            elif line.strip() and not line.startswith('#'):
+                rows.append(line.split()[:len(cols)])
+    table = pd.DataFrame(rows, columns=cols)
+    return measures, table
+
+
+def read_subject_stats(subpath, aparc=False):
+    """Volumes of all aseg structures and global measures of one freesurfer
+    subject directory and, optionally, cortical thickness of every aparc region
+    
+    Parameters
+    ----------
+    subpath : string
+        Full path to the subject directory, holding stats/aseg.stats
+    aparc : boolean
+        If TRUE, also read stats/lh.aparc.stats and stats/rh.aparc.stats into
+        columns named like aparcstats2table, e.g. lh_entorhinal_thickness.
+        Default is FALSE.
+    
+    Returns
+    -------
+    vols : dict
+        Keys are measure and structure names, values are volumes in mm^3 (or
+        mm for thickness)
+    """
+    measures, table = read_statsfile('%s/stats/aseg.stats' %subpath, ASEG_COLS)
+    vols = dict(measures)
+    vols.update(zip(table['StructName'], table['Volume_mm3'].astype(float)))
+    if aparc:
+        for hemi in ['lh', 'rh']:
+            aparcpath = '%s/stats/%s.aparc.stats' %(subpath, hemi)
+            if os.path.isfile(aparcpath):
+                _, table = read_statsfile(aparcpath, APARC_COLS)
+                vols.update(zip(['%s_%s_thickness' %(hemi, name) for name in table['StructName']],
+                                table['ThickAvg'].astype(float)))
+    return vols
+
+
+@instrument.profiled
+def extract_stream_stats(directory, stream='long', jobs=1, indexcache=None, aparc=False,
+                         failures=None, journalpath=None):
+    """Reads aseg (and optionally aparc) stats of every timepoint processed by
+    one freesurfer stream, reading subjects in parallel
+    
+    Parameters
+    ----------
+    directory : string
+        Full path to root directory of freesurfer processed data
+    stream : string
+        'cross' reads <sub>_v# directories. 'long' reads <sub>_v#.long.<base>
+        directories whose base template directory is also in directory.
+        Default 'long'.
+    jobs : int
+        Number of processes reading subjects. Default 1.
+    indexcache : string
+        Full path of the file subjindex.subject_index keeps its index in.
+        Default None.
+    aparc : boolean
+        If TRUE, also read cortical thickness. Default is FALSE.
+    failures : list
+        If given, the table of subjects that failed is appended to it. Failed
+        subjects are left out of aseg_stats. Default None prints them.
+    journalpath : string
+        Full path of a checkpoint journal each subject's stats are saved to.
+        Subjects already in it are not read again. Default None.
+    
+    Returns
+    -------
+    aseg_stats : pandas DataFrame
+        DataFrame where each row is a scan, with columns codea, MRI_Tp, MRI_Base
+        (the base template, for the long stream), sub and all volumes
+    """
+    if stream not in ('cross', 'long'):
+        raise ValueError("stream must be 'cross' or 'long', not %s" %stream)
+    allsubs = subjindex.subject_index(directory, indexcache)
+    index = allsubs[allsubs['codea'].notnull() & allsubs['Tp'].notnull()
+                    & allsubs['has_aseg_stats']]
+    if stream == 'long':
+        #pair each timepoint with its base template, which must be present
+        index = index[index['long'] & index['base'].isin(set(allsubs['sub']))]
+    else:
+        index = index[index['cross']]
+    
+    rows, failed = shards.shard_map(functools.partial(read_subject_stats, aparc=aparc),
+                                    [directory + sub for sub in index['sub']], jobs,
+                                    key=lambda path: cf.get_id(os.path.basename(path)),
+                                    journal=journalpath,
+                                    journaltag=repr(('stats', directory, aparc)))
+    shards.keep_failures(failed, failures, 'read_subject_stats')
+    ok = [row is not None for row in rows]
+    index = index[ok]
+    subs = index['sub'].tolist()
+    aseg_stats = pd.DataFrame([row for row in rows if row is not None], index=index.index)
+    aseg_stats.insert(0, 'sub', subs)
+    aseg_stats.insert(0, 'MRI_Base', index['base'].values)
+    aseg_stats.insert(0, 'MRI_Tp', index['Tp'].astype(str).values)
+    aseg_stats.insert(0, 'codea', index['codea'].values)
+    return aseg_stats.reset_index(drop=True)
+
+
 # In[23]:
 
 def icvcorr(tbl, rois, icvcol):
@@ -145,14 +308,15 @@ def icvcorr(tbl, rois, icvcol):
         Tbl now has additional columns specified by rois.values holding icv 
         corrected volumes
     """
-    for key, value in rois.iteritems():
+    for key, value in rois.items():
         tbl[value] = tbl[key] / tbl[icvcol]
     return tbl
 
 
 # In[29]:
 
-def mri_run(datadir, outdir, rois):
+@instrument.profiled
+def mri_run(datadir, outdir, rois, jobs=1, indexcache=None, stream='cross', resume=True):
     """Main function to collect MRI volume data
     
     Parameters
@@ -165,6 +329,21 @@ def mri_run(datadir, outdir, rois):
     rois : list of strings
         List of freesurfer rois of interest. These volumes of these rois will be 
         inserted in aseg_change along with their rates of change
+    jobs : int
+        Number of processes gathering subjects, see shards.shard_map. Subjects
+        that fail are left out and saved to mri_failures. Default 1.
+    indexcache : string
+        Full path of the file the index of subject directories in datadir is kept
+        in between runs. Default None uses outdir/subjindex.pkl.
+    stream : string
+        Freesurfer stream to gather. 'cross' runs asegstats2table over the
+        cross-sectional <sub>_v# directories. 'long' reads the longitudinal
+        <sub>_v#.long.<base> directories in parallel. Default 'cross'.
+    resume : boolean
+        Each subject's dates and long stream stats are saved to journals in
+        outdir as soon as they are read, and the journals are deleted once
+        aseg_change is saved. If TRUE, subjects in the journals of an earlier
+        run that died are not read again. Default is TRUE.
         
     Returns
     -------
@@ -176,18 +355,34 @@ def mri_run(datadir, outdir, rois):
         their rates of change, and icv correction
     """
 
+    if indexcache is None:
+        indexcache = '%ssubjindex.pkl' %outdir
+    failures = []
+    journals = ['%smri_stats.journal' %outdir, '%smri_dates.journal' %outdir]
+    if not resume:
+        for path in journals:
+            journal.remove(path)
+    
     #get aseg_stats data from freesurfer processed data
-    outfile = '%sFS_aseg_stats.txt' %outdir
-    subs, asegout, output = extractFSasegstats(datadir, outfile)
-    aseg_stats = pd.read_csv(outfile, header=0, delim_whitespace=True)
+    if stream == 'long':
+        aseg_stats = extract_stream_stats(datadir, 'long', jobs, indexcache, failures=failures,
+                                          journalpath=journals[0])
+        aseg_stats = aseg_stats.drop(['sub'], axis=1)
+    else:
+        outfile = '%sFS_aseg_stats.txt' %outdir
+        subs, asegout, output = extractFSasegstats(datadir, outfile, indexcache)
+        instrument.note_read(outfile)
+        aseg_stats = pd.read_csv(outfile, header=0, sep=r'\s+')
 
-    #add columns for SubjID and MRI_TP
-    aseg_stats['codea'] = [cf.get_id(sub) for sub in subs]
-    aseg_stats['MRI_Tp'] = [cf.get_tp(sub) for sub in subs]
-    aseg_stats.drop('Measure:volume', axis=1, inplace=True)
+        #add columns for SubjID and MRI_TP
+        aseg_stats['codea'] = [cf.get_id(sub) for sub in subs]
+        aseg_stats['MRI_Tp'] = [cf.get_tp(sub) for sub in subs]
+        aseg_stats.drop('Measure:volume', axis=1, inplace=True)
+    aseg_stats['MRI_Stream'] = stream
+    aseg_change = aseg_stats[['codea', 'MRI_Tp', 'MRI_Stream', 'IntraCranialVol'] + rois]
 
     #get dates of MRI scans that were processed with freesurfer
-    mridates = bacs_pet_mri_date_batch(datadir)
+    mridates = bacs_pet_mri_date_batch(datadir, jobs, indexcache, failures, journals[1])
 
     aseg_change = pd.merge(aseg_change, mridates, on=['codea','MRI_Tp'])
 
@@ -202,6 +397,9 @@ def mri_run(datadir, outdir, rois):
     
     cf.save_xls_and_pkl(aseg_stats, 'aseg_stats', outdir)
     cf.save_xls_and_pkl(aseg_change, 'aseg_change', outdir)
+    for path in journals:
+        journal.remove(path)
+    cf.report_failures(failures, 'mri', outdir)
     
     return aseg_stats, aseg_change
 
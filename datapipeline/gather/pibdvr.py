@@ -0,0 +1,314 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import glob
+import functools
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+from datapipeline.gather import cohortarray
+
+
+# In[2]:
+
+#freesurfer labels of cerebellar grey matter, the default reference region
+REF_LABELS = {'Left-Cerebellum-Cortex': 8, 'Right-Cerebellum-Cortex': 47}
+#voxels fitted at once, which bounds the memory used by logan_dvr
+CHUNK_VOXELS = 50000
+#freesurfer aparc+aseg labels of the cortical parcels (ctx-lh-* from 1000,
+#ctx-rh-* from 2000), averaged into PIB_Index unless indexrois is given
+CORTEX_LABELS = (1000, 3000)
+
+
+def frame_midtimes(frametimes):
+    """Mid-frame times from a list of (start, end) times of each frame
+    """
+    frametimes = np.asarray(frametimes, dtype=np.float64)
+    if frametimes.ndim != 2 or frametimes.shape[1] != 2:
+        raise ValueError('frametimes must hold a (start, end) pair for each frame')
+    return frametimes.mean(axis=1)
+
+
+def cumulative_integral(tacs, times):
+    """Integral of time activity curves from time 0 to each frame by the
+    trapezoid rule, taking activity to be 0 at time 0
+
+    Parameters
+    ----------
+    tacs : numpy array
+        Activity of each voxel (rows) in each frame (last axis)
+    times : numpy array
+        Mid-frame times
+
+    Returns
+    -------
+    integrals : numpy array
+        Same shape as tacs
+    """
+    tacs = np.asarray(tacs, dtype=np.float64)
+    dt = np.diff(np.concatenate([[0.], times]))
+    prev = np.concatenate([np.zeros(tacs.shape[:-1] + (1,)), tacs[..., :-1]], axis=-1)
+    return np.cumsum((tacs + prev) / 2. * dt, axis=-1)
+
+
+def logan_dvr(tacs, reftac, midtimes, tstar, k2ref=None):
+    """Distribution volume ratio of many time activity curves at once by Logan
+    graphical analysis with a reference region. The slope of
+    int(C)/C against (int(Cref) + Cref/k2ref)/C over the frames from tstar on
+    is fitted for every voxel together, from sums over frames.
+
+    Parameters
+    ----------
+    tacs : numpy array
+        Activity of each voxel (rows) in each frame (columns)
+    reftac : numpy array
+        Mean activity of the reference region in each frame
+    midtimes : numpy array
+        Mid-frame times, in the units of tstar and k2ref
+    tstar : float
+        Time after which the Logan plot is linear. Frames with mid-times from
+        tstar on are fitted.
+    k2ref : float
+        Reference region efflux rate constant. Default None leaves out the
+        Cref/k2ref term, as is usual for PIB.
+
+    Returns
+    -------
+    dvr : numpy array
+        DVR of each row of tacs, NaN where activity in a fitted frame is not
+        positive
+    """
+    tacs = np.atleast_2d(np.asarray(tacs, dtype=np.float64))
+    reftac = np.asarray(reftac, dtype=np.float64)
+    late = np.asarray(midtimes) >= tstar
+    n = late.sum()
+    if n < 2:
+        raise ValueError('fewer than 2 frames have mid-times after tstar=%s' %tstar)
+    ref = cumulative_integral(reftac, midtimes)[late]
+    if k2ref:
+        ref = ref + reftac[late] / k2ref
+    tgt = cumulative_integral(tacs, midtimes)[:, late]
+    conc = tacs[:, late]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = ref / conc
+        y = tgt / conc
+        sx, sy = x.sum(axis=1), y.sum(axis=1)
+        slope = (n * (x * y).sum(axis=1) - sx * sy) / (n * (x * x).sum(axis=1) - sx * sx)
+    slope[(conc <= 0).any(axis=1) | ~np.isfinite(slope)] = np.nan
+    return slope
+
+
+# In[3]:
+
+def _region_values(lut, labels):
+    """Names and label values of regions, from lut or every label present
+    """
+    if lut is not None:
+        return list(lut), [lut[n] for n in lut]
+    values = np.unique(labels[labels != 0])
+    return [str(v) for v in values], list(values)
+
+
+def _index_names(names, values, indexrois, refvalues):
+    """Names of the regions averaged into PIB_Index: indexrois, or else every
+    cortical parcel, leaving out the reference region either way
+    """
+    if indexrois is None:
+        lo, hi = CORTEX_LABELS
+        indexnames = [n for n, v in zip(names, values) if lo <= v < hi]
+        if not indexnames:
+            raise ValueError('no cortical labels (%d-%d) to average into PIB_Index, '
+                             'give indexrois' %CORTEX_LABELS)
+    else:
+        indexnames = [str(r) for r in indexrois]
+    byname = dict(zip(names, values))
+    return [n for n in indexnames if byname.get(n) not in refvalues]
+
+
+def subject_dvr(item, midtimes, tstar, lut=None, refregion=None, indexrois=None, k2ref=None,
+                chunksize=CHUNK_VOXELS, dvrdir=None):
+    """Voxelwise DVR of one dynamic PIB scan, and its mean in each region of a
+    label volume on the same grid. Voxels are fitted in slabs of about
+    chunksize voxels. An uncompressed scan is also read slab by slab, so it is
+    never held in memory at once. A compressed one is read once, as float32,
+    since every slab would otherwise decompress the whole file again.
+
+    Parameters
+    ----------
+    item : tuple
+        Full paths of the 4D frames and of the label volume, e.g. aparc+aseg
+    midtimes : numpy array
+        Mid-frame times
+    tstar : float
+        Start of the fitted part of the Logan plot
+    lut : dictionary
+        Regions and their label values. Default None uses every label.
+    refregion : list
+        Names of reference regions in lut. Default None uses cerebellar grey
+        matter, REF_LABELS.
+    indexrois : list
+        Regions whose mean DVRs are averaged into PIB_Index. Default None uses
+        every cortical parcel, CORTEX_LABELS. The reference region is always
+        left out.
+    k2ref : float
+        See logan_dvr. Default None.
+    chunksize : int
+        Number of voxels fitted at once. Default CHUNK_VOXELS.
+    dvrdir : string
+        If given, the DVR image is saved here as dvr_<frames file name>.
+        Default None.
+
+    Returns
+    -------
+    stats : dict
+        '<region>_DVR' for each region, PIB_Index and PIB_RefVoxels
+    """
+    import nibabel as nb
+    framespath, atlaspath = item
+    img = nb.load(framespath)
+    instrument.note_read(framespath)
+    frames = img.dataobj
+    if framespath.endswith('.gz'):
+        frames = np.asarray(frames, dtype=np.float32)
+    labels = cf.preproc_aparc(atlaspath).astype(np.int64)
+    if img.ndim != 4 or img.shape[:3] != labels.shape or img.shape[3] != len(midtimes):
+        raise ValueError('%s has shape %s, expected %s with %d frames'
+                         %(framespath, img.shape, labels.shape, len(midtimes)))
+    if refregion is None:
+        refvalues = list(REF_LABELS.values())
+    else:
+        refs = [refregion] if isinstance(refregion, str) else list(refregion)
+        refvalues = [lut[r] if lut is not None else int(r) for r in refs]
+    refmask = np.isin(labels, refvalues)
+    if not refmask.any():
+        raise ValueError('%s has no voxels in the reference region' %atlaspath)
+
+    #the reference region is read from the slab of slices holding it
+    zs = np.flatnonzero(refmask.any(axis=(0, 1)))
+    z0, z1 = zs[0], zs[-1] + 1
+    refslab = np.asarray(frames[:, :, z0:z1], dtype=np.float64)
+    reftac = refslab[refmask[:, :, z0:z1]].mean(axis=0)
+    del refslab
+
+    brain = labels > 0
+    dvr = np.full(labels.shape, np.nan, dtype=np.float32)
+    step = max(1, chunksize // (labels.shape[0] * labels.shape[1]))
+    for z0 in range(0, labels.shape[2], step):
+        z1 = min(z0 + step, labels.shape[2])
+        inslab = brain[:, :, z0:z1]
+        if not inslab.any():
+            continue
+        slab = np.asarray(frames[:, :, z0:z1], dtype=np.float64)
+        out = dvr[:, :, z0:z1]
+        out[inslab] = logan_dvr(slab[inslab], reftac, midtimes, tstar, k2ref)
+    if dvrdir is not None:
+        dvrpath = os.path.join(dvrdir, 'dvr_' + os.path.basename(framespath))
+        nb.save(nb.Nifti1Image(dvr, img.affine), dvrpath)
+        instrument.note_written(dvrpath)
+
+    names, values = _region_values(lut, labels)
+    finite = np.isfinite(dvr) & brain
+    lab, vals = labels[finite], dvr[finite].astype(np.float64)
+    #region number of each voxel, with -1 for labels outside the regions
+    order = np.argsort(values)
+    pos = np.searchsorted(np.asarray(values)[order], lab)
+    pos = np.minimum(pos, len(values) - 1)
+    ids = np.where(np.asarray(values)[order][pos] == lab, order[pos], -1)
+    keep = ids >= 0
+    nvox = np.bincount(ids[keep], minlength=len(names))
+    sums = np.bincount(ids[keep], weights=vals[keep], minlength=len(names))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / nvox
+    stats = dict(('%s_DVR' %name, mean) for name, mean in zip(names, means))
+    indexnames = _index_names(names, values, indexrois, refvalues)
+    stats['PIB_Index'] = np.nanmean([stats['%s_DVR' %name] for name in indexnames])
+    stats['PIB_RefVoxels'] = int(refmask.sum())
+    return stats
+
+
+# In[4]:
+
+@instrument.profiled
+def pibdvr_run(scans, outdir, frametimes, atlas=None, tstar=35., lut=None, refregion=None,
+               indexrois=None, k2ref=None, chunksize=CHUNK_VOXELS, jobs=1, dvrdir=None):
+    """Main function to quantify dynamic PIB scans by voxelwise Logan DVR with
+    a cerebellar grey reference region, giving regional DVRs and PIB_Index
+
+    Parameters
+    ----------
+    scans : list, pandas DataFrame or string
+        Full paths of 4D dynamic PIB scans, a glob pattern matching them, or a
+        DataFrame with a 'path' column and optionally 'codea', 'Tp' and
+        'atlas' (the label volume of each scan) columns, see
+        cohortarray.scan_index
+    outdir : string
+        Full path where the pibdvr table is saved
+    frametimes : list
+        (start, end) time of each frame, in minutes
+    atlas : string
+        Full path to a label volume on the grid of every scan, used when scans
+        has no atlas column. Default None.
+    tstar : float
+        Minutes after which the Logan plot is linear. Default 35.
+    lut : dictionary
+        Regions and their label values. Default None uses every label.
+    refregion : list
+        Names of reference regions in lut. Default None uses REF_LABELS.
+    indexrois : list
+        Regions averaged into PIB_Index, less the reference region. Default
+        None uses every cortical parcel of aparc+aseg, CORTEX_LABELS.
+    k2ref : float
+        Reference region efflux rate constant, per minute. Default None.
+    chunksize : int
+        Number of voxels fitted at once. Default CHUNK_VOXELS.
+    jobs : int
+        Number of scans processed at the same time, in processes. Scans that
+        fail are left out and saved to pibdvr_failures. Default 1.
+    dvrdir : string
+        If given, each scan's DVR image is saved here. Default None.
+
+    Returns
+    -------
+    dvrtbl : pandas DataFrame
+        One row per scan with columns codea, PIB_Tp, PIB_Index, PIB_RefVoxels
+        and '<region>_DVR' for each region
+    """
+    if isinstance(scans, str):
+        scans = sorted(glob.glob(scans))
+    if lut is not None and indexrois is not None:
+        missing = [r for r in indexrois if r not in lut]
+        if missing:
+            raise ValueError('indexrois not in lut: %s' %', '.join(map(str, missing)))
+    index = cohortarray.scan_index(scans)
+    if 'atlas' not in index.columns:
+        if atlas is None:
+            raise ValueError('give atlas, or an atlas column in scans')
+        index['atlas'] = atlas
+    if dvrdir is not None and not os.path.exists(dvrdir):
+        os.makedirs(dvrdir)
+
+    items = list(zip(index['path'], index['atlas']))
+    rows, failed = shards.shard_map(functools.partial(subject_dvr,
+                                                      midtimes=frame_midtimes(frametimes),
+                                                      tstar=tstar, lut=lut, refregion=refregion,
+                                                      indexrois=indexrois, k2ref=k2ref,
+                                                      chunksize=chunksize, dvrdir=dvrdir),
+                                    items, jobs,
+                                    key=lambda item: cf.get_id(os.path.basename(item[0])))
+    failures = []
+    shards.keep_failures(failed, failures, 'subject_dvr')
+    ok = np.array([row is not None for row in rows], dtype=bool)
+    dvrtbl = index.loc[ok, ['codea', 'Tp']].rename(columns={'Tp': 'PIB_Tp'})
+    dvrtbl = pd.concat([dvrtbl.reset_index(drop=True),
+                        pd.DataFrame([row for row in rows if row is not None])], axis=1)
+    first = ['codea', 'PIB_Tp', 'PIB_Index', 'PIB_RefVoxels']
+    dvrtbl = dvrtbl.reindex(columns=first + [c for c in dvrtbl.columns if c not in first])
+
+    cf.save_xls_and_pkl(dvrtbl, 'pibdvr', outdir)
+    cf.report_failures(failures, 'pibdvr', outdir)
+    return dvrtbl
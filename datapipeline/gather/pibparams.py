@@ -4,14 +4,17 @@
 # In[84]:
 
 import pandas as pd
+import numpy as np
 import glob
 import os, sys
-from tools import common_funcs as cf
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
 
 
 # In[87]:
 
-def pibparams_run(path_pib, pibrename, outdir, pibcutoff):
+@instrument.profiled
+def pibparams_run(path_pib, pibrename, outdir, pibcutoff, tbldict=None):
     """Reads data from the spreadsheet, does some calculations, and 
     returns a Pandas dataframe with PIB data.
     
@@ -26,6 +29,10 @@ def pibparams_run(path_pib, pibrename, outdir, pibcutoff):
         Full path where final dataframe will be saved
     pibcutoff : float
         PIB cutoff value
+    tbldict : dictionary
+        Tables from other stages. If it holds 'pibdvr' from pibdvr_run, its
+        PIB_Index and regional DVRs replace those in the spreadsheet for the
+        scans it has, see add_dvr. Default None.
     
     Returns
     -------
@@ -34,13 +41,16 @@ def pibparams_run(path_pib, pibrename, outdir, pibcutoff):
     """
 
     #read in pib data from old sheet
-    pib_old = pd.read_excel(path_pib, sheetname='i')
+    instrument.note_read(path_pib)
+    pib_old = pd.read_excel(path_pib, sheet_name='i')
     #read in PIB data from longitudinal timepoints
-    pib_long = pd.read_excel(path_pib, sheetname='j')
+    pib_long = pd.read_excel(path_pib, sheet_name='j')
     #concatenate PIB tables
     pib_df = pd.concat([pib_long, pib_old])
-    pib_df = pib_df[pibrename.keys()]
+    pib_df = pib_df[list(pibrename)]
     pib_df.rename(columns=pibrename, inplace=True)
+    if tbldict is not None and 'pibdvr' in tbldict:
+        pib_df = add_dvr(pib_df, tbldict['pibdvr'])
 
     #make binary PIB value
     pib_df['PIB_Pos'] = pib_df['PIB_Index'].apply(lambda x: 1 if x >= pibcutoff else 0)
@@ -50,25 +60,51 @@ def pibparams_run(path_pib, pibrename, outdir, pibcutoff):
                                'PIB_Index', 'PIB_sl')
 
     #make column for the age at which PIB positivity appears
-    pib_df.sort(columns=['codea','PIB_Tp'], inplace=True)
+    pib_df = pib_df.sort_values(['codea', 'PIB_Tp'])
 
-    #calculate age of PIB positivity
-    pib_df['PIB_agepos'] = float('nan')
-    pib_df = pib_df.groupby(by='codea')
-    pib_df = pib_df.apply(f)
+    #calculate age of PIB positivity: the youngest age at a positive scan
+    posage = pib_df['PIB_Age'].where(pib_df['PIB_Pos'] == 1)
+    pib_df['PIB_agepos'] = posage.groupby(pib_df['codea']).transform('min')
     
     cf.save_xls_and_pkl(pib_df, 'pibparams', outdir)
     
     return pib_df
 
 
-# In[86]:
+# In[85]:
 
-#calculate age of PIB positivity
-def f(group):
-    pos = group[group['PIB_Pos'] == 1]
-    if len(pos) > 0:
-        agepos = min(pos['PIB_Age'])
-        group.ix[:,'PIB_agepos'] = agepos
-    return group
+def add_dvr(pib_df, dvrtbl):
+    """Puts PIB_Index and regional DVRs computed from dynamic scans into the
+    PIB table, matching scans by codea and PIB_Tp. Computed values replace
+    those from the spreadsheet, and computed scans missing from it are added.
+    
+    Parameters
+    ----------
+    pib_df : pandas DataFrame
+        PIB table with codea and PIB_Tp columns
+    dvrtbl : pandas DataFrame
+        Output of pibdvr.pibdvr_run. Every scan with a PIB_Index must have a
+        codea and PIB_Tp, and no two the same, or ValueError is raised.
+    
+    Returns
+    -------
+    pib_df : pandas DataFrame
+        pib_df with the DVR columns and PIB_IndexSource, which is 'dvr' for
+        scans whose PIB_Index was computed and 'sheet' for the others
+    """
+    keys = ['codea', 'PIB_Tp']
+    dvr = dvrtbl.dropna(subset=['PIB_Index'])
+    if dvr[keys].isnull().any().any():
+        raise ValueError('pibdvr has scans without codea or PIB_Tp')
+    if dvr.duplicated(subset=keys).any():
+        dups = dvr.loc[dvr.duplicated(subset=keys, keep=False), keys]
+        raise ValueError('pibdvr has more than one scan for: %s'
+                         %', '.join('%s %s' %tuple(k) for k in dups.drop_duplicates().values))
+    #timepoints read from file names can be floats where the sheet has ints
+    dvr = dvr.astype({'PIB_Tp': pib_df['PIB_Tp'].dtype}).set_index(keys)
+    merged = dvr.combine_first(pib_df.set_index(keys)).reset_index()
+    merged['PIB_IndexSource'] = np.where(merged.set_index(keys).index.isin(dvr.index),
+                                         'dvr', 'sheet')
+    cols = list(pib_df.columns) + [c for c in merged.columns if c not in pib_df.columns]
+    return merged[cols]
 
@@ -0,0 +1,243 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import functools
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+from datapipeline.tools import labelindex
+from datapipeline.gather import cohortarray
+
+
+# In[2]:
+
+#gaussian kernels are cut off this many standard deviations from the center
+TRUNCATE = 4.0
+
+
+def psf_sigma(fwhm, zooms):
+    """Standard deviation, in voxels along each axis, of a gaussian point
+    spread function with the given full width at half maximum in mm
+
+    Parameters
+    ----------
+    fwhm : float or list
+        FWHM in mm, one value or one per axis
+    zooms : list
+        Voxel size in mm along each axis
+    """
+    fwhm = np.broadcast_to(np.asarray(fwhm, dtype=np.float64), (len(zooms),))
+    return fwhm / (2. * np.sqrt(2. * np.log(2.))) / np.asarray(zooms, dtype=np.float64)
+
+
+def region_volume(index, values):
+    """Volume of region numbers decoded from a label index: voxels of
+    values[n] hold n, and voxels in no region hold -1
+    """
+    shape = tuple(int(d) for d in index['shape'])
+    regions = np.full(int(np.prod(shape)), -1, dtype=np.int32)
+    for n, value in enumerate(values):
+        regions[labelindex.label_voxels(index, [value])] = n
+    return regions.reshape(shape)
+
+
+def transfer_matrix(index, regions, values, sigma):
+    """Geometric transfer matrix of the regions: entry (i, j) is the mean over
+    region i of region j's mask smoothed by the point spread function.
+
+    Each mask is smoothed with separable 1D gaussians only within its bounding
+    box, padded by the kernel's reach, so the cost follows the size of the
+    region rather than the volume. Only regions reached by the padded box are
+    summed, which leaves the matrix mostly zeros for a sharp PSF.
+
+    Parameters
+    ----------
+    index : dict
+        Label index of the subject, from labelindex.label_index
+    regions : numpy array
+        Output of region_volume
+    values : list
+        Label value of each region
+    sigma : numpy array
+        PSF standard deviation in voxels along each axis, from psf_sigma
+
+    Returns
+    -------
+    gtm : numpy array
+        nreg x nreg matrix. Rows of empty regions are zero.
+    nvox : numpy array
+        Voxels in each region
+    """
+    from scipy import ndimage
+    shape = regions.shape
+    reach = [int(TRUNCATE * s + 0.5) for s in sigma]
+    inregion = regions >= 0
+    nreg = len(values)
+    nvox = np.bincount(regions[inregion], minlength=nreg)
+    gtm = np.zeros((nreg, nreg))
+    for j in range(nreg):
+        if nvox[j] == 0:
+            continue
+        box = labelindex.label_bbox(index, [values[j]])
+        box = tuple(slice(max(0, b.start - r), min(n, b.stop + r))
+                    for b, r, n in zip(box, reach, shape))
+        mask = (regions[box] == j).astype(np.float64)
+        for axis, s in enumerate(sigma):
+            if s > 0:
+                mask = ndimage.gaussian_filter1d(mask, s, axis=axis, mode='constant',
+                                                 truncate=TRUNCATE)
+        inbox = regions[box]
+        keep = inbox >= 0
+        gtm[:, j] = np.bincount(inbox[keep], weights=mask[keep], minlength=nreg)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gtm = np.where(nvox[:, None] > 0, gtm / nvox[:, None], 0.)
+    return gtm, nvox
+
+
+# In[3]:
+
+def subject_gtm(item, fwhm, lut=None, labelcache=None, refregion=None, indexrois=None):
+    """Partial volume corrected region means of one PET image by the geometric
+    transfer matrix method. The observed mean of every region is taken as the
+    mix of true region means given by transfer_matrix, and the system is
+    solved for the true means.
+
+    Parameters
+    ----------
+    item : tuple
+        Full paths of the PET image and of its label volume, e.g. aparc+aseg,
+        on the same grid
+    fwhm : float or list
+        FWHM of the scanner PSF in mm, one value or one per axis
+    lut : dictionary
+        Regions and their label values. Default None uses every label. Labels
+        left out are neither corrected nor modeled as a source of spill-over.
+    labelcache : string
+        Directory of label index sidecar files, see labelindex.label_index.
+        Default None keeps each next to its label volume.
+    refregion : string or list
+        Region(s) whose pooled corrected mean every corrected mean is divided
+        by, e.g. 'Pons' for FDG. Default None.
+    indexrois : list
+        Regions whose means are averaged into Index_obs and Index_pvc, e.g.
+        the cortical regions of the PIB index. Default None.
+
+    Returns
+    -------
+    stats : dict
+        '<region>_obs' (uncorrected mean), '<region>_pvc' (corrected mean) and,
+        with refregion, '<region>_pvcsuvr' for each region, and the index
+        values with indexrois
+    """
+    import nibabel as nb
+    petpath, aparcpath = item
+    index = labelindex.label_index(aparcpath, labelcache)
+    shape = tuple(int(d) for d in index['shape'])
+    img = nb.load(petpath)
+    instrument.note_read(petpath)
+    pet = np.asarray(img.dataobj, dtype=np.float64).squeeze()
+    if pet.shape != shape:
+        raise ValueError('%s has shape %s, labels have shape %s' %(petpath, pet.shape, shape))
+    if lut is None:
+        names = [str(v) for v in index['labels']]
+        values = list(index['labels'])
+    else:
+        names, values = list(lut), [lut[n] for n in lut]
+    nreg = len(names)
+
+    regions = region_volume(index, values)
+    sigma = psf_sigma(fwhm, img.header.get_zooms()[:3])
+    gtm, nvox = transfer_matrix(index, regions, values, sigma)
+
+    finite = (regions >= 0) & np.isfinite(pet)
+    sums = np.bincount(regions[finite], weights=pet[finite], minlength=nreg)
+    counts = np.bincount(regions[finite], minlength=nreg)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = sums / counts
+    present = (nvox > 0) & np.isfinite(observed)
+    corrected = np.full(nreg, np.nan)
+    corrected[present] = np.linalg.lstsq(gtm[np.ix_(present, present)],
+                                         observed[present], rcond=None)[0]
+
+    stats = {}
+    for name, obs, pvc in zip(names, observed, corrected):
+        stats['%s_obs' %name] = obs
+        stats['%s_pvc' %name] = pvc
+    if refregion is not None:
+        refs = [refregion] if isinstance(refregion, str) else list(refregion)
+        refidx = [names.index(str(r)) for r in refs]
+        refmean = (corrected[refidx] * nvox[refidx]).sum() / nvox[refidx].sum()
+        for name, pvc in zip(names, corrected):
+            stats['%s_pvcsuvr' %name] = pvc / refmean
+    if indexrois is not None:
+        idx = [names.index(str(r)) for r in indexrois]
+        stats['Index_obs'] = np.nanmean(observed[idx])
+        stats['Index_pvc'] = np.nanmean(corrected[idx])
+    return stats
+
+
+# In[4]:
+
+@instrument.profiled
+def pvc_run(scans, outdir, fwhm, name='fdg', lut=None, labelcache=None, refregion=None,
+            indexrois=None, jobs=1):
+    """Main function to correct regional PET means for partial volume effects
+    with a geometric transfer matrix built from each subject's aparc+aseg
+
+    Parameters
+    ----------
+    scans : list or pandas DataFrame
+        DataFrame with a 'path' column holding PET images and an 'aparc'
+        column holding the label volume on the grid of each, and optionally
+        'codea' and 'Tp' columns, see cohortarray.scan_index. A list of
+        (PET path, label volume path) pairs can be given instead.
+    outdir : string
+        Full path where the table is saved
+    fwhm : float or list
+        FWHM of the scanner PSF in mm, one value or one per axis
+    name : string
+        Modality, e.g. 'fdg' or 'pib'. The table is saved as <name>_pvc and
+        the timepoint column is named <NAME>_Tp. Default 'fdg'.
+    lut : dictionary
+        Regions and their label values. Default None uses every label.
+    labelcache : string
+        Directory of label index sidecar files, so each aparc+aseg is only
+        read once over all runs. Default None keeps each next to its file.
+    refregion : string or list
+        Reference region(s) for '<region>_pvcsuvr' columns. Default None.
+    indexrois : list
+        Regions averaged into Index_obs and Index_pvc. Default None.
+    jobs : int
+        Number of scans corrected at the same time, in processes. Scans that
+        fail are left out and saved to <name>_pvc_failures. Default 1.
+
+    Returns
+    -------
+    pvctbl : pandas DataFrame
+        One row per scan with codea, <NAME>_Tp and the columns of subject_gtm
+    """
+    if not isinstance(scans, pd.DataFrame):
+        scans = pd.DataFrame(list(scans), columns=['path', 'aparc'])
+    index = cohortarray.scan_index(scans)
+    items = list(zip(index['path'], index['aparc']))
+    rows, failed = shards.shard_map(functools.partial(subject_gtm, fwhm=fwhm, lut=lut,
+                                                      labelcache=labelcache,
+                                                      refregion=refregion,
+                                                      indexrois=indexrois),
+                                    items, jobs,
+                                    key=lambda item: cf.get_id(os.path.basename(item[0])))
+    failures = []
+    shards.keep_failures(failed, failures, 'subject_gtm')
+    ok = np.array([row is not None for row in rows], dtype=bool)
+    pvctbl = index.loc[ok, ['codea', 'Tp']].rename(columns={'Tp': '%s_Tp' %name.upper()})
+    pvctbl = pd.concat([pvctbl.reset_index(drop=True),
+                        pd.DataFrame([row for row in rows if row is not None])], axis=1)
+
+    cf.save_xls_and_pkl(pvctbl, '%s_pvc' %name, outdir)
+    cf.report_failures(failures, '%s_pvc' %name, outdir)
+    return pvctbl
@@ -4,13 +4,17 @@
 # In[1]:
 
 import pandas as pd
+import numpy as np
 import glob
 import os, sys
-from tools import common_funcs as cf
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import instrument
+from datapipeline.tools import tablestore
 
 
 # In[367]:
 
+@instrument.profiled
 def mergelots(bigdict, tblstojoin, joincol, how='outer'):
     """Merges multiple tables that are in a common dictionary. Does an outer join by
     default on the designated columns.
@@ -56,12 +60,11 @@ def count_instances(tbl, col2count, colcounted):
     -------
     tbl : pandas DataFrame
         DataFrame the same as input tbl containing an extra column named colcounted
-        that holds the counts of values in the col2count column
+        that holds the counts of values in the col2count column. Rows missing
+        col2count are dropped.
     """
-    counted_ser = tbl[col2count].value_counts()
-    counted_df = pd.DataFrame(counted_ser, columns=[colcounted]).reset_index()
-    counted_df.rename(columns={'index':col2count},inplace=True)
-    tbl = tbl.merge(counted_df,on=col2count)
+    tbl = tbl[tbl[col2count].notnull()]
+    tbl = cf.aggregate_per_sub(tbl, col2count, {colcounted: (col2count, 'count')})
     return tbl
 
 
@@ -127,9 +130,66 @@ def addcodes(tbl, codetbl, sicol='codea', bacol='codeb'):
         return tbl
 
 
+# In[362]:
+
+#imaging tables matched to cognitive sessions by nearest_visit, and their date columns
+VISIT_SCANS = [('pibparams', 'PIB_Scandate'), ('aseg_change', 'MRI_Scandate'),
+               ('fdg_metaroi', 'FDG_Scandate')]
+
+
+def nearest_visit(tbl, scantbl, datecol, scandatecol, tolerance, by='codea', gapcol=None):
+    """Joins each row of tbl to the subject's scan closest in time, if one lies
+    within tolerance days. A visit halfway between two scans is joined to the
+    earlier one. Done as one sorted as-of merge over all subjects.
+    
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame where each row is a visit, such as cognitive sessions
+    scantbl : pandas DataFrame
+        DataFrame where each row is a scan, such as pibparams
+    datecol : string
+        Name of column in tbl holding the visit date, e.g. 'NP_Date'
+    scandatecol : string
+        Name of column in scantbl holding the scan date, e.g. 'PIB_Scandate'
+    tolerance : int
+        Largest number of days between a visit and its matched scan
+    by : string
+        Name of the subject column in both tables. Default 'codea'.
+    gapcol : string
+        Name of column to add holding scan date minus visit date in days.
+        Default replaces '_Scandate' in scandatecol with '_GapDays'.
+    
+    Returns
+    -------
+    tbl : pandas DataFrame
+        tbl in its original row order with the columns of the matched scan and
+        gapcol added. Visits with no scan within tolerance have NaN there.
+    """
+    if gapcol is None:
+        gapcol = scandatecol.replace('_Scandate', '') + '_GapDays'
+    left = tbl.reset_index(drop=True)
+    left['_row'] = np.arange(len(left))
+    left['_key'] = pd.to_datetime(left[datecol], errors='coerce')
+    right = scantbl[[c for c in scantbl.columns if c == by or c not in left.columns]].copy()
+    right['_scankey'] = pd.to_datetime(right[scandatecol], errors='coerce')
+    right = right[right['_scankey'].notnull() & right[by].notnull()]
+    
+    #merge_asof needs both keys sorted and no missing values
+    haskey = left['_key'].notnull() & left[by].notnull()
+    matched = pd.merge_asof(left[haskey].sort_values('_key'), right.sort_values('_scankey'),
+                            left_on='_key', right_on='_scankey', by=by,
+                            direction='nearest', tolerance=pd.Timedelta(days=tolerance))
+    matched[gapcol] = (matched['_scankey'] - matched['_key']).dt.days
+    tbl = pd.concat([matched, left[~haskey]]).sort_values('_row')
+    tbl = tbl.drop(['_row', '_key', '_scankey'], axis=1).reset_index(drop=True)
+    return tbl
+
+
 # In[4]:
 
 #put all subject data into a dictionary of tables
+@instrument.profiled
 def collect2dict(filenames, outdir):
     """Compiles multiple pickle files from the same directory into a dictionary of
     DataFrames
@@ -151,6 +211,7 @@ def collect2dict(filenames, outdir):
     for fn in filenames:
         try:
             path = max(glob.glob(outdir+fn+'*.pkl'), key=os.path.getctime)
+            instrument.note_read(path)
             out = pd.read_pickle(path)
             tbldict[fn] = out
         except ValueError:
@@ -162,6 +223,7 @@ def collect2dict(filenames, outdir):
 
 #merge two tables with cognitive data into a single table
 #and delete original tables
+@instrument.profiled
 def cogtest_manipulation(tbldict, roc_cols):
     """Process table containing cognitive testing data
     
@@ -188,15 +250,19 @@ def cogtest_manipulation(tbldict, roc_cols):
         tbldict['cogtests'] = cf.rate_of_change(tbldict['cogtests'], 'codeb', 'NP_Tp', 
                                 'NP_Date', col, '%s_sl' %col)
     
-    #add column for maximum follow-up time per subject
-    tbldict['cogtests'] = cf.max_per_sub(tbldict['cogtests'], 'codeb', 'NP_YrsRelBL', 'NP_Followup_Time')
+    #add columns for maximum follow-up time and number of tps per subject
+    tbldict['cogtests'] = cf.aggregate_per_sub(tbldict['cogtests'], 'codeb',
+                                {'NP_Followup_Time': ('NP_YrsRelBL', 'max'),
+                                 'NP_NoTps': ('codeb', 'count')})
     
     return tbldict
 
 
 # In[364]:
 
-def datamerge_run(filenames, outdir, roc_cols):
+@instrument.profiled
+def datamerge_run(filenames, outdir, roc_cols, tbldict=None, visit_tolerance=None, dbpath=None,
+                  report=True):
     """Main function to merge all data
     
     Parameters
@@ -208,6 +274,21 @@ def datamerge_run(filenames, outdir, roc_cols):
     roc_cols : list
         List of strings corresponding to column names for which rate of change should be 
         calculated
+    tbldict : dict
+        Dictionary of DataFrames already in memory, where keys are the names in 
+        filenames. If given, these are merged instead of reading pickles from outdir,
+        and only the names in filenames missing from tbldict are read. Default None.
+    visit_tolerance : int
+        If given, also makes NPvisittbl, where each cognitive session is joined
+        to the PIB, MRI and FDG scans nearest in time within this many days. It
+        is saved and added to tbldict. Default None.
+    dbpath : string
+        If given, full path of a SQLite database that every table in tbldict,
+        NPtbl and subjtbl are also written to, so they can be read back in parts
+        with tablestore.query. Default None.
+    report : boolean
+        If True and instrument is enabled, print the time, memory, rows and files
+        of every stage recorded so far. Default True.
     
     Returns
     -------
@@ -219,16 +300,21 @@ def datamerge_run(filenames, outdir, roc_cols):
         DataFrame where each row is a single subject
     """
     
-    tbldict = collect2dict(filenames, outdir)
+    if tbldict is None:
+        tbldict = collect2dict(filenames, outdir)
+    else:
+        #copy so tables held by the caller are not changed
+        tbldict = dict((key, tbl.copy()) for key, tbl in tbldict.items())
+        tbldict.update(collect2dict([fn for fn in filenames if fn not in tbldict], outdir))
     tbldict = cogtest_manipulation(tbldict, roc_cols)
     
     #count number of tps
-    tbldict['cogtests'] = count_instances(tbldict['cogtests'], 'codeb', 'NP_NoTps')
     tbldict['aseg_change'] = count_instances(tbldict['aseg_change'], 'codea', 'MRI_NoTps')
     tbldict['pibparams'] = count_instances(tbldict['pibparams'], 'codea', 'PIB_NoTps')
+    tbldict['fdg_metaroi'] = count_instances(tbldict['fdg_metaroi'], 'codea', 'FDG_NoTps')
     
     new_tbldict = {}
-    for key, tbl in tbldict.iteritems():
+    for key, tbl in tbldict.items():
         tpcol = [s for s in tbl.columns if ('_Tp' in s)]
         if tpcol:
             tpcol = tpcol[0]
@@ -237,7 +323,7 @@ def datamerge_run(filenames, outdir, roc_cols):
     tbldict.update(new_tbldict)
     
     #make sure each table contains SubjID and BAC# fields
-    for key, tbl in tbldict.iteritems():
+    for key, tbl in tbldict.items():
         tbl = addcodes(tbl, tbldict['codetranslator'])
         tbldict[key] = tbl
     
@@ -254,5 +340,22 @@ def datamerge_run(filenames, outdir, roc_cols):
     cf.save_xls_and_pkl(subjtbl, 'subjtbl', outdir)
     cf.save_xls_and_pkl(NPtbl, 'NPtbl', outdir)
     
+    #match each cognitive session to its contemporaneous scans
+    if visit_tolerance is not None:
+        NPvisittbl = mergelots(tbldict, ['cogtests','subjinfo'], joincol)
+        for key, scandatecol in VISIT_SCANS:
+            if key in tbldict and scandatecol in tbldict[key].columns:
+                NPvisittbl = nearest_visit(NPvisittbl, tbldict[key], 'NP_Date', scandatecol,
+                                           visit_tolerance)
+        tbldict['NPvisittbl'] = NPvisittbl
+        cf.save_xls_and_pkl(NPvisittbl, 'NPvisittbl', outdir)
+    
+    if dbpath is not None:
+        tablestore.write_tables(tbldict, dbpath)
+        tablestore.write_tables({'NPtbl': NPtbl, 'subjtbl': subjtbl}, dbpath)
+    
+    if report and instrument.is_enabled():
+        print(instrument.summary().to_string(index=False))
+    
     return tbldict, NPtbl, subjtbl
 
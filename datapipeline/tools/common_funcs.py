@@ -2,11 +2,20 @@ import glob
 import os, sys
 import pandas as pd
 import re
-import nibabel as nb
 import numpy as np
 import time
+import warnings
+import functools
+from datapipeline.tools import instrument
+from datapipeline.tools import subjindex
+from datapipeline.tools import shards
+from datapipeline.tools import labelindex
 
+#pattern of subject ids in file and directory names
+ID_PATTERN = subjindex.ID_PATTERN
 
+
+@instrument.profiled
 def gzip_all(_path):
     """Recursively search path and gzip all .nii files. Return the number gzipped.
     """
@@ -21,6 +30,7 @@ def gzip_all(_path):
     return len(gunzipped)
 
 
+@instrument.profiled
 def gunzip_all(_path):
     """Recursively search path and gzip all .nii files. Return the number gzipped.
     """
@@ -35,6 +45,7 @@ def gunzip_all(_path):
     return len(gzipped)
 
 
+@instrument.profiled
 def mgz_to_nii(_path):
     """Recursively search path and convert all .mgz files to .nii.gz files.
     """
@@ -77,6 +88,7 @@ def pet_mri_date(rootpath, sub, verbose=False):
             print('No recon-all.log file found in %s' %reconlog_path)
         return
     try:
+        instrument.note_read(reconlog_path)
         with open(reconlog_path) as f:
             lines = f.read().splitlines()
         iline = lines[3]
@@ -97,7 +109,8 @@ def pet_mri_date(rootpath, sub, verbose=False):
         return
 
 
-def pet_mri_date_batch(rootpath):
+@instrument.profiled
+def pet_mri_date_batch(rootpath, jobs=1, failures=None):
     """Given a path, this function finds subject folders there and finds 
     the date of the freesurfer processed data.
 
@@ -105,19 +118,23 @@ def pet_mri_date_batch(rootpath):
     ----------
     rootpath : string
         Path where subject directories lie
+    jobs : int
+        Number of processes reading recon-all.log files. Default 1.
+    failures : list
+        If given, the table of subjects that failed is appended to it. Default
+        None prints them.
 
     Returns
     -------
     datetbl : DataFrame
         Holds SubjID, MRI_Tp, and MRI_Scandate fields
     """
-    subs, _ = _infold(rootpath)
+    subs, _ = IDs_infold(rootpath)
+    dates, found = shards.shard_map(functools.partial(pet_mri_date, rootpath), subs, jobs,
+                                    key=get_id)
+    shards.keep_failures(found, failures, 'pet_mri_date')
     datetbl = pd.DataFrame(columns=['sub'], data=subs)
-    datetbl['MRI_Scandate'] = float('NaN')
-
-    for sub in subs:
-        dateout = pet_mri_date(rootpath, sub)
-        datetbl.loc[datetbl['sub']==sub,'MRI_Scandate'] = dateout
+    datetbl['MRI_Scandate'] = pd.to_datetime(dates)
 
     datetbl['codea'] = [get_id(sub) for sub in datetbl['sub'].tolist()]
     datetbl['MRI_Tp'] = [get_tp(sub) for sub in datetbl['sub'].tolist()]
@@ -127,7 +144,21 @@ def pet_mri_date_batch(rootpath):
     return datetbl
 
 
-def extractFSvolumes(rootpath, subs, rois, FS_lut, file_aparc):
+def subject_volumes(aparcpath, rois, FS_lut):
+    """Number of voxels of each region in one aparc+aseg file, counted in a
+    single pass. Returns None if the file does not exist.
+    """
+    if not os.path.isfile(aparcpath):
+        return None
+    aparc_dat = preproc_aparc(aparcpath).astype(np.int64)
+    counts = np.bincount(aparc_dat[aparc_dat > 0].ravel())
+    return dict((roi, int(counts[FS_lut[roi]]) if FS_lut[roi] < len(counts) else 0)
+                for roi in rois)
+
+
+@instrument.profiled
+def extractFSvolumes(rootpath, subs, rois, FS_lut, file_aparc, jobs=1, failures=None,
+                     labelcache=None):
     """Extracts the volume of regions from freesurfer-processed MRI data.
     
     Parameters
@@ -138,11 +169,23 @@ def extractFSvolumes(rootpath, subs, rois, FS_lut, file_aparc):
     subs : list 
         list of directories in rootpath that contain data of interest
     rois : list 
-        list of freesurfer regions of interest
+        list of freesurfer regions of interest. With labelcache, a dict of
+        combined regions, e.g. {'Hippocampus': ['Left-Hippocampus',
+        'Right-Hippocampus']}, can be given instead.
     FS_lut : dictionary
         dictionary of freesurfer regions and their numerical values
     file_aparc : string 
         name of the file to extract volumes from
+    jobs : int
+        Number of processes reading aparc files. Default 1.
+    failures : list
+        If given, the table of subjects that failed is appended to it. Default
+        None prints them.
+    labelcache : string
+        Directory of label index sidecar files, see labelindex.label_index. If
+        given, each aparc file is read only once, to make its sidecar, and
+        later calls with other rois read the small sidecar instead. Default
+        None reads every aparc file.
     
     Returns
     -------
@@ -151,48 +194,49 @@ def extractFSvolumes(rootpath, subs, rois, FS_lut, file_aparc):
     """
     mrivols = pd.DataFrame(subs, columns = ['SubjCode'])
     mrivols['fullpath'] = ['%s%s/mri/' % (rootpath, sub) for sub in mrivols['SubjCode'].tolist()]
-    roitbl = pd.DataFrame(index=mrivols.index, columns=rois)
+    if labelcache is not None:
+        func = functools.partial(labelindex.subject_regions, regions=rois, FS_lut=FS_lut,
+                                 cachedir=labelcache)
+    else:
+        func = functools.partial(subject_volumes, rois=rois, FS_lut=FS_lut)
+    vols, found = shards.shard_map(func, [path + file_aparc for path in mrivols['fullpath']], jobs,
+                                   key=lambda path: get_id(path[len(rootpath):]))
+    shards.keep_failures(found, failures, 'extractFSvolumes')
+    roitbl = pd.DataFrame([v if v is not None else {} for v in vols], index=mrivols.index,
+                          columns=list(rois))
     mrivols = pd.concat([mrivols, roitbl], axis=1)
-    for row_index, row in mrivols.iterrows():
-        aparcpath = row['fullpath'] + file_aparc
-        if os.path.isfile(aparcpath):
-            aparc_dat = preproc_aparc(aparcpath)
-            for roi in rois:
-                row[roi] = get_label_vol(FS_lut, roi, aparc_dat)
     return mrivols
 
 
-def IDs_infold(path):
+def IDs_infold(path, cachepath=None):
     """Extracts list of directories containing ID strings and a list of those  
-    ID strings given a path.
+    ID strings given a path. Uses the shared subjindex.subject_index of path.
     """
-    dirs = os.listdir(path)
-    subs = []
-    subs_id = []
-    for sub in dirs:
-        _id = get_id(sub)
-        if not _id == None:
-            subs.append(sub)
-            subs_id.append(_id)
-    return subs, subs_id
+    index = subjindex.subject_index(path, cachepath)
+    index = index[index['codea'].notnull()]
+    return index['sub'].tolist(), index['codea'].tolist()
 
 
 def preproc_aparc(aparcpath):
     """Import and preprocess FS aparc+aseg.mgz file
     """
+    import nibabel as nb
     #import the data
+    instrument.note_read(aparcpath)
     aparc_img = nb.load(aparcpath)
-    aparc_dat = aparc_img.get_data()
+    aparc_dat = np.array(aparc_img.dataobj)
     #preprocess the data
     aparc_dat = aparc_dat.squeeze()
     aparc_dat[np.isnan(aparc_dat)] = 0
     return aparc_dat
 
 
+@instrument.profiled
 def FS_make_lut(path):
     """Reads an excel file holding Freesurfer label values
     and returns a dictionary with region as the key.
     """
+    instrument.note_read(path)
     fslut = pd.read_excel(path, parse_cols='A, B')
     fslut.columns = ['value', 'region']
     fslutdict = fslut.set_index('region')['value'].to_dict()
@@ -200,10 +244,10 @@ def FS_make_lut(path):
 
 
 def get_id(string):
-    """Find the -ID in a string and return it as a string.
-    If no -ID is found then return None.
+    """Find the -ID, B followed by all of its digits, in a string and return
+    it as a string. If no -ID is found then return None.
     """
-    idmatch = re.search('B\d', string)
+    idmatch = re.search(ID_PATTERN, string)
     if idmatch:
         _id = idmatch.group()
         return _id
@@ -219,6 +263,67 @@ def get_tp(string):
         return tp
 
 
+def subject_slopes(tbl, subcol, timecol, ycols, mintps=2):
+    """Per-subject ordinary least-squares intercepts and slopes of many outcomes
+    against time, the same fits as R's lmList(y ~ time | subject). All subjects
+    and outcomes are solved together from grouped sums. Rows missing an outcome
+    are left out of that outcome's fit only.
+    
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        Long table with one row per subject per timepoint
+    subcol : string
+        Name of column containing subject ID
+    timecol : string
+        Name of column containing time, e.g. years since baseline
+    ycols : list
+        Names of outcome columns
+    mintps : int
+        Fewest non-missing timepoints needed to fit a subject. Default 2.
+        
+    Returns
+    -------
+    slopetbl : pandas DataFrame
+        One row per subject, indexed by subject, with columns '<y>_int' and
+        '<y>_sl'. Both are NaN for subjects with too few timepoints or a single
+        distinct time.
+    """
+    t = tbl[timecol].astype(float).values[:, None]
+    y = tbl[ycols].astype(float).values
+    m = ~np.isnan(y) & ~np.isnan(t)
+    #centering keeps the sums below from cancelling for large values
+    with warnings.catch_warnings():
+        #outcomes with no values are left unfit below
+        warnings.simplefilter('ignore', RuntimeWarning)
+        tc = np.nanmean(t) if m.any() else 0.
+        yc = np.nan_to_num(np.nanmean(np.where(m, y, np.nan), axis=0))
+    t0 = np.where(m, t - tc, 0.)
+    y0 = np.where(m, y - yc, 0.)
+    k = len(ycols)
+    parts = np.hstack([m, t0, t0 * t0, y0, t0 * y0]).astype(float)
+    keep = tbl[subcol].notnull().values
+    grouped = pd.DataFrame(parts[keep]).groupby(tbl[subcol].values[keep]).sum()
+    sums = grouped.values
+    n, st, stt, sy, sty = [sums[:, i * k:(i + 1) * k] for i in range(5)]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = stt - st * st / n
+        slope = (sty - st * sy / n) / sxx
+        intercept = (sy - slope * st) / n + yc - slope * tc
+    bad = (n < max(mintps, 2)) | ~(np.abs(sxx) > 1e-12)
+    slope[bad] = np.nan
+    intercept[bad] = np.nan
+    
+    slopetbl = pd.DataFrame(index=grouped.index)
+    slopetbl.index.name = subcol
+    for i, ycol in enumerate(ycols):
+        slopetbl['%s_int' %ycol] = intercept[:, i]
+        slopetbl['%s_sl' %ycol] = slope[:, i]
+    return slopetbl
+
+
+@instrument.profiled
 def rate_of_change(tbl, subcol, tpcol, datecol, datacol, slopecol):
     """Takes a datatable holding longintudinal data and calculates rate of change
     in years for your variable of interest. The rate of change value will be 
@@ -243,38 +348,75 @@ def rate_of_change(tbl, subcol, tpcol, datecol, datacol, slopecol):
     Returns
     -------
     tbl: pandas DataFrame
-        Table with additional column with the name of slopecol containing the 
-        rate of change for data in datacol
+        Copy of tbl sorted by subject and timepoint, with an additional column
+        with the name of slopecol containing the rate of change for data in
+        datacol. Rows missing the date or data are left out of the fit, and
+        subjects with fewer than 2 of the rest get NaN.
     """
-    
-    from scipy import stats
-    import math
+    tbl = tbl.sort_values([subcol, tpcol], kind='mergesort')
+    dates = pd.to_datetime(tbl[datecol])
+    years = pd.DataFrame({subcol: tbl[subcol].values,
+                          '_years': (dates - dates.min()).dt.days.values / 365.25,
+                          datacol: tbl[datacol].values})
+    slopes = subject_slopes(years, subcol, '_years', [datacol])
+    tbl[slopecol] = tbl[subcol].map(slopes['%s_sl' %datacol])
+    return tbl
 
-    tbl.sort(columns=[subcol,tpcol], inplace=True)
-    
-    tbl[slopecol] = float('nan')
-    ids = list(set(tbl[subcol]))
+
+@instrument.profiled
+def aggregate_per_sub(tbl, subcol, aggs, ordercol=None):
+    """Broadcasts per-subject aggregates onto every row of a longitudinal table.
+    All aggregates are computed from a single groupby over subcol, and the row
+    order of tbl is preserved. tbl itself is not changed.
     
-    for sid in ids:
-        sid_ix = tbl[subcol] == sid
-        subset = tbl.loc[sid_ix]
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame where each row is a single subject's single observation
+    subcol : string
+        Name of column containing subject ID. Expects multiple rows per subject ID
+    aggs : dict
+        Keys are names of columns to be made, and values are (datacol, how) tuples
+        where datacol is the column to aggregate and how is one of 'count' (number
+        of non-missing values, as int), 'max', 'min', 'span' (max minus min),
+        'first' or 'baseline' (value of datacol on the subject's earliest row,
+        even if missing) or 'last' (value on the subject's latest row). Rows with
+        no subject get a count of 0 and missing values otherwise.
+    ordercol : string
+        Name of column defining the order of each subject's rows, e.g. timepoint or
+        date. Used by 'first', 'last' and 'baseline'. Default None uses row order.
         
-        if len(subset)<2:
-            continue
+    Returns
+    -------
+    tbl : pandas DataFrame
+        Copy of tbl with an additional column for each key in aggs
+    """
+    tbl = tbl.copy()
+    work = tbl.reset_index(drop=True)
+    if ordercol is not None:
+        work = work.sort_values([subcol, ordercol], kind='mergesort')
+    grouped = work.groupby(subcol, sort=False)
+    
+    for newcol, (datacol, how) in aggs.items():
+        if how == 'count':
+            vals = grouped[datacol].transform('count').fillna(0).astype(np.int64)
+        elif how == 'span':
+            vals = grouped[datacol].transform('max') - grouped[datacol].transform('min')
+        elif how in ('first', 'baseline', 'last'):
+            keep = 'last' if how == 'last' else 'first'
+            rows = work.drop_duplicates(subset=subcol, keep=keep).dropna(subset=[subcol])
+            vals = work[subcol].map(rows.set_index(subcol)[datacol])
+        elif how in ('max', 'min'):
+            vals = grouped[datacol].transform(how)
         else:
-            try:
-                datediff = ((subset[datecol]-subset[datecol].iloc[0]).astype('timedelta64[D]'))/365.25
-                slope, _, _, _, _ = stats.linregress(datediff,subset[datacol])
-                if math.isnan(slope) == True:
-                    continue
-                else:
-                    tbl.loc[sid_ix,slopecol] = slope
-            except:
-                continue
-            
+            raise ValueError('Unknown aggregate %s for column %s' %(how, newcol))
+        #put values back in the original row order
+        tbl[newcol] = vals.reindex(np.arange(len(work))).values
+        
     return tbl
 
 
+@instrument.profiled
 def max_per_sub(tbl, subcol, datacol, maxcol):
     """Takes a dataframe holding longitudinal data and extracts the maximum value
     for your variable of interest. This value will be added to all rows for each
@@ -298,27 +440,58 @@ def max_per_sub(tbl, subcol, datacol, maxcol):
         Table with additional column with the name of maxcol containing the max 
         value in datacol for each subject
     """
-    from scipy import stats
-    import math
-    
-    tbl.sort(columns=[subcol,datacol], inplace=True)
-    tbl[maxcol] = float('nan')
-    ids = list(set(tbl[subcol]))
+    return aggregate_per_sub(tbl, subcol, {maxcol: (datacol, 'max')})
+
+
+def parallel_map(func, items, jobs=1):
+    """Applies func to every item in items, using up to jobs threads. Intended for
+    per-subject work that mostly waits on files or command line tools.
     
-    for sid in ids:
-        sid_ix = tbl[subcol] == sid
-        subset = tbl.loc[sid_ix]
-        
-        maxval = max(subset[datacol])
-        
-        tbl.loc[sid_ix,maxcol] = maxval
+    Parameters
+    ----------
+    func : function
+        Function taking a single item
+    items : list
+        Items to apply func to
+    jobs : int
+        Number of threads to use. Default 1 runs serially.
         
-    return tbl
+    Returns
+    -------
+    results : list
+        Output of func for each item, in the same order as items
+    """
+    if jobs is None or jobs <= 1:
+        return [func(item) for item in items]
+    from concurrent import futures
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(instrument.bind(func), items))
 
 
+def report_failures(failures, name, outdir):
+    """Prints and saves the items that failed in the stages of a *_run function,
+    as failures tables from shards.shard_map, to name_failures in outdir
+    
+    Returns
+    -------
+    failures : pandas DataFrame
+        All failures in one table, empty if nothing failed
+    """
+    failures = [f for f in failures if len(f)]
+    if not failures:
+        return pd.DataFrame(columns=['stage'] + shards.FAILURE_COLS)
+    failures = pd.concat(failures, ignore_index=True)
+    print('%d item(s) failed in %s, see %s_failures:' %(len(failures), name, name))
+    print(failures[['stage', 'item', 'error']].to_string(index=False))
+    save_xls_and_pkl(failures, '%s_failures' %name, outdir)
+    return failures
+
+
+@instrument.profiled
 def save_xls_and_pkl(tbl, filename, path, overwriteold=False):
     """Saves a pandas dataframe as both an excel file and a pickle file.
-    Appends the date and time to the end of the filename.
+    Appends the date and time to the end of the filename. The excel file is
+    .xls, or .xlsx with pandas versions that can no longer write .xls.
     
     Parameters
     ----------
@@ -335,21 +508,32 @@ def save_xls_and_pkl(tbl, filename, path, overwriteold=False):
     import glob
 
     if overwriteold==True:
-        oldxls = glob.glob(path+filename+'*.xls')
+        oldxls = glob.glob(path+filename+'*.xls') + glob.glob(path+filename+'*.xlsx')
         oldpkl = glob.glob(path+filename+'*.pkl')
         _ = [os.remove(path) for path in oldxls]
         _ = [os.remove(path) for path in oldpkl]
 
     timestr = time.strftime("%Y%m%d-%H%M%S")
-    tbl.to_excel('%s%s_%s.xls' %(path, filename, timestr), index=False)
-    tbl.to_pickle('%s/%s_%s.pkl' %(path, filename, timestr))
+    xlspath = '%s%s_%s.xls' %(path, filename, timestr)
+    pklpath = '%s/%s_%s.pkl' %(path, filename, timestr)
+    try:
+        tbl.to_excel(xlspath, index=False)
+    except ValueError:
+        #pandas 2 dropped the .xls writer
+        xlspath += 'x'
+        tbl.to_excel(xlspath, index=False)
+    instrument.note_written(xlspath)
+    tbl.to_pickle(pklpath)
+    instrument.note_written(pklpath)
 
 
-def linregressTEK(tbl,x,y):
+@instrument.profiled
+def linregressTEK(tbl, x, y, covars=None):
     """Performs linear regression on multiple columns within a DataFrame as the y value 
     and returns a table summarizing the results, where columns are the output of 
     stats.linregress and the rows are the columns regressed. The x value of the regression 
-    is the same for all regressions. 
+    is the same for all regressions. All columns in y are solved together as one 
+    least-squares problem with a shared design matrix.
     
     Parameters
     ----------
@@ -360,21 +544,73 @@ def linregressTEK(tbl,x,y):
     y : list
         List of strings which are each the name of a column in tbl to be used as the y
         value for linear regression
+    covars : list
+        List of names of numeric columns to adjust for, e.g. age, sex, ICV or PIB
+        status. Default None regresses on x alone, which gives the same values as
+        stats.linregress.
         
     Returns
     -------
     lrtbl : pandas DataFrame
-        DataFrame where columns are the 5-value output of stats.linregress and rows correspond
-        to each regression designated by y
+        DataFrame where rows correspond to each regression designated by y and
+        columns are the slope, intercept, r value, p value and standard error of x
+        as from stats.linregress, the model R squared and number of observations,
+        and the coefficient and p value of each covariate. Each regression uses the
+        rows where x, the covariates and that y column are all present. With
+        covariates, the r value is the partial correlation of x and y. The r
+        value, p values, standard errors and R squared are NaN for a y column
+        that is constant or fit exactly.
     """
-
     from scipy import stats
 
-    lrdict = {}
-    for yval in y:
-        slope, intercept, r_value, p_value, std_err = stats.linregress(tbl[x],tbl[yval])
-        lrdict[yval] = [slope, intercept, r_value, p_value, std_err]
-    lrtbl = pd.DataFrame(lrdict).T
-    lrout = ['XSslope', 'XSintercept', 'XSr_value', 'XSp_value', 'XSstd_err']
-    lrtbl.columns = lrout
-    return lrtbl
\ No newline at end of file
+    covars = list(covars) if covars else []
+    D = tbl[[x] + covars].astype(float).values
+    Y = tbl[y].astype(float).values
+    M = ~np.isnan(Y) & ~np.isnan(D).any(axis=1)[:, None]
+    k = D.shape[1] + 1
+    
+    coef = np.full((len(y), k), np.nan)
+    se = np.full((len(y), k), np.nan)
+    r2 = np.full(len(y), np.nan)
+    dof = np.zeros(len(y))
+    
+    #y columns missing the same rows share one solve
+    patterns, which = np.unique(M.T, axis=0, return_inverse=True)
+    for ipat, rows in enumerate(patterns):
+        cols = np.flatnonzero(which.ravel() == ipat)
+        n = rows.sum()
+        if n <= k:
+            continue
+        X = np.column_stack([np.ones(n), D[rows]])
+        Yp = Y[rows][:, cols]
+        beta, _, rank, _ = np.linalg.lstsq(X, Yp, rcond=None)
+        if rank < k:
+            continue
+        resid = Yp - X.dot(beta)
+        ssres = (resid ** 2).sum(axis=0)
+        sstot = ((Yp - Yp.mean(axis=0)) ** 2).sum(axis=0)
+        xtxinv = np.linalg.inv(X.T.dot(X))
+        coef[cols] = beta.T
+        se[cols] = np.sqrt(np.outer(ssres / (n - k), np.diag(xtxinv)))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r2[cols] = 1 - ssres / sstot
+        #a constant y, or one fit exactly, has no error to test against
+        eps = np.finfo(float).eps
+        flat = (sstot <= eps * (Yp ** 2).sum(axis=0)) | (ssres <= eps * sstot)
+        se[cols[flat]] = np.nan
+        r2[cols[flat]] = np.nan
+        dof[cols] = n - k
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tval = coef / se
+        pval = 2 * stats.t.sf(np.abs(tval), dof[:, None])
+        r_value = tval[:, 1] / np.sqrt(tval[:, 1] ** 2 + dof)
+    
+    lrtbl = pd.DataFrame({'XSslope': coef[:, 1], 'XSintercept': coef[:, 0],
+                          'XSr_value': r_value, 'XSp_value': pval[:, 1],
+                          'XSstd_err': se[:, 1], 'XSr_squared': r2,
+                          'XSn': np.where(dof > 0, dof + k, 0).astype(int)}, index=y)
+    for i, cov in enumerate(covars):
+        lrtbl['XS%s_coef' %cov] = coef[:, i + 2]
+        lrtbl['XS%s_p_value' %cov] = pval[:, i + 2]
+    return lrtbl
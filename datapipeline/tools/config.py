@@ -0,0 +1,50 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+
+
+# In[2]:
+
+def load_config(path):
+    """Reads a YAML or TOML file holding the paths and arguments for each data
+    modality, in the layout expected by gathermany.build_stages.
+    
+    Parameters
+    ----------
+    path : string
+        Full path to a .yaml, .yml or .toml file
+        
+    Returns
+    -------
+    config : dict
+        Dictionary holding 'outdir' and one dictionary per modality
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('PyYAML is needed to read %s' %path)
+        with open(path) as f:
+            config = yaml.safe_load(f)
+    elif ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ImportError('tomli is needed to read %s' %path)
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        raise ValueError('Config file must be .yaml, .yml or .toml: %s' %path)
+    
+    if not config or 'outdir' not in config:
+        raise ValueError('Config file %s does not set outdir' %path)
+    #the gather functions join outdir and file names without a separator
+    config['outdir'] = os.path.join(config['outdir'], '')
+    return config
@@ -0,0 +1,300 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import glob
+import json
+import pickle
+import hashlib
+import inspect
+from concurrent import futures
+
+
+# In[2]:
+
+def stage(func, outputs, needs=(), inputs=(), tblarg=None, **kwargs):
+    """Declares a single pipeline stage
+
+    Parameters
+    ----------
+    func : function
+        Function to call, usually one of the *_run functions
+    outputs : list
+        Names given to each item returned by func. A single name can be given
+        for functions that return one table.
+    needs : list
+        Names of tables produced by other stages that this stage depends on
+    inputs : list
+        Paths or glob patterns of the files and directories read by func. The
+        size and modification time of these files, and of every file below
+        these directories, decide whether the stage needs to run again. Naming
+        the files actually read, e.g. '<subjdir>/*/stats/aseg.stats', is
+        quicker than naming a large directory.
+    tblarg : string
+        Name of the keyword argument of func that receives a dictionary of the
+        tables in needs. Default None passes nothing.
+    **kwargs
+        Keyword arguments passed to func
+
+    Returns
+    -------
+    spec : dict
+        Dictionary describing the stage, for use in run_dag
+    """
+    if isinstance(outputs, str):
+        outputs = [outputs]
+    return {'func': func, 'outputs': list(outputs), 'needs': list(needs),
+            'inputs': list(inputs), 'tblarg': tblarg, 'kwargs': kwargs}
+
+
+# In[3]:
+
+def producers(stages):
+    """Maps every table name to the name of the stage that produces it
+    """
+    made_by = {}
+    for name, spec in stages.items():
+        for out in spec['outputs']:
+            made_by[out] = name
+    return made_by
+
+
+def resolve_order(stages, targets=None):
+    """Orders stages so that every stage comes after the stages it depends on.
+
+    Parameters
+    ----------
+    stages : dict
+        Dictionary where keys are stage names and values are made by stage
+    targets : list
+        Names of the stages to run. Stages they depend on are added. Default
+        None runs all stages.
+
+    Returns
+    -------
+    order : list
+        Names of stages in an order in which they can be run
+    upstream : dict
+        Keys are stage names, values are sets of the stages they depend on
+    """
+    made_by = producers(stages)
+    upstream = {}
+
+    order = []
+    visiting = set()
+    def visit(name):
+        if name in order:
+            return
+        if name in visiting:
+            raise ValueError('Stage %s depends on itself' %name)
+        #only stages that will run need every table they ask for
+        missing = [t for t in stages[name]['needs'] if t not in made_by]
+        if missing:
+            raise ValueError('Stage %s needs tables no stage makes: %s'
+                             %(name, ', '.join(missing)))
+        upstream[name] = set(made_by[t] for t in stages[name]['needs'])
+        visiting.add(name)
+        for dep in sorted(upstream[name]):
+            visit(dep)
+        visiting.discard(name)
+        order.append(name)
+
+    for name in (targets if targets is not None else sorted(stages)):
+        visit(name)
+    return order, dict((name, upstream[name]) for name in order)
+
+
+# In[4]:
+
+def _tree_entries(path):
+    """Every file below a directory, in a fixed order
+    """
+    entries = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        entries.extend(os.path.join(root, f) for f in sorted(files))
+    return entries
+
+
+def _hash_code(h, func):
+    """Hashes the source of the module defining func, so that editing func or
+    the helpers next to it is noticed. Falls back to the bytecode of func.
+    """
+    func = inspect.unwrap(func)
+    h.update(('%s.%s' %(func.__module__, func.__qualname__)).encode())
+    try:
+        with open(inspect.getsourcefile(func), 'rb') as f:
+            h.update(f.read())
+    except (TypeError, OSError):
+        code = getattr(func, '__code__', None)
+        if code is not None:
+            h.update(code.co_code)
+            h.update(repr(code.co_consts).encode())
+
+
+def _hash_value(h, value):
+    """Hashes an argument by its contents. Tables and arrays are hashed in full
+    rather than by their repr, which leaves out all but a few rows.
+    """
+    import numpy as np
+    import pandas as pd
+    if isinstance(value, dict):
+        h.update(b'{')
+        for key in sorted(value, key=str):
+            h.update(('%r:' %(key,)).encode())
+            _hash_value(h, value[key])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for item in value:
+            _hash_value(h, item)
+        h.update(b']')
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        h.update(repr(value.shape).encode())
+        if isinstance(value, pd.DataFrame):
+            h.update(repr(list(value.columns)).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, np.ndarray):
+        h.update(('%s%r' %(value.dtype, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif callable(value):
+        _hash_code(h, value)
+    else:
+        h.update(json.dumps(value, default=repr).encode())
+
+
+def fingerprint(spec, upstream_fps=()):
+    """Hashes everything that decides the output of a stage: the code of the
+    function, its arguments, the size and modification time of its input files,
+    and the fingerprints of the stages it depends on. Directories are walked, so
+    a change to any file below them, e.g. <subject>/stats/aseg.stats, is noticed.
+    """
+    h = hashlib.sha1()
+    _hash_code(h, spec['func'])
+    #the number of jobs does not change what a stage makes
+    _hash_value(h, dict((k, v) for k, v in spec['kwargs'].items() if k != 'jobs'))
+    for pattern in spec['inputs']:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            if os.path.isdir(path):
+                entries = _tree_entries(path)
+            else:
+                entries = [path]
+            for entry in entries:
+                try:
+                    st = os.stat(entry)
+                    h.update(('%s:%d:%d' %(entry, st.st_size, st.st_mtime_ns)).encode())
+                except OSError:
+                    h.update(('%s:missing' %entry).encode())
+    for fp in upstream_fps:
+        h.update(fp.encode())
+    return h.hexdigest()
+
+
+def _load_manifest(cachedir):
+    path = os.path.join(cachedir, 'manifest.json')
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(cachedir, manifest):
+    path = os.path.join(cachedir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+# In[5]:
+
+def _call(spec, tables):
+    """Calls the function of a stage and names its outputs
+    """
+    kwargs = dict(spec['kwargs'])
+    if spec['tblarg'] is not None:
+        kwargs[spec['tblarg']] = dict((t, tables[t]) for t in spec['needs'])
+    out = spec['func'](**kwargs)
+    if len(spec['outputs']) == 1:
+        out = (out,)
+    return dict(zip(spec['outputs'], out))
+
+
+def _load(cachefile):
+    with open(cachefile, 'rb') as f:
+        return pickle.load(f)
+
+
+def run_dag(stages, targets=None, jobs=1, cachedir=None, force=False, verbose=False):
+    """Runs pipeline stages in dependency order, passing tables between stages
+    in memory. Stages that do not depend on each other run concurrently.
+
+    Parameters
+    ----------
+    stages : dict
+        Dictionary where keys are stage names and values are made by stage
+    targets : list
+        Names of the stages to run, along with everything they depend on.
+        Default None runs all stages.
+    jobs : int
+        Number of stages that may run at the same time. Default 1.
+    cachedir : string
+        Full path to a directory where stage outputs are kept. If given, a stage
+        whose fingerprint is unchanged since its last run is loaded from here
+        instead of being run. Default None always runs every stage.
+    force : boolean
+        If True, run every stage even if its inputs are unchanged. Default False.
+    verbose : boolean
+        Default False. Set to True to print which stages run or are skipped.
+
+    Returns
+    -------
+    tables : dict
+        Dictionary where keys are the output names of every stage that ran
+        and values are the outputs themselves
+    """
+    order, upstream = resolve_order(stages, targets)
+    if cachedir is not None and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    manifest = _load_manifest(cachedir) if cachedir is not None else {}
+
+    tables = {}
+    fps = {}
+    done = set()
+    running = {}
+
+    def start(pool, name):
+        spec = stages[name]
+        fps[name] = fingerprint(spec, [fps[dep] for dep in sorted(upstream[name])])
+        cachefile = os.path.join(cachedir, '%s.pkl' %name) if cachedir else None
+        if (not force and cachefile and manifest.get(name) == fps[name]
+                and os.path.isfile(cachefile)):
+            if verbose:
+                print('%s unchanged, loading from %s' %(name, cachefile))
+            return pool.submit(_load, cachefile)
+        if verbose:
+            print('Running %s' %name)
+        return pool.submit(_call, spec, tables)
+
+    with futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while len(done) < len(order):
+            for name in order:
+                if (name not in done and name not in running
+                        and upstream[name] <= done and len(running) < max(jobs, 1)):
+                    running[name] = start(pool, name)
+            finished, _ = futures.wait(list(running.values()),
+                                       return_when=futures.FIRST_COMPLETED)
+            for name, fut in list(running.items()):
+                if fut not in finished:
+                    continue
+                del running[name]
+                out = fut.result()
+                tables.update(out)
+                done.add(name)
+                if cachedir is not None and manifest.get(name) != fps[name]:
+                    with open(os.path.join(cachedir, '%s.pkl' %name), 'wb') as f:
+                        pickle.dump(out, f, pickle.HIGHEST_PROTOCOL)
+                    manifest[name] = fps[name]
+                    _save_manifest(cachedir, manifest)
+    return tables
@@ -0,0 +1,116 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import hashlib
+from collections import Counter
+import pandas as pd
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+
+
+# In[2]:
+
+#bytes read from each of SAMPLE_BLOCKS evenly spaced places in a file when
+#telling apart files of the same size
+SAMPLE_BYTES = 64 * 1024
+SAMPLE_BLOCKS = 4
+#bytes read at a time for full hashes
+CHUNK_BYTES = 1024 * 1024
+
+
+def sample_hash(path, blocksize=SAMPLE_BYTES, nblocks=SAMPLE_BLOCKS):
+    """Hash of a few evenly spaced blocks of a file, including the first and
+    last. Files that differ here differ, but files that match must still be
+    compared with full_hash.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.blake2b(digest_size=16)
+    instrument.note_read(path)
+    with open(path, 'rb') as f:
+        if size <= blocksize * nblocks:
+            h.update(f.read())
+        else:
+            step = (size - blocksize) // (nblocks - 1)
+            for i in range(nblocks):
+                f.seek(i * step)
+                h.update(f.read(blocksize))
+    return h.hexdigest()
+
+
+def full_hash(path, chunksize=CHUNK_BYTES):
+    """Hash of the whole content of a file
+    """
+    h = hashlib.blake2b(digest_size=16)
+    instrument.note_read(path)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunksize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _hash_groups(func, paths, groups, jobs, failures, stage):
+    """Applies a hash function to the paths of groups with more than one
+    member, returning the hash of each path, or None where it was not needed
+    or could not be read
+    """
+    counts = Counter(g for g in groups if g is not None)
+    torun = [p for p, g in zip(paths, groups) if g is not None and counts[g] > 1]
+    hashes, failed = shards.shard_map(func, torun, jobs, processes=False)
+    shards.keep_failures(failed, failures, stage)
+    found = dict(zip(torun, hashes))
+    return [found.get(p) for p in paths]
+
+
+# In[3]:
+
+@instrument.profiled
+def find_duplicates(paths, jobs=1, failures=None):
+    """Finds files with identical content, such as the same scan copied into
+    several folders. Files are grouped by size, files sharing a size by a hash
+    of a few sampled blocks, and only files that still match are read in full
+    and compared by a hash of their whole content.
+
+    Parameters
+    ----------
+    paths : list
+        Full paths of the files to compare
+    jobs : int
+        Number of files hashed at the same time. Default 1.
+    failures : list
+        If given, the table of files that could not be read is appended to it.
+        They are treated as unique. Default None prints them.
+
+    Returns
+    -------
+    dups : pandas DataFrame
+        One row per path, in the order given, with columns path, size, digest
+        (the full hash, None for files that are unique by size or sampled
+        hash), canonical (of the files with the same content, the one fewest
+        folders deep, then first by name) and duplicate (TRUE for every path
+        but canonical)
+    """
+    paths = [str(p) for p in paths]
+    sizes = []
+    for p in paths:
+        try:
+            sizes.append(os.path.getsize(p))
+        except OSError:
+            sizes.append(None)
+    samples = _hash_groups(sample_hash, paths, sizes, jobs, failures, 'sample_hash')
+    keys = [(size, sample) if sample is not None else None
+            for size, sample in zip(sizes, samples)]
+    digests = _hash_groups(full_hash, paths, keys, jobs, failures, 'full_hash')
+
+    dups = pd.DataFrame({'path': paths, 'size': sizes, 'digest': digests})
+    canonical = {}
+    #the copy highest in the directory tree is kept, then the first by name
+    bydepth = sorted(zip(paths, digests), key=lambda pair: (pair[0].count('/'), pair[0]))
+    for p, digest in bydepth:
+        if digest is not None:
+            canonical.setdefault(digest, p)
+    dups['canonical'] = [canonical.get(d, p) for p, d in zip(paths, digests)]
+    dups['duplicate'] = dups['canonical'] != dups['path']
+    return dups
@@ -0,0 +1,254 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import json
+import time
+import resource
+import threading
+import functools
+from contextlib import contextmanager
+
+
+# In[2]:
+
+#instrumentation is off unless enable is called or DATAPIPELINE_PROFILE is set
+#to the path of the JSON log
+_enabled = False
+_logpath = None
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def enable(logpath=None):
+    """Turns on recording of stage timings, memory, row counts and files.
+
+    Parameters
+    ----------
+    logpath : string
+        Full path of a file that each finished stage is appended to as a line of
+        JSON. Default None only keeps records in memory.
+    """
+    global _enabled, _logpath
+    _logpath = logpath
+    _enabled = True
+
+
+def disable():
+    """Turns off recording. Records made so far are kept until reset is called.
+    """
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def _noting():
+    #files are noted when enabled, or inside capture in this thread
+    return _enabled or getattr(_local, 'capturing', False)
+
+
+def reset():
+    """Deletes all records made so far
+    """
+    with _lock:
+        del _records[:]
+
+
+def records():
+    """Returns a copy of the list of records, one dict per finished stage
+    """
+    with _lock:
+        return list(_records)
+
+
+if os.environ.get('DATAPIPELINE_PROFILE'):
+    enable(os.environ['DATAPIPELINE_PROFILE'])
+
+
+# In[3]:
+
+def _rows(obj):
+    """Counts rows of DataFrames and Series, including those inside tuples,
+    lists and dicts
+    """
+    if getattr(obj, 'ndim', None) in (1, 2) and hasattr(obj, 'index'):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return sum(_rows(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_rows(o) for o in obj.values())
+    return 0
+
+
+def _active():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _maxrss_mb():
+    #ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def note_read(path):
+    """Records that the running stage read path. Does nothing when disabled.
+    """
+    if _noting():
+        for rec in _active():
+            rec['files_read'].append(str(path))
+
+
+def note_written(path):
+    """Records that the running stage wrote path. Does nothing when disabled.
+    """
+    if _noting():
+        for rec in _active():
+            rec['files_written'].append(str(path))
+
+
+def bind(func):
+    """Wraps func so that files it notes from a worker thread are credited to
+    the stages running in the calling thread. Returns func itself when disabled.
+    """
+    if not _noting():
+        return func
+    stack = list(_active())
+    capturing = getattr(_local, 'capturing', False)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        prev = getattr(_local, 'stack', [])
+        prevcapturing = getattr(_local, 'capturing', False)
+        _local.stack = list(stack)
+        _local.capturing = capturing
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.stack = prev
+            _local.capturing = prevcapturing
+    return wrapper
+
+
+@contextmanager
+def track(stage, rows_in=0):
+    """Context manager that records wall time, CPU time, peak RSS and the files
+    read and written by the code inside it. CPU time is that of the calling
+    thread, so stages running in other threads are not counted, and neither is
+    work handed to worker threads or processes. Peak RSS is process-wide. The
+    yielded record can be given a 'rows_out' value. Does nothing but yield a
+    dict when disabled.
+
+    Parameters
+    ----------
+    stage : string
+        Name to record the stage under
+    rows_in : int
+        Number of input rows, if known
+    """
+    if not _enabled:
+        yield {}
+        return
+    stack = _active()
+    rec = {'stage': stage, 'parent': stack[-1]['stage'] if stack else None,
+           'thread': threading.current_thread().name, 'rows_in': rows_in, 'rows_out': 0,
+           'files_read': [], 'files_written': [], 'status': 'ok'}
+    rss0 = _maxrss_mb()
+    wall0, cpu0 = time.time(), time.thread_time()
+    stack.append(rec)
+    try:
+        yield rec
+    except BaseException as e:
+        rec['status'] = '%s: %s' %(type(e).__name__, e)
+        raise
+    finally:
+        stack.pop()
+        rec['start'] = wall0
+        rec['wall_s'] = time.time() - wall0
+        rec['cpu_s'] = time.thread_time() - cpu0
+        rec['peak_rss_mb'] = _maxrss_mb()
+        rec['rss_growth_mb'] = rec['peak_rss_mb'] - rss0
+        with _lock:
+            _records.append(rec)
+            if _logpath is not None:
+                with open(_logpath, 'a') as f:
+                    f.write(json.dumps(rec) + '\n')
+
+
+@contextmanager
+def capture():
+    """Context manager that collects the files noted by the code inside it
+    without making a record, even when disabled. Used in worker processes, whose
+    files are then noted again in the parent. Only the calling thread, and
+    functions it passes through bind, are affected.
+    """
+    prev = getattr(_local, 'capturing', False)
+    rec = {'files_read': [], 'files_written': []}
+    stack = _active()
+    stack.append(rec)
+    _local.capturing = True
+    try:
+        yield rec
+    finally:
+        _local.capturing = prev
+        stack.remove(rec)
+
+
+def profiled(func):
+    """Decorator recording each call of func as a stage named module.function,
+    with the rows of any DataFrames passed in and returned. When instrumentation
+    is disabled the call goes straight through.
+    """
+    stage = '%s.%s' %(func.__module__.split('.')[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with track(stage, _rows(args) + _rows(kwargs)) as rec:
+            out = func(*args, **kwargs)
+            rec['rows_out'] = _rows(out)
+        return out
+    return wrapper
+
+
+# In[4]:
+
+def summary(recs=None):
+    """Summarizes records into a table with one row per stage
+
+    Parameters
+    ----------
+    recs : list
+        Records to summarize. Default None uses all records made so far.
+
+    Returns
+    -------
+    summ : pandas DataFrame
+        Columns are the number of calls, total wall and CPU seconds, largest peak
+        RSS, total input and output rows, and number of files read and written,
+        sorted with the slowest stage first
+    """
+    import pandas as pd
+    recs = records() if recs is None else recs
+    cols = ['stage', 'calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rows_in', 'rows_out',
+            'files_read', 'files_written', 'errors']
+    if not recs:
+        return pd.DataFrame(columns=cols)
+    tbl = pd.DataFrame(recs)
+    tbl['calls'] = 1
+    tbl['files_read'] = tbl['files_read'].map(len)
+    tbl['files_written'] = tbl['files_written'].map(len)
+    tbl['errors'] = (tbl['status'] != 'ok').astype(int)
+    summ = tbl.groupby('stage').agg({'calls': 'sum', 'wall_s': 'sum', 'cpu_s': 'sum',
+                                     'peak_rss_mb': 'max', 'rows_in': 'sum',
+                                     'rows_out': 'sum', 'files_read': 'sum',
+                                     'files_written': 'sum', 'errors': 'sum'})
+    summ = summ.reset_index().sort_values('wall_s', ascending=False)
+    return summ[cols].reset_index(drop=True)
@@ -0,0 +1,217 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import glob
+import pickle
+import shutil
+import socket
+import tempfile
+from contextlib import contextmanager
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+#end of the last complete record of each journal this process wrote or read,
+#keyed by path, with the tag and the file's size and time at that point
+_ends = {}
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _known_end(path, tag):
+    """Offset to append at without reading the journal, or None when the file
+    changed since this process last wrote or read it
+    """
+    known = _ends.get(os.path.abspath(path))
+    if known is None or known[0] != tag:
+        return None
+    try:
+        if _stamp(path) != known[2]:
+            return None
+    except OSError:
+        return None
+    return known[1]
+
+
+def _remember(path, tag, end):
+    if end is None:
+        _ends.pop(os.path.abspath(path), None)
+    else:
+        _ends[os.path.abspath(path)] = (tag, end, _stamp(path))
+
+
+def _read(path, tag):
+    """Reads a journal, returning its records and the offset just past the last
+    complete one. The offset is None if the journal is missing or was written
+    for another tag.
+    """
+    done = {}
+    if not os.path.isfile(path):
+        return done, None
+    end = None
+    with open(path, 'rb') as f:
+        try:
+            if pickle.load(f) != tag:
+                return done, None
+            end = f.tell()
+            while True:
+                key, result = pickle.load(f)
+                done[key] = result
+                end = f.tell()
+        except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            #end of the journal, or a record cut short by a crash
+            pass
+    return done, end
+
+
+def load(path, tag):
+    """Reads the results saved in a checkpoint journal by append
+
+    Parameters
+    ----------
+    path : string
+        Full path of the journal file
+    tag : string
+        Description of the work the journal belongs to, e.g. the template and
+        its modification time. A journal written with another tag is ignored.
+
+    Returns
+    -------
+    done : dict
+        Saved results keyed by item id. Empty when there is no journal, or it
+        was written for another tag.
+    """
+    if os.path.isfile(path):
+        instrument.note_read(path)
+    done, end = _read(path, tag)
+    _remember(path, tag, end)
+    return done
+
+
+def append(path, tag, records):
+    """Durably adds results to a checkpoint journal. The file is flushed and
+    synced to disk before returning, so a crash afterwards loses none of them.
+    A record left half written by an earlier crash is cut off first. The
+    journal is only read when it was changed by something other than this
+    process since its last append or load, so appends take constant time.
+
+    Parameters
+    ----------
+    path : string
+        Full path of the journal file, created if missing
+    tag : string
+        Description of the work, see load. A journal with another tag is
+        replaced.
+    records : list
+        (item id, result) pairs
+    """
+    end = _known_end(path, tag)
+    if end is None:
+        end = _read(path, tag)[1]
+    with open(path, 'r+b' if end is not None else 'wb') as f:
+        if end is None:
+            pickle.dump(tag, f)
+        else:
+            f.seek(end)
+            f.truncate()
+        for record in records:
+            pickle.dump(record, f)
+        f.flush()
+        os.fsync(f.fileno())
+        end = f.tell()
+    _remember(path, tag, end)
+    instrument.note_written(path)
+
+
+def remove(path):
+    """Deletes a journal once the work it checkpoints has been saved
+    """
+    _ends.pop(os.path.abspath(path), None)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+# In[3]:
+
+#prefix of run-scoped scratch directories, followed by process id and host
+SCRATCH_PREFIX = 'run_'
+COMPLETE_MARKER = '.complete'
+
+
+def _discard(path):
+    """Moves a directory out of the way in one rename, then deletes it, so a
+    crash never leaves a half-deleted directory that looks like a run
+    """
+    trash = path.rstrip('/') + '.trash'
+    os.rename(path.rstrip('/'), trash)
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+def _owner_alive(name):
+    """Whether the process that made a scratch directory is still running
+    """
+    try:
+        owner = name[len(SCRATCH_PREFIX):].split('~', 1)[0]
+        pid, host = owner.split('@', 1)
+        pid = int(pid)
+    except ValueError:
+        return False
+    if host != socket.gethostname():
+        #cannot tell for another machine sharing the directory
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_stale(parent):
+    """Deletes scratch directories in parent left by runs that died: those that
+    were never marked complete and whose process is gone
+    """
+    for trash in glob.glob(os.path.join(parent, SCRATCH_PREFIX + '*.trash')):
+        shutil.rmtree(trash, ignore_errors=True)
+    for path in glob.glob(os.path.join(parent, SCRATCH_PREFIX + '*')):
+        name = os.path.basename(path)
+        if (os.path.isdir(path) and not name.endswith('.trash')
+                and not os.path.exists(os.path.join(path, COMPLETE_MARKER))
+                and not _owner_alive(name)):
+            _discard(path)
+
+
+@contextmanager
+def scratch_dir(parent, keep=False):
+    """Context manager making a scratch directory in parent used by one run
+    only, named run_<pid>@<host>~<random>. Directories left by runs that died
+    are deleted first. On leaving, the directory is deleted, or, with keep,
+    marked complete and kept for inspection.
+
+    Yields
+    ------
+    path : string
+        Full path of the scratch directory, ending in '/'
+    """
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+    clear_stale(parent)
+    path = tempfile.mkdtemp(prefix='%s%d@%s~' %(SCRATCH_PREFIX, os.getpid(),
+                                               socket.gethostname()), dir=parent)
+    ok = False
+    try:
+        yield path + '/'
+        ok = True
+    finally:
+        if keep and ok:
+            open(os.path.join(path, COMPLETE_MARKER), 'w').close()
+        else:
+            _discard(path)
@@ -0,0 +1,363 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+from datapipeline.tools import instrument
+from datapipeline.tools import shards
+
+
+# In[2]:
+
+#bumped when the layout of the sidecar files changes, so old ones are rebuilt
+INDEX_VERSION = 1
+SIDECAR_SUFFIX = '.labels.npz'
+
+
+def build_index(labels):
+    """Encodes a label volume, such as aparc+aseg, as runs of voxels. Each run
+    is a stretch of consecutive voxels of one label along the last axis.
+
+    Parameters
+    ----------
+    labels : numpy array
+        3D integer label volume. Label 0 is left out.
+
+    Returns
+    -------
+    index : dict
+        labels (sorted label values), counts (voxels of each label), bbox (first
+        and last voxel of each label along each axis, as i0, j0, k0, i1, j1, k1),
+        runptr (each label's runs are runstart[runptr[n]:runptr[n + 1]]),
+        runstart (flat index of the first voxel of each run), runlen (voxels in
+        each run) and shape
+    """
+    labels = np.asarray(labels)
+    flat = labels.ravel()
+    vox = np.flatnonzero(flat)
+    #sorted by label, then by position
+    vox = vox[np.argsort(flat[vox], kind='stable')]
+    lab = flat[vox]
+    #a run ends where the label changes, a voxel is skipped or a row ends
+    brk = np.ones(len(vox), dtype=bool)
+    if len(vox):
+        brk[1:] = ((lab[1:] != lab[:-1]) | (vox[1:] != vox[:-1] + 1)
+                   | (vox[1:] % labels.shape[-1] == 0))
+    starts = np.flatnonzero(brk)
+    runstart = vox[starts]
+    runlen = np.diff(np.append(starts, len(vox)))
+    runlab = lab[starts]
+
+    values, firstrun = np.unique(runlab, return_index=True)
+    runptr = np.append(firstrun, len(runstart))
+    counts = np.add.reduceat(runlen, firstrun) if len(runlen) else np.zeros(0, np.int64)
+    #the two ends of every run bound all of its voxels
+    first = np.array(np.unravel_index(runstart, labels.shape))
+    last = np.array(np.unravel_index(runstart + runlen - 1, labels.shape))
+    if len(runstart):
+        lo = np.minimum.reduceat(np.minimum(first, last), firstrun, axis=1)
+        hi = np.maximum.reduceat(np.maximum(first, last), firstrun, axis=1)
+    else:
+        lo = hi = np.zeros((labels.ndim, 0), dtype=np.int64)
+    itype = np.uint32 if labels.size < 2**32 else np.int64
+    return {'labels': values.astype(np.int64), 'counts': counts.astype(np.int64),
+            'bbox': np.concatenate([lo, hi]).T.astype(np.int32),
+            'runptr': runptr.astype(np.int64), 'runstart': runstart.astype(itype),
+            'runlen': runlen.astype(np.uint32), 'shape': np.array(labels.shape)}
+
+
+def sidecar_path(aparcpath, cachedir=None):
+    """Path of the label index of aparcpath: next to it, or in cachedir under a
+    name made from its full path
+    """
+    if cachedir is None:
+        return aparcpath + SIDECAR_SUFFIX
+    fullpath = os.path.abspath(aparcpath)
+    tag = hashlib.sha1(fullpath.encode('utf-8')).hexdigest()[:12]
+    parts = fullpath.split(os.sep)
+    #e.g. B12_v1_aparc+aseg.mgz, from the subject directory above mri/
+    name = '_'.join(p for p in [parts[-3] if len(parts) > 2 else '', parts[-1]] if p)
+    return os.path.join(cachedir, '%s_%s%s' %(tag, name, SIDECAR_SUFFIX))
+
+
+# In[3]:
+
+def label_index(aparcpath, cachedir=None, rebuild=False):
+    """Label index of an aparc+aseg file, read from its sidecar file when that
+    was made from the same file. Otherwise the label volume is read once,
+    indexed with build_index and the sidecar is written.
+
+    Parameters
+    ----------
+    aparcpath : string
+        Full path to a label volume, e.g. <sub>/mri/aparc+aseg.mgz
+    cachedir : string
+        Directory holding sidecar files. Default None keeps each next to its
+        label volume.
+    rebuild : boolean
+        If TRUE, the sidecar is made again even when it is current. Default is
+        FALSE.
+
+    Returns
+    -------
+    index : dict
+        Output of build_index, plus the source file's path
+    """
+    from datapipeline.tools import common_funcs as cf
+    stat = os.stat(aparcpath)
+    stamp = np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    sidecar = sidecar_path(aparcpath, cachedir)
+    if not rebuild and os.path.isfile(sidecar):
+        instrument.note_read(sidecar)
+        with np.load(sidecar) as saved:
+            if np.array_equal(saved['stamp'], stamp):
+                index = dict((k, saved[k]) for k in saved.files if k != 'stamp')
+                index['source'] = aparcpath
+                return index
+
+    index = build_index(cf.preproc_aparc(aparcpath).astype(np.int64))
+    if cachedir is not None and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    #written under another name first so a crash never leaves a torn sidecar
+    tmp = '%s.%d.tmp.npz' %(sidecar[:-len('.npz')], os.getpid())
+    np.savez_compressed(tmp, stamp=stamp, **index)
+    os.replace(tmp, sidecar)
+    instrument.note_written(sidecar)
+    index['source'] = aparcpath
+    return index
+
+
+@instrument.profiled
+def build_indexes(aparcpaths, cachedir=None, jobs=1, failures=None):
+    """Makes sure every label volume has a current sidecar file, reading only
+    those that do not, in jobs processes
+
+    Parameters
+    ----------
+    aparcpaths : list
+        Full paths to label volumes
+    cachedir : string
+        Directory holding sidecar files. Default None keeps each next to its
+        label volume.
+    jobs : int
+        Number of processes. Default 1.
+    failures : list
+        If given, the table of files that could not be indexed is appended to
+        it. Default None prints them.
+
+    Returns
+    -------
+    sidecars : list
+        Full path of the sidecar of each label volume, None where it failed
+    """
+    aparcpaths = list(aparcpaths)
+    done, failed = shards.shard_map(functools.partial(_index_one, cachedir=cachedir),
+                                    aparcpaths, jobs)
+    shards.keep_failures(failed, failures, 'build_indexes')
+    return [sidecar_path(p, cachedir) if ok else None for p, ok in zip(aparcpaths, done)]
+
+
+def _index_one(aparcpath, cachedir=None):
+    label_index(aparcpath, cachedir)
+    return True
+
+
+# In[4]:
+
+def _label_rows(index, labels):
+    """Positions in the index of the given label values. Labels missing from
+    the volume are left out.
+    """
+    labels = np.unique(np.asarray(labels, dtype=np.int64))
+    pos = np.searchsorted(index['labels'], labels)
+    #a missing label lands on the next label in the index, which may be asked for too
+    found = pos < len(index['labels'])
+    found[found] = index['labels'][pos[found]] == labels[found]
+    return pos[found]
+
+
+def label_voxels(index, labels):
+    """Flat indices of the voxels holding any of labels, in increasing order,
+    decoded from the runs of those labels only
+    """
+    rows = _label_rows(index, labels)
+    sel = np.concatenate([np.arange(index['runptr'][r], index['runptr'][r + 1])
+                          for r in rows]) if len(rows) else np.zeros(0, np.int64)
+    starts = index['runstart'][sel].astype(np.int64)
+    lens = index['runlen'][sel].astype(np.int64)
+    #each run's start repeated over its length, plus the offset within the run
+    offsets = np.arange(lens.sum()) - np.repeat(np.cumsum(lens) - lens, lens)
+    return np.sort(np.repeat(starts, lens) + offsets)
+
+
+def label_bbox(index, labels):
+    """Smallest box holding every voxel of any of labels, as a tuple of slices,
+    or None when no voxel holds them
+    """
+    rows = _label_rows(index, labels)
+    if len(rows) == 0:
+        return None
+    box = index['bbox'][rows]
+    ndim = len(index['shape'])
+    lo, hi = box[:, :ndim].min(axis=0), box[:, ndim:].max(axis=0)
+    return tuple(slice(int(a), int(b) + 1) for a, b in zip(lo, hi))
+
+
+def _region_labels(regions, FS_lut=None):
+    """Turns regions into a dict of region name to label values. regions is a
+    list of region names, or a dict whose values are lists of region names or
+    label values making up a combined region.
+    """
+    if not isinstance(regions, dict):
+        regions = dict((name, [name]) for name in regions)
+    out = {}
+    for name, members in regions.items():
+        if isinstance(members, (str, int, np.integer)):
+            members = [members]
+        out[name] = [FS_lut[m] if isinstance(m, str) else int(m) for m in members]
+    return out
+
+
+def region_volumes(index, regions, FS_lut=None):
+    """Number of voxels in each region, from the label counts alone
+
+    Parameters
+    ----------
+    index : dict
+        Output of label_index
+    regions : list or dict
+        Region names in FS_lut, or a dict of combined regions, e.g.
+        {'Hippocampus': ['Left-Hippocampus', 'Right-Hippocampus']}
+    FS_lut : dictionary
+        Freesurfer regions and their label values. Needed for region names.
+
+    Returns
+    -------
+    vols : dict
+        Voxel count of each region
+    """
+    vols = {}
+    for name, labels in _region_labels(regions, FS_lut).items():
+        #labels are disjoint, so a union's count is the sum of its labels'
+        vols[name] = int(index['counts'][_label_rows(index, np.unique(labels))].sum())
+    return vols
+
+
+def region_means(index, imgpath, regions, FS_lut=None):
+    """Mean, ignoring non-finite voxels, of a co-registered image (FDG, PIB)
+    within each region. Only the box holding the regions is read from the
+    image, and the label volume is not read at all.
+
+    Parameters
+    ----------
+    index : dict
+        Output of label_index, on the same grid as the image
+    imgpath : string
+        Full path to the image
+    regions : list or dict
+        Regions, as for region_volumes
+    FS_lut : dictionary
+        Freesurfer regions and their label values. Needed for region names.
+
+    Returns
+    -------
+    means : dict
+        Mean of each region, NaN for regions with no voxels
+    """
+    import nibabel as nb
+    regions = _region_labels(regions, FS_lut)
+    alllabels = np.unique([l for labels in regions.values() for l in labels])
+    shape = tuple(int(d) for d in index['shape'])
+    img = nb.load(imgpath)
+    if tuple(img.shape[:len(shape)]) != shape:
+        raise ValueError('%s has shape %s, labels have shape %s' %(imgpath, img.shape, shape))
+    box = label_bbox(index, alllabels)
+    means = dict((name, np.nan) for name in regions)
+    if box is None:
+        return means
+    instrument.note_read(imgpath)
+    #with an uncompressed image, slicing the proxy reads only the box
+    data = np.asarray(img.dataobj[box], dtype=np.float64).reshape(
+        [b.stop - b.start for b in box] + [-1])
+    lo = [b.start for b in box]
+    boxshape = data.shape[:-1]
+    for name, labels in regions.items():
+        vox = label_voxels(index, labels)
+        if len(vox) == 0:
+            continue
+        ijk = np.unravel_index(vox, shape)
+        local = np.ravel_multi_index([c - o for c, o in zip(ijk, lo)], boxshape)
+        vals = data.reshape(-1, data.shape[-1])[local]
+        vals = vals[np.isfinite(vals).all(axis=1)]
+        means[name] = float(vals.mean()) if len(vals) else np.nan
+    return means
+
+
+# In[5]:
+
+def subject_regions(aparcpath, regions, FS_lut=None, cachedir=None, imgpath=None):
+    """Volumes of regions in one subject, and with imgpath their mean in that
+    image, from the subject's label index. Returns None if aparcpath does not
+    exist.
+    """
+    if not os.path.isfile(aparcpath):
+        return None
+    index = label_index(aparcpath, cachedir)
+    out = region_volumes(index, regions, FS_lut)
+    if imgpath is not None:
+        means = region_means(index, imgpath, regions, FS_lut)
+        out.update(('%s_mean' %name, val) for name, val in means.items())
+    return out
+
+
+@instrument.profiled
+def index_regions(aparcpaths, regions, FS_lut=None, cachedir=None, imgpaths=None, jobs=1,
+                  failures=None):
+    """Volumes, and optionally image means, of regions in many subjects. Each
+    label volume is read only the first time, to make its sidecar file.
+
+    Parameters
+    ----------
+    aparcpaths : list
+        Full paths to label volumes
+    regions : list or dict
+        Regions, as for region_volumes
+    FS_lut : dictionary
+        Freesurfer regions and their label values. Needed for region names.
+    cachedir : string
+        Directory holding sidecar files. Default None keeps each next to its
+        label volume.
+    imgpaths : list
+        Full paths to co-registered images, one per label volume, whose region
+        means are added as '<region>_mean' columns. Default None.
+    jobs : int
+        Number of processes. Default 1.
+    failures : list
+        If given, the table of subjects that failed is appended to it. Default
+        None prints them.
+
+    Returns
+    -------
+    tbl : pandas DataFrame
+        One row per label volume, with a column per region and mean
+    """
+    aparcpaths = list(aparcpaths)
+    items = list(zip(aparcpaths, imgpaths if imgpaths is not None else [None] * len(aparcpaths)))
+    rows, failed = shards.shard_map(functools.partial(_regions_one, regions=regions,
+                                                      FS_lut=FS_lut, cachedir=cachedir),
+                                    items, jobs)
+    shards.keep_failures(failed, failures, 'index_regions')
+    cols = list(regions)
+    if imgpaths is not None:
+        cols += ['%s_mean' %name for name in regions]
+    return pd.DataFrame([row if row is not None else {} for row in rows], columns=cols)
+
+
+def _regions_one(item, regions, FS_lut=None, cachedir=None):
+    aparcpath, imgpath = item
+    return subject_regions(aparcpath, regions, FS_lut, cachedir, imgpath)
@@ -1,35 +1,51 @@
 
 # coding: utf-8
 
-# In[29]:
-
-get_ipython().magic(u'pylab inline')
-
-
 # In[27]:
 
 # Modified from https://gist.github.com/sergiobuj/6721187
 
+#matplotlib is imported where it is used so importing this module stays cheap
+#and works outside IPython. In a notebook, run %matplotlib inline to show plots.
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 import pandas as pd
-from matplotlib.path import Path
-from matplotlib.spines import Spine
-from matplotlib.projections.polar import PolarAxes
-from matplotlib.projections import register_projection
+
+#names of the radar projections already registered, by number of variables
+_projections = {}
  
 def _radar_factory(num_vars):
+    from matplotlib.patches import Polygon
+    from matplotlib.path import Path
+    from matplotlib.spines import Spine
+    from matplotlib.projections.polar import PolarAxes
+    from matplotlib.projections import register_projection
+
+    #the first variable is at the top: theta is measured from north
     theta = 2*np.pi * np.linspace(0, 1-1./num_vars, num_vars)
-    theta += np.pi/2
+    if num_vars in _projections:
+        return theta
  
     def unit_poly_verts(theta):
         x0, y0, r = [0.5] * 3
-        verts = [(r*np.cos(t) + x0, r*np.sin(t) + y0) for t in theta]
+        verts = [(r*np.cos(t + np.pi/2) + x0, r*np.sin(t + np.pi/2) + y0) for t in theta]
         return verts
+
+    class RadarTransform(PolarAxes.PolarTransform):
+        #draw straight edges between variables instead of arcs
+        def transform_path_non_affine(self, path):
+            if path._interpolation_steps > 1:
+                path = path.interpolated(num_vars)
+            return Path(self.transform(path.vertices), path.codes)
  
     class RadarAxes(PolarAxes):
-        name = 'radar'
+        name = 'radar%d' %num_vars
         RESOLUTION = 1
+        PolarTransform = RadarTransform
+
+        def __init__(self, *args, **kwargs):
+            super(RadarAxes, self).__init__(*args, **kwargs)
+            self.set_theta_zero_location('N')
  
         def fill(self, *args, **kwargs):
             closed = kwargs.pop('closed', True)
@@ -39,6 +55,7 @@ def _radar_factory(num_vars):
             lines = super(RadarAxes, self).plot(*args, **kwargs)
             for line in lines:
                 self._close_line(line)
+            return lines
  
         def _close_line(self, line):
             x, y = line.get_data()
@@ -49,11 +66,11 @@ def _radar_factory(num_vars):
                 line.set_data(x, y)
  
         def set_varlabels(self, labels):
-            self.set_thetagrids(theta * 180/np.pi, labels)
+            self.set_thetagrids(np.degrees(theta), labels)
  
         def _gen_axes_patch(self):
             verts = unit_poly_verts(theta)
-            return plt.Polygon(verts, closed=True, edgecolor='k')
+            return Polygon(verts, closed=True, edgecolor='k')
  
         def _gen_axes_spines(self):
             spine_type = 'circle'
@@ -65,19 +82,138 @@ def _radar_factory(num_vars):
             return {'polar': spine}
  
     register_projection(RadarAxes)
+    _projections[num_vars] = RadarAxes.name
     return theta
  
 def radar_graph(labels = [], values = [], colors = ['k', 'r', 'b', 'g']):
+    import matplotlib.pyplot as plt
     N = len(labels) 
     theta = _radar_factory(N)
     max_val = max(np.concatenate(values))
     fig = plt.figure()
-    ax = fig.add_subplot(1, 1, 1, projection='radar')
+    ax = fig.add_subplot(1, 1, 1, projection=_projections[N])
     for i,value in enumerate(values):
         ax.plot(theta, value, color=colors[i])
     ax.set_varlabels(labels)
 
 
+# In[28]:
+
+def _closed(x):
+    return np.concatenate([x, x[:1]])
+
+
+def _set_profile(line, patch, theta, value):
+    """Moves the line and fill of a drawn profile to new values. The line is
+    broken at missing values rather than drawn to the center, and a profile
+    with missing values is not filled.
+    """
+    line.set_data(_closed(theta), _closed(value))
+    missing = np.isnan(value).any()
+    patch.set_visible(not missing)
+    if not missing:
+        patch.set_xy(np.column_stack([_closed(theta), _closed(value)]))
+
+
+def _render_chunk(args, pages=None):
+    """Draws a chunk of radar profiles on one reused Agg figure. Writes a PNG
+    per profile to outdir, or a page per profile to the PdfPages pages.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    labels, names, values, outdir, ylim, figsize, dpi, color = args
+
+    theta = _radar_factory(len(labels))
+    fig = Figure(figsize=figsize, dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1, projection=_projections[len(labels)])
+    ax.set_varlabels(labels)
+    ax.set_ylim(*ylim)
+    line = ax.plot(theta, np.zeros(len(theta)), color=color)[0]
+    patch = ax.fill(theta, np.zeros(len(theta)), color=color, alpha=0.25)[0]
+    title = ax.set_title('')
+
+    out = []
+    for name, value in zip(names, values):
+        _set_profile(line, patch, theta, value)
+        title.set_text(name)
+        if pages is not None:
+            pages.savefig(fig)
+        else:
+            path = os.path.join(outdir, '%s.png' %name)
+            fig.savefig(path)
+            out.append(path)
+    return out
+
+
+def render_radars(tbl, labels, outpath, namecols=None, ylim=None, jobs=1, chunksize=200,
+                  figsize=(6, 6), dpi=100, color='b'):
+    """Draws a radar plot for every row of a table, such as the factor weights
+    read by factorscores (one plot per factor) or the subjdata_z table from
+    zscore (one plot per subject session). The projection is registered once,
+    each worker process reuses a single Agg figure, and chunks of rows are drawn
+    in a process pool. A PDF is drawn in this process, straight to its pages,
+    so they stay vector graphics.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        DataFrame where each row is a profile to plot
+    labels : list
+        Names of the columns of tbl to plot, e.g. cogtests_master
+    outpath : string
+        Full path of a directory to write one PNG per row to, or of a .pdf file
+        to write one page per row to
+    namecols : list
+        Columns of tbl joined with '_' to name each plot, e.g. ['codeb', 'NP_Tp'].
+        Default None uses the index of tbl.
+    ylim : tuple
+        Radial limits shared by all plots. Default None uses the smallest and
+        largest value in tbl[labels].
+    jobs : int
+        Number of processes to draw PNGs with. Default 1 draws in this process.
+    chunksize : int
+        Number of rows each task draws. Default 200.
+    figsize : tuple
+        Size of each plot in inches. Default (6, 6).
+    dpi : int
+        Resolution of each plot. Default 100.
+    color : string
+        Color of the profile. Default 'b'.
+
+    Returns
+    -------
+    outputs : list
+        Paths of the PNGs written, or outpath for a PDF
+    """
+    values = tbl[labels].astype(float).values
+    if namecols:
+        names = tbl[namecols].astype(str).apply('_'.join, axis=1).tolist()
+    else:
+        names = [str(i) for i in tbl.index]
+    if ylim is None:
+        ylim = (np.nanmin(values), np.nanmax(values))
+    pdf = outpath.lower().endswith('.pdf')
+    outdir = None if pdf else outpath
+    if outdir is not None and not os.path.exists(outdir):
+        os.makedirs(outdir)
+    tasks = [(list(labels), names[i:i + chunksize], values[i:i + chunksize], outdir,
+              ylim, figsize, dpi, color) for i in range(0, len(names), chunksize)]
+
+    if pdf:
+        from matplotlib.backends.backend_pdf import PdfPages
+        with PdfPages(outpath) as pages:
+            for task in tasks:
+                _render_chunk(task, pages)
+        return [outpath]
+
+    if jobs is None or jobs <= 1:
+        return [path for task in tasks for path in _render_chunk(task)]
+    from concurrent import futures
+    with futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        return [path for chunk in pool.map(_render_chunk, tasks) for path in chunk]
+
+
 # In[ ]:
 
 # if __name__ = '__main__':
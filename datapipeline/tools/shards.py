@@ -0,0 +1,235 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import traceback
+import pandas as pd
+from datapipeline.tools import instrument
+from datapipeline.tools import journal as jr
+
+
+# In[2]:
+
+#columns of the failures table returned by shard_map
+FAILURE_COLS = ['shard', 'item', 'error', 'traceback']
+
+
+def make_shards(items, shardsize, key=None):
+    """Splits items into shards of about shardsize items, keeping all items with
+    the same key (e.g. every timepoint of a subject) in one shard
+
+    Parameters
+    ----------
+    items : list
+        Items to split
+    shardsize : int
+        Number of items per shard. A shard can be larger when one key has more
+        items than this.
+    key : function
+        Function of an item returning its subject, e.g. get_id of the file name.
+        Default None treats every item as its own subject.
+
+    Returns
+    -------
+    shards : list
+        Lists of (position in items, item) pairs
+    """
+    groups = {}
+    for pos, item in enumerate(items):
+        groups.setdefault(key(item) if key is not None else pos, []).append((pos, item))
+    shards, cur = [], []
+    for group in groups.values():
+        if cur and len(cur) + len(group) > shardsize:
+            shards.append(cur)
+            cur = []
+        cur = cur + group
+    if cur:
+        shards.append(cur)
+    return shards
+
+
+def _run_shard(args):
+    """Applies func to each item of a shard, catching the error of any item
+    that fails so the rest of the shard still runs. Returns the results, the
+    failures and the files noted while running.
+    """
+    func, shardno, shard, capture = args
+    results, failures = [], []
+
+    def run():
+        for pos, item in shard:
+            try:
+                results.append((pos, func(item)))
+            except Exception as e:
+                failures.append({'shard': shardno, 'item': item,
+                                 'error': '%s: %s' %(type(e).__name__, e),
+                                 'traceback': traceback.format_exc()})
+    if capture:
+        with instrument.capture() as files:
+            run()
+    else:
+        files = None
+        run()
+    return results, failures, files
+
+
+# In[3]:
+
+@instrument.profiled
+def shard_map(func, items, jobs=1, shardsize=None, key=None, maxinflight=None,
+              processes=True, journal=None, journaltag='', ids=None):
+    """Applies a per-subject function to every item, running shards of subjects
+    in a process pool. At most maxinflight shards are queued or running at once,
+    so only their inputs and outputs are held in memory. An item that raises, or
+    a shard whose worker dies, is reported in failures and the rest of the batch
+    carries on. Shards in flight when a worker dies are run again one at a time,
+    so only the shard that killed it is reported.
+
+    Parameters
+    ----------
+    func : function
+        Function taking a single item. With processes it must be picklable: a
+        module-level function, or a functools.partial of one.
+    items : list
+        Items to apply func to, e.g. subject directories or scan paths
+    jobs : int
+        Number of workers. Default 1 runs every shard in this process.
+    shardsize : int
+        Number of items per shard. Default None makes about four shards per
+        worker, or with journal one subject per shard.
+    key : function
+        Function of an item returning its subject, so that a subject's items
+        share a shard. Default None.
+    maxinflight : int
+        Number of shards queued or running at once. Default None uses 2 * jobs.
+    processes : boolean
+        If TRUE, workers are processes. Set to FALSE for work that waits on
+        files or command line tools, which threads do as well. Default is TRUE.
+    journal : string
+        Full path of a checkpoint journal. The results of each finished shard
+        are appended to it, and items already in it are not run again, so a
+        batch that died can be resumed. Shards hold one subject by default, so
+        each subject is saved as soon as it is done. Default None keeps no
+        journal.
+    journaltag : string
+        Description of the work, such as the arguments bound to func. A journal
+        written with a different tag is started over. Default ''.
+    ids : list
+        Names of the items that stay the same between runs, used as journal
+        keys, e.g. source paths when items are in a run's scratch directory.
+        Default None uses items.
+
+    Returns
+    -------
+    results : list
+        Output of func for each item, in the same order as items, with None for
+        items that failed
+    failures : pandas DataFrame
+        One row per failed item with columns shard, item, error and traceback
+    """
+    items = list(items)
+    ids = list(ids) if ids is not None else items
+    jobs = jobs if jobs is not None and jobs > 1 else 1
+    results = [None] * len(items)
+    failures = []
+    torun = list(range(len(items)))
+    if journal is not None:
+        saved = jr.load(journal, journaltag)
+        for pos in torun:
+            if ids[pos] in saved:
+                results[pos] = saved[ids[pos]]
+        torun = [pos for pos in torun if ids[pos] not in saved]
+    if shardsize is None and journal is not None:
+        #only finished shards reach the journal, so keep them to one subject
+        shardsize = 1
+    elif shardsize is None:
+        shardsize = max(1, -(-len(torun) // (4 * jobs)))
+    subject = (lambda pos: key(items[pos])) if key is not None else None
+    shards = [[(pos, items[pos]) for _, pos in shard]
+              for shard in make_shards(torun, shardsize, subject)]
+
+    def collect(out):
+        done, failed, files = out
+        for pos, res in done:
+            results[pos] = res
+        if journal is not None and done:
+            jr.append(journal, journaltag, [(ids[pos], res) for pos, res in done])
+        failures.extend(failed)
+        if files is not None:
+            for path in files['files_read']:
+                instrument.note_read(path)
+            for path in files['files_written']:
+                instrument.note_written(path)
+
+    if jobs == 1:
+        for shardno, shard in enumerate(shards):
+            collect(_run_shard((func, shardno, shard, False)))
+        return results, pd.DataFrame(failures, columns=FAILURE_COLS)
+
+    from concurrent import futures
+    from concurrent.futures.process import BrokenProcessPool
+    if processes:
+        pool = futures.ProcessPoolExecutor(max_workers=jobs)
+        task = lambda shardno: (func, shardno, shards[shardno], instrument.is_enabled())
+    else:
+        pool = futures.ThreadPoolExecutor(max_workers=jobs)
+        bound = instrument.bind(func)
+        task = lambda shardno: (bound, shardno, shards[shardno], False)
+    maxinflight = maxinflight or 2 * jobs
+    pending = {}
+    #shards in flight when a worker died, rerun one at a time at the end
+    suspects = []
+    todo = iter(range(len(shards)))
+    try:
+        while True:
+            for shardno in todo:
+                pending[pool.submit(_run_shard, task(shardno))] = shardno
+                if len(pending) >= maxinflight:
+                    break
+            if not pending:
+                break
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            if any(isinstance(fut.exception(), BrokenProcessPool) for fut in done):
+                #a worker died, e.g. killed for running out of memory, and took
+                #the pool with it. Any shard in flight could have killed it.
+                for fut, shardno in pending.items():
+                    if fut.done() and fut.exception() is None:
+                        collect(fut.result())
+                    else:
+                        suspects.append(shardno)
+                pending = {}
+                pool.shutdown(wait=False)
+                pool = futures.ProcessPoolExecutor(max_workers=jobs)
+                continue
+            for fut in done:
+                collect(fut.result())
+                del pending[fut]
+    finally:
+        pool.shutdown()
+
+    for shardno in sorted(suspects):
+        with futures.ProcessPoolExecutor(max_workers=1) as alone:
+            try:
+                collect(alone.submit(_run_shard, task(shardno)).result())
+            except BrokenProcessPool as e:
+                failures.extend({'shard': shardno, 'item': item,
+                                 'error': '%s: %s' %(type(e).__name__, e),
+                                 'traceback': ''} for _, item in shards[shardno])
+    failures = pd.DataFrame(failures, columns=FAILURE_COLS)
+    return results, failures.sort_values(['shard'], kind='stable').reset_index(drop=True)
+
+
+def keep_failures(found, failures=None, stage=''):
+    """Adds the failures table of a shard_map call, labeled with the stage it
+    came from, to the list failures. Prints it when failures is None.
+    """
+    if len(found) == 0:
+        return
+    found = found.copy()
+    found.insert(0, 'stage', stage)
+    if failures is None:
+        print('%d item(s) failed in %s:' %(len(found), stage))
+        print(found[['item', 'error']].to_string(index=False))
+    else:
+        failures.append(found)
@@ -0,0 +1,168 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import os
+import re
+import sys
+import pickle
+import threading
+import pandas as pd
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+#files looked for in each freesurfer subject directory, by column name
+EXPECTED_FILES = {'has_aseg_stats': 'stats/aseg.stats',
+                  'has_reconlog': 'scripts/recon-all.log',
+                  'has_aparc_aseg': 'mri/aparc+aseg.mgz'}
+
+#subject id: B followed by all of its digits, so B1 and B12 are two subjects.
+#Names used to be read as B and one digit, which made them one.
+ID_PATTERN = r'B\d+'
+
+#changed whenever the parsing of directory names changes, so kept indexes
+#made by older code are scanned again
+INDEX_VERSION = 2
+
+#indexes already made in this process, by root path
+_memo = {}
+_lock = threading.Lock()
+
+
+def parse_subdir(name):
+    """Reads the subject id, timepoint and freesurfer stream from the name of
+    a subject directory, e.g. B12_v2, B12_v2.long.B12_base or B12_base
+
+    Returns
+    -------
+    info : dict
+        Keys are codea, Tp, long (True for longitudinal stream directories),
+        base (name of the template a .long. directory was made from) and cross
+        (True for cross-sectional timepoint directories)
+    """
+    idmatch = re.search(ID_PATTERN, name)
+    tpmatch = re.search(r'\_v(\d)', name)
+    islong = '.long.' in name
+    base = name.split('.long.', 1)[1] if islong else None
+    #the same names recur in every table, so keep one copy of each
+    return {'codea': sys.intern(idmatch.group()) if idmatch else None,
+            'Tp': int(tpmatch.group(1)) if tpmatch else None,
+            'long': islong,
+            'base': sys.intern(base) if base else None,
+            'cross': bool(tpmatch) and not islong}
+
+
+def _scan_entry(entry):
+    """Indexes one subject directory, checking which expected files exist
+    """
+    row = {'sub': sys.intern(entry.name), 'mtime': entry.stat().st_mtime}
+    row.update(parse_subdir(entry.name))
+    for col, relpath in EXPECTED_FILES.items():
+        row[col] = os.path.isfile(os.path.join(entry.path, relpath))
+    return row
+
+
+# In[3]:
+
+@instrument.profiled
+def subject_index(rootpath, cachepath=None, refresh=False):
+    """Index of the subject directories in a freesurfer subjects directory,
+    read with a single os.scandir and shared by every function that needs it.
+    The index is kept in memory for the rest of the process and, with
+    cachepath, on disk between runs.
+
+    A kept index is reused as is while rootpath has the same modification time
+    and no subject was missing an expected file. Otherwise rootpath is scanned
+    again, and only subject directories that are new, have a new modification
+    time or were missing an expected file (recon-all fills them in later) are
+    checked again. Directories without a subject id, such as fsaverage, are
+    not expected to fill in.
+
+    Parameters
+    ----------
+    rootpath : string
+        Full path to root directory of freesurfer processed data
+    cachepath : string
+        Full path of a pickle file to keep the index in between runs. Default
+        None only keeps it in memory.
+    refresh : boolean
+        If TRUE, ignore any kept index and check every directory again.
+        Default is FALSE.
+
+    Returns
+    -------
+    index : pandas DataFrame
+        One row per directory in rootpath with columns sub, codea, Tp, long,
+        base, cross, mtime and one has_* column per entry in EXPECTED_FILES
+    """
+    rootpath = os.path.join(rootpath, '')
+    rootmtime = os.stat(rootpath).st_mtime
+    with _lock:
+        kept = None if refresh else _memo.get(rootpath)
+    if kept is None and not refresh and cachepath and os.path.isfile(cachepath):
+        try:
+            with open(cachepath, 'rb') as f:
+                kept = pickle.load(f).get(rootpath)
+        except (EOFError, pickle.UnpicklingError):
+            #cut short by a crash before writes were atomic
+            kept = None
+        instrument.note_read(cachepath)
+    if kept is not None and kept.get('version') != INDEX_VERSION:
+        kept = None
+    if kept is not None and kept['rootmtime'] == rootmtime and kept['complete']:
+        return kept['index'].copy()
+
+    old = dict((row['sub'], row) for row in kept['index'].to_dict('records')) if kept else {}
+    expected = list(EXPECTED_FILES)
+    rows = []
+    for entry in os.scandir(rootpath):
+        if not entry.is_dir():
+            continue
+        prev = old.get(entry.name)
+        if (prev is not None and prev['mtime'] == entry.stat().st_mtime
+                and (pd.isnull(prev['codea']) or all(prev[col] for col in expected))):
+            rows.append(prev)
+        else:
+            rows.append(_scan_entry(entry))
+    columns = ['sub', 'codea', 'Tp', 'long', 'base', 'cross', 'mtime'] + expected
+    index = pd.DataFrame(rows, columns=columns).sort_values('sub').reset_index(drop=True)
+    index['Tp'] = index['Tp'].astype('Int64')
+
+    #only an index with no unfinished subjects can be reused without checking
+    subjects = index[index['codea'].notnull()]
+    kept = {'version': INDEX_VERSION, 'rootmtime': rootmtime, 'index': index,
+            'complete': bool(subjects[expected].values.all())}
+    with _lock:
+        _memo[rootpath] = kept
+        if cachepath:
+            _save(cachepath, rootpath, kept)
+    return index.copy()
+
+
+def _save(cachepath, rootpath, kept):
+    """Adds one root's index to the cache file. The file is replaced in one
+    rename, so readers never see it half written.
+    """
+    allkept = {}
+    if os.path.isfile(cachepath):
+        try:
+            with open(cachepath, 'rb') as f:
+                allkept = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            pass
+    allkept[rootpath] = kept
+    tmppath = '%s.%d.%d.tmp' %(cachepath, os.getpid(), threading.get_ident())
+    with open(tmppath, 'wb') as f:
+        pickle.dump(allkept, f)
+    os.replace(tmppath, cachepath)
+    instrument.note_written(cachepath)
+
+
+def clear():
+    """Forgets the indexes kept in memory
+    """
+    with _lock:
+        _memo.clear()
@@ -0,0 +1,207 @@
+
+# coding: utf-8
+
+# In[1]:
+
+import sqlite3
+import numpy as np
+import pandas as pd
+from datapipeline.tools import instrument
+
+
+# In[2]:
+
+#columns that tables are clustered and indexed on, when present
+SUBJECT_COLS = ['codea', 'codeb']
+
+
+def _quote(name):
+    return '"%s"' %str(name).replace('"', '""')
+
+
+def key_columns(tbl):
+    """Columns of tbl that queries are expected to filter on: subject codes,
+    timepoints (*_Tp) and dates (*Date, *Scandate)
+    """
+    keys = [c for c in SUBJECT_COLS if c in tbl.columns]
+    keys += [c for c in tbl.columns if str(c).endswith('_Tp')]
+    keys += [c for c in tbl.columns if str(c).endswith(('Date', 'Scandate', 'DateBL'))
+             and c not in keys]
+    return keys
+
+
+def _dtype(values):
+    """Name of the dtype recorded for a column. Object columns holding only
+    booleans and missing values, as left by merges, are recorded as boolean.
+    """
+    if values.dtype == object:
+        present = values.dropna()
+        if len(present) and present.map(lambda v: isinstance(v, (bool, np.bool_))).all():
+            return 'boolean'
+    return str(values.dtype)
+
+
+def _connect(dbpath):
+    con = sqlite3.connect(dbpath)
+    con.execute('CREATE TABLE IF NOT EXISTS _columns '
+                '(tbl TEXT, col TEXT, dtype TEXT, iskey INTEGER, pos INTEGER)')
+    return con
+
+
+# In[3]:
+
+@instrument.profiled
+def write_table(tbl, name, dbpath, keycols=None):
+    """Saves a table in a local SQLite database, replacing any table of the same
+    name. Rows are written sorted by subject so each subject's rows sit
+    together on disk, and every key column is indexed, so query reads only the
+    pages of the subjects and visits asked for.
+
+    Parameters
+    ----------
+    tbl : pandas DataFrame
+        Table such as NPtbl, subjtbl or any gather output
+    name : string
+        Name to save the table under, e.g. 'NPtbl'
+    dbpath : string
+        Full path of the database file, created if missing
+    keycols : list
+        Columns to index. Default None uses key_columns(tbl).
+    """
+    if keycols is None:
+        keycols = key_columns(tbl)
+    sortcols = [c for c in SUBJECT_COLS + list(keycols) if c in tbl.columns]
+    sortcols = list(dict.fromkeys(sortcols))
+    if sortcols:
+        tbl = tbl.sort_values(sortcols, kind='stable')
+    tbl = tbl.reset_index(drop=True)
+
+    con = _connect(dbpath)
+    try:
+        with con:
+            con.execute('DROP TABLE IF EXISTS %s' %_quote(name))
+            con.execute('DELETE FROM _columns WHERE tbl = ?', (name,))
+            tbl.to_sql(name, con, index=False)
+            for col in keycols:
+                con.execute('CREATE INDEX %s ON %s (%s)' %(_quote('ix_%s_%s' %(name, col)),
+                                                          _quote(name), _quote(col)))
+            con.executemany('INSERT INTO _columns VALUES (?, ?, ?, ?, ?)',
+                            [(name, str(col), _dtype(tbl[col]), int(col in keycols), pos)
+                             for pos, col in enumerate(tbl.columns)])
+    finally:
+        con.close()
+    instrument.note_written(dbpath)
+
+
+@instrument.profiled
+def write_tables(tbldict, dbpath, names=None):
+    """Saves several tables, e.g. the tbldict returned by datamerge_run, with
+    write_table. Default None for names saves every table in tbldict.
+    """
+    for name in (names if names is not None else sorted(tbldict)):
+        write_table(tbldict[name], name, dbpath)
+
+
+def tables(dbpath):
+    """Lists the tables in a database with their columns
+
+    Returns
+    -------
+    cols : pandas DataFrame
+        One row per table column with columns tbl, col, dtype and iskey
+    """
+    instrument.note_read(dbpath)
+    con = _connect(dbpath)
+    try:
+        return pd.read_sql('SELECT tbl, col, dtype, iskey FROM _columns ORDER BY tbl, pos', con)
+    finally:
+        con.close()
+
+
+# In[4]:
+
+@instrument.profiled
+def query(dbpath, name, columns=None, where=None, params=(), **filters):
+    """Reads part of a saved table. Only the requested columns are returned and
+    filters are applied inside SQLite, using the indexes on key columns.
+
+    Parameters
+    ----------
+    dbpath : string
+        Full path of the database file
+    name : string
+        Name of the table, e.g. 'NPtbl'
+    columns : list
+        Columns to return. Default None returns all.
+    where : string
+        Extra SQL condition, e.g. '"PIB_Index" > ?'. Default None.
+    params : tuple
+        Values for the ? placeholders in where
+    **filters
+        Column filters combined with AND. A single value selects equal rows, a
+        list selects rows equal to any of its values, and a (low, high) tuple
+        selects rows in that closed range, e.g. codeb=[10012, 10015],
+        NP_Tp=1 or NP_Date=('2012-01-01', '2013-12-31').
+
+    Returns
+    -------
+    tbl : pandas DataFrame
+        Matching rows, with the dtypes the table was saved with. Boolean
+        columns with missing values come back as the nullable boolean dtype.
+    """
+    instrument.note_read(dbpath)
+    con = _connect(dbpath)
+    try:
+        meta = pd.read_sql('SELECT col, dtype FROM _columns WHERE tbl = ? ORDER BY pos', con,
+                           params=(name,))
+        if len(meta) == 0:
+            raise KeyError('%s is not a table in %s' %(name, dbpath))
+        dtypes = dict(zip(meta['col'], meta['dtype']))
+        if columns is None:
+            columns = list(meta['col'])
+        missing = [c for c in list(columns) + list(filters) if c not in dtypes]
+        if missing:
+            raise KeyError('%s not in table %s' %(', '.join(map(str, missing)), name))
+
+        conds, values = [], []
+        for col, val in filters.items():
+            if isinstance(val, tuple):
+                conds.append('%s BETWEEN ? AND ?' %_quote(col))
+                values += [_sqlvalue(v, dtypes[col]) for v in val]
+            elif isinstance(val, (list, set, pd.Index, pd.Series)):
+                val = list(val)
+                conds.append('%s IN (%s)' %(_quote(col), ', '.join('?' * len(val))))
+                values += [_sqlvalue(v, dtypes[col]) for v in val]
+            else:
+                conds.append('%s = ?' %_quote(col))
+                values.append(_sqlvalue(val, dtypes[col]))
+        if where:
+            conds.append('(%s)' %where)
+            values += list(params)
+        sql = 'SELECT %s FROM %s' %(', '.join(_quote(c) for c in columns), _quote(name))
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        tbl = pd.read_sql(sql, con, params=values)
+    finally:
+        con.close()
+
+    for col in tbl.columns:
+        if dtypes[col].startswith('datetime'):
+            tbl[col] = pd.to_datetime(tbl[col])
+        elif dtypes[col] in ('bool', 'boolean'):
+            #missing values stay missing rather than becoming True
+            tbl[col] = tbl[col].astype('boolean')
+            if dtypes[col] == 'bool' and not tbl[col].isnull().any():
+                tbl[col] = tbl[col].astype(bool)
+    return tbl
+
+
+def _sqlvalue(val, dtype):
+    """Converts numpy and pandas scalars to values sqlite3 accepts, with values
+    for date columns written the way to_sql stores them
+    """
+    if dtype.startswith('datetime') or hasattr(val, 'strftime'):
+        return pd.Timestamp(val).strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(val, 'item'):
+        return val.item()
+    return val
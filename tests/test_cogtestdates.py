@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import cogtestdates
+
+
+def test_years_relative_to_baseline(tmp_path, monkeypatch):
+    pytest.importorskip('openpyxl')
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    wide = pd.DataFrame({'codea': ['B1', 'B2'], 'APOE1': [3, 4], 'APOE2': [4, 4],
+                         '1:: AgeatSession': [70.0, 65.0],
+                         '1:: NeuropsychExamTestDate': pd.to_datetime(['2010-01-01',
+                                                                       '2011-03-01']),
+                         '2:: AgeatSession': [72.0, np.nan],
+                         '2:: NeuropsychExamTestDate': pd.to_datetime(['2012-01-01', None])})
+    path = str(tmp_path / 'cogdates.xlsx')
+    wide.to_excel(path, index=False)
+    testing, subjinfo = cogtestdates.cogtestdates_run(path, {'APOE1': 'APOE1',
+                                                             'APOE2': 'APOE2'}, str(tmp_path))
+    testing = testing.set_index(['codea', 'NP_Tp'])
+    assert len(testing) == 3
+    assert testing.loc[('B1', '1'), 'NP_YrsRelBL'] == 0
+    assert np.isclose(testing.loc[('B1', '2'), 'NP_YrsRelBL'], 730 / 365.25)
+    assert list(subjinfo['APOE_dose']) == [5, 6]
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import cohortarray
+
+nb = pytest.importorskip('nibabel')
+SHAPE = (6, 5, 4)
+AFFINE = np.diag([2., 2., 2., 1.])
+
+
+def save_scan(path, vol, affine=AFFINE):
+    nb.save(nb.Nifti1Image(vol.astype(np.float32), affine), path)
+    return path
+
+
+def make_scans(tmp_path):
+    rng = np.random.default_rng(0)
+    vols = [rng.uniform(1, 2, SHAPE) for _ in range(3)]
+    for vol in vols:
+        vol[0] = 0
+    vols[1][3, 2, 1] = np.nan
+    paths = [save_scan(str(tmp_path / name), vol) for name, vol in
+             zip(['pn_B2_v1.nii', 'pn_B1_v2.nii', 'pn_B1_v1.nii'], vols)]
+    return paths, vols
+
+
+def test_build_and_load_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    paths, vols = make_scans(tmp_path)
+    badpath = save_scan(str(tmp_path / 'pn_B3_v1.nii'), vols[0], np.diag([3., 3., 3., 1.]))
+    outdir = str(tmp_path) + '/'
+    failures = []
+    index = cohortarray.build_cohort_array(paths + [badpath], outdir, jobs=2,
+                                           failures=failures)
+    assert list(index['codea']) == ['B1', 'B1', 'B2', 'B3']
+    assert list(index['Tp']) == [1, 2, 1, 1]
+    assert list(failures[0]['item']) == [(3, badpath)]
+
+    data, loaded, mask, affine = cohortarray.load_cohort_array(outdir)
+    assert data.dtype == np.float32 and data.shape == (4, mask.sum())
+    assert loaded.equals(index)
+    assert np.allclose(affine, AFFINE)
+    #the mask comes from the first scan in index order, pn_B1_v1
+    assert np.array_equal(mask, vols[2] != 0)
+    byname = dict(zip(paths, vols))
+    for row, path in enumerate(index['path'][:3]):
+        expected = byname[path].astype(np.float32)
+        assert np.array_equal(data[row], expected[mask], equal_nan=True)
+        vol = cohortarray.unmask(data[row], mask, fill=0)
+        assert np.array_equal(vol, np.where(mask, expected, 0), equal_nan=True)
+    assert np.isnan(data[3]).all()
+
+
+def test_roi_means_match_dense(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    paths, vols = make_scans(tmp_path)
+    atlas = np.zeros(SHAPE, dtype=np.int16)
+    atlas[1:3] = 4
+    atlas[3:] = 7
+    atlaspath = str(tmp_path / 'atlas.nii')
+    nb.save(nb.Nifti1Image(atlas, AFFINE), atlaspath)
+    index, roitbl = cohortarray.cohortarray_run(paths, str(tmp_path) + '/', atlaspath=atlaspath,
+                                                lut={'front': 4, 'back': 7, 'none': 9})
+    byname = dict(zip(paths, vols))
+    for row, path in enumerate(index['path']):
+        vol = byname[path].astype(np.float32).astype(np.float64)
+        assert np.isclose(roitbl['front'][row], np.nanmean(vol[atlas == 4]))
+        assert np.isclose(roitbl['back'][row], np.nanmean(vol[atlas == 7]))
+    assert roitbl['none'].isnull().all()
+    assert list(roitbl.columns) == ['codea', 'Tp', 'front', 'back', 'none']
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import common_funcs as cf
+
+
+def test_subject_slopes_matches_polyfit():
+    tbl = pd.DataFrame({'codea': ['B1', 'B1', 'B1', 'B2', 'B2', 'B3'],
+                        't': [0., 1., 3., 2., 5., 1.],
+                        'y': [1e6 + 1, 1e6 + 2.5, 1e6 + 4, 7., 8., 3.]})
+    slopes = cf.subject_slopes(tbl, 'codea', 't', ['y'])
+    sl, intercept = np.polyfit([0., 1., 3.], [1e6 + 1, 1e6 + 2.5, 1e6 + 4], 1)
+    assert np.isclose(slopes.loc['B1', 'y_sl'], sl)
+    assert np.isclose(slopes.loc['B1', 'y_int'], intercept)
+    assert np.isclose(slopes.loc['B2', 'y_sl'], 1. / 3)
+    assert np.isnan(slopes.loc['B3', 'y_sl'])
+
+
+def test_rate_of_change():
+    dates = pd.to_datetime(['2010-01-01', '2012-01-01', '2011-01-01', '2013-01-01', '2010-06-01'])
+    tbl = pd.DataFrame({'codeb': ['B1', 'B1', 'B2', 'B2', 'B3'], 'NP_Tp': [2, 1, 1, 2, 1],
+                        'NP_Date': dates, 'score': [20., 18., 5., 9., np.nan]})
+    before = tbl.copy()
+    out = cf.rate_of_change(tbl, 'codeb', 'NP_Tp', 'NP_Date', 'score', 'score_sl')
+    assert tbl.equals(before)
+    assert list(out['NP_Tp']) == [1, 2, 1, 2, 1]
+    years = (dates[0] - dates[1]).days / 365.25
+    assert np.allclose(out.loc[out['codeb'] == 'B1', 'score_sl'], 2. / years)
+    assert np.isnan(out.loc[out['codeb'] == 'B3', 'score_sl']).all()
+
+
+def test_aggregate_per_sub():
+    tbl = pd.DataFrame({'codeb': ['B1', 'B1', 'B2', None], 'NP_Tp': [2, 1, 1, 1],
+                        'score': [1., np.nan, 3., 4.]})
+    out = cf.aggregate_per_sub(tbl, 'codeb', {'n': ('codeb', 'count'),
+                                              'first': ('score', 'first'),
+                                              'last': ('score', 'last'),
+                                              'top': ('score', 'max'),
+                                              'span': ('NP_Tp', 'span')}, 'NP_Tp')
+    assert 'n' not in tbl.columns
+    assert list(out['n']) == [2, 2, 1, 0]
+    assert out['n'].dtype.kind == 'i'
+    #B1's first timepoint is the second row, whose score is missing
+    expected = pd.DataFrame({'first': [np.nan, np.nan, 3., np.nan],
+                             'last': [1., 1., 3., np.nan],
+                             'top': [1., 1., 3., np.nan],
+                             'span': [1., 1., 0., np.nan]})
+    pd.testing.assert_frame_equal(out[list(expected.columns)], expected, check_dtype=False)
+
+
+def test_get_id_keeps_every_digit():
+    assert cf.get_id('pn_B00012_v1.nii.gz') == 'B00012'
+    assert cf.get_id('B12_v2.long.B12_base') == 'B12'
+    assert cf.get_id('B1_v2') != cf.get_id('B12_v2')
+    assert cf.get_id('template.nii') is None
+
+
+def test_subject_ids_agree():
+    from datapipeline.tools import subjindex
+    from datapipeline.gather import fdg
+    names = ['B1_v1', 'B12_v2.long.B12_base', 'B00012_base']
+    assert [subjindex.parse_subdir(n)['codea'] for n in names] == ['B1', 'B12', 'B00012']
+    paths = ['/data/B1/pn_B1_v1.nii', '/data/B12/v2/pn.nii', '/data/B00012/pn_v1.nii']
+    info = fdg.scan_info(paths, readheaders=False)
+    assert list(info['codea']) == ['B1', 'B12', 'B00012']
+
+
+def test_linregressTEK():
+    from scipy import stats
+    rng = np.random.default_rng(2)
+    tbl = pd.DataFrame({'x': rng.standard_normal(40), 'age': rng.uniform(60, 80, 40),
+                        'flat': np.zeros(40)})
+    tbl['a'] = 2 * tbl['x'] + rng.standard_normal(40)
+    tbl['b'] = -tbl['x'] + 0.1 * tbl['age'] + rng.standard_normal(40)
+    tbl.loc[:4, 'b'] = np.nan
+    lrtbl = cf.linregressTEK(tbl, 'x', ['a', 'b', 'flat'])
+    for col in ['a', 'b']:
+        keep = tbl[col].notnull()
+        lr = stats.linregress(tbl.loc[keep, 'x'], tbl.loc[keep, col])
+        assert np.allclose(lrtbl.loc[col, ['XSslope', 'XSintercept', 'XSr_value', 'XSp_value',
+                                           'XSstd_err']].astype(float),
+                           [lr.slope, lr.intercept, lr.rvalue, lr.pvalue, lr.stderr])
+        assert np.isclose(lrtbl.loc[col, 'XSr_squared'], lr.rvalue ** 2)
+        assert lrtbl.loc[col, 'XSn'] == keep.sum()
+    #a constant outcome is not significant
+    assert lrtbl.loc['flat', 'XSslope'] == 0
+    assert lrtbl.loc['flat', ['XSr_value', 'XSp_value', 'XSstd_err']].isnull().all()
+
+    sm = pytest.importorskip('statsmodels.api')
+    lrtbl = cf.linregressTEK(tbl, 'x', ['b'], covars=['age'])
+    keep = tbl['b'].notnull()
+    fit = sm.OLS(tbl.loc[keep, 'b'], sm.add_constant(tbl.loc[keep, ['x', 'age']])).fit()
+    assert np.isclose(lrtbl.loc['b', 'XSslope'], fit.params['x'])
+    assert np.isclose(lrtbl.loc['b', 'XSstd_err'], fit.bse['x'])
+    assert np.isclose(lrtbl.loc['b', 'XSp_value'], fit.pvalues['x'])
+    assert np.isclose(lrtbl.loc['b', 'XSage_coef'], fit.params['age'])
+    assert np.isclose(lrtbl.loc['b', 'XSage_p_value'], fit.pvalues['age'])
+    assert np.isclose(lrtbl.loc['b', 'XSr_squared'], fit.rsquared)
+
+
+def test_save_xls_and_pkl(tmp_path):
+    pytest.importorskip('openpyxl')
+    tbl = pd.DataFrame({'codea': ['B1', 'B2'], 'x': [1.5, 2.5]})
+    cf.save_xls_and_pkl(tbl, 'tbl', str(tmp_path) + '/')
+    pkls = list(tmp_path.glob('tbl_*.pkl'))
+    sheets = list(tmp_path.glob('tbl_*.xls*'))
+    assert len(pkls) == 1 and len(sheets) == 1
+    assert pd.read_pickle(pkls[0]).equals(tbl)
+    assert pd.read_excel(sheets[0]).equals(tbl)
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+from datapipeline.analyze import correlations
+
+
+def test_corr_matrix_large_offset():
+    rng = np.random.default_rng(0)
+    a = 1.5e6 + 0.7 * rng.standard_normal(500)
+    tbl = pd.DataFrame({'a': a, 'b': (a - 1.5e6) + rng.standard_normal(500)})
+    tbl.loc[:20, 'b'] = np.nan
+    r, n = correlations.corr_matrix(tbl, ['a', 'b'])
+    assert np.abs(r.values - tbl.corr().values).max() < 1e-9
+    assert n.loc['a', 'b'] == 479
+
+
+def test_partial_corr_complete_case_n():
+    rng = np.random.default_rng(1)
+    tbl = pd.DataFrame(rng.standard_normal((100, 3)), columns=['x', 'y', 'z'])
+    tbl.loc[:9, 'z'] = np.nan
+    tbl.loc[90:, 'y'] = np.nan
+    pr, n, ncond = correlations.partial_corr_matrix(tbl, ['x', 'y'], covars=['z'])
+    assert ncond == 1
+    assert n.loc['x', 'y'] == 80
+    assert n.loc['x', 'x'] == 90
+
+
+def test_spearman_ranks_each_pair():
+    rng = np.random.default_rng(3)
+    tbl = pd.DataFrame(rng.standard_normal((60, 4)), columns=['a', 'b', 'c', 'd'])
+    tbl['b'] = tbl['a'] ** 3 + 0.3 * rng.standard_normal(60)
+    tbl.loc[:14, 'a'] = np.nan
+    tbl.loc[40:, 'b'] = np.nan
+    tbl.loc[::7, 'c'] = np.nan
+    #ties are given their average rank within each pair
+    tbl['d'] = rng.integers(0, 4, 60).astype(float)
+    tbl.loc[50:, 'd'] = np.nan
+    r, n = correlations.corr_matrix(tbl, list(tbl.columns), method='spearman')
+    assert np.allclose(r.values, tbl.corr(method='spearman').values)
+    assert n.loc['a', 'b'] == 25
+
+
+def test_partial_corr_small_pair_is_nan():
+    rng = np.random.default_rng(4)
+    tbl = pd.DataFrame(rng.standard_normal((50, 4)), columns=['x', 'y', 'z', 'w'])
+    #w shares only two rows with x
+    tbl.loc[2:, 'w'] = np.nan
+    tbl.loc[:0, 'x'] = np.nan
+    pr, n, ncond = correlations.partial_corr_matrix(tbl, ['x', 'y', 'w'], covars=['z'])
+    assert np.isnan(pr.loc['x', 'w'])
+    assert np.isnan(pr.loc['y', 'w'])
+    assert not np.isnan(pr.loc['x', 'y'])
+    pr, n, ncond = correlations.partial_corr_matrix(tbl, ['x', 'y', 'z', 'w'])
+    assert np.isnan(pr.values[~np.eye(4, dtype=bool)]).all()
+    corrtbl, _ = correlations.correlations_run(tbl, ['x', 'y', 'w'], covars=['z'],
+                                               method='spearman')
+    assert corrtbl.loc[(corrtbl['var1'] == 'x') & (corrtbl['var2'] == 'w'),
+                       'partial_r'].isnull().all()
@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import dag
+
+calls = []
+
+
+def make(name, value=1):
+    calls.append(name)
+    return pd.DataFrame({'x': [value]})
+
+
+def add(tbls):
+    calls.append('add')
+    return sum(tbl for tbl in tbls.values())
+
+
+def stages():
+    return {'a': dag.stage(make, 'ta', name='a'),
+            'b': dag.stage(make, 'tb', name='b', value=2),
+            'c': dag.stage(add, 'tc', needs=['ta', 'tb'], tblarg='tbls'),
+            'd': dag.stage(add, 'td', needs=['tc', 'nobody'], tblarg='tbls')}
+
+
+def test_resolve_order():
+    order, upstream = dag.resolve_order(stages(), ['c'])
+    assert order == ['a', 'b', 'c']
+    assert upstream['c'] == {'a', 'b'}
+    #d needs a table no stage makes, which only matters when d runs
+    with pytest.raises(ValueError):
+        dag.resolve_order(stages(), ['d'])
+    with pytest.raises(ValueError):
+        dag.resolve_order(stages())
+    loop = {'a': dag.stage(make, 'ta', needs=['tb']), 'b': dag.stage(make, 'tb', needs=['ta'])}
+    with pytest.raises(ValueError):
+        dag.resolve_order(loop)
+
+
+def test_fingerprint(tmp_path):
+    path = tmp_path / 'in.txt'
+    path.write_text('1')
+    tbl = pd.DataFrame({'x': np.arange(1000)})
+    spec = dag.stage(make, 'ta', inputs=[str(tmp_path)], name=tbl, jobs=1)
+    fp = dag.fingerprint(spec)
+    assert dag.fingerprint(dict(spec, kwargs=dict(spec['kwargs'], jobs=8))) == fp
+    #a change in the middle of a table is left out of its repr
+    changed = tbl.copy()
+    changed.loc[500, 'x'] = -1
+    assert repr(changed) == repr(tbl)
+    assert dag.fingerprint(dict(spec, kwargs=dict(spec['kwargs'], name=changed))) != fp
+    assert dag.fingerprint(dict(spec, func=add)) != fp
+    assert dag.fingerprint(spec, ['upstream']) != fp
+    path.write_text('22')
+    assert dag.fingerprint(spec) != fp
+
+
+def test_fingerprint_follows_code(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = tmp_path / 'stagecode.py'
+    module.write_text('def run():\n    return 1\n')
+    import stagecode
+    fp = dag.fingerprint(dag.stage(stagecode.run, 'out'))
+    module.write_text('def run():\n    return 2\n')
+    assert dag.fingerprint(dag.stage(stagecode.run, 'out')) != fp
+
+
+def test_run_dag_skips_unchanged(tmp_path):
+    cachedir = str(tmp_path / 'cache')
+    del calls[:]
+    tables = dag.run_dag(stages(), ['c'], cachedir=cachedir)
+    assert tables['tc']['x'][0] == 3
+    assert sorted(calls) == ['a', 'add', 'b']
+
+    del calls[:]
+    tables = dag.run_dag(stages(), ['c'], cachedir=cachedir)
+    assert tables['tc']['x'][0] == 3
+    assert calls == []
+
+    changed = stages()
+    changed['b']['kwargs']['value'] = 5
+    del calls[:]
+    tables = dag.run_dag(changed, ['c'], cachedir=cachedir)
+    assert tables['tc']['x'][0] == 6
+    assert sorted(calls) == ['add', 'b']
+
+    del calls[:]
+    dag.run_dag(changed, ['c'], cachedir=cachedir, force=True)
+    assert sorted(calls) == ['a', 'add', 'b']
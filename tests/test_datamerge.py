@@ -0,0 +1,32 @@
+import pandas as pd
+from datapipeline.merge import datamerge
+
+
+def test_count_instances_drops_rows_without_subject():
+    tbl = pd.DataFrame({'codea': ['B1', None, 'B2', 'B1'], 'PIB_Tp': [1, 1, 1, 2]})
+    out = datamerge.count_instances(tbl, 'codea', 'PIB_NoTps')
+    assert list(out['codea']) == ['B1', 'B2', 'B1']
+    assert list(out['PIB_NoTps']) == [2, 1, 2]
+
+
+def test_nearest_visit_tolerance_and_ties():
+    visits = pd.DataFrame({'codea': ['B1', 'B1', 'B2', None, 'B2', 'B3'],
+                           'NP_Date': pd.to_datetime(['2010-01-11', '2010-03-01', '2011-01-01',
+                                                      '2011-01-01', None, '2012-01-01']),
+                           'score': [1, 2, 3, 4, 5, 6]})
+    scans = pd.DataFrame({'codea': ['B1', 'B1', 'B2', 'B2'],
+                          'PIB_Scandate': pd.to_datetime(['2010-01-21', '2010-01-01',
+                                                          '2010-12-02', '2011-02-01']),
+                          'PIB_Tp': [2, 1, 1, 2],
+                          'score': [9, 9, 9, 9]})
+    out = datamerge.nearest_visit(visits, scans, 'NP_Date', 'PIB_Scandate', 30)
+    #B1 is 10 days from both scans, B2 is 30 days after one and 31 before the other
+    expected = visits.copy()
+    expected['PIB_Scandate'] = pd.to_datetime(['2010-01-01', None, '2010-12-02', None, None,
+                                               None])
+    expected['PIB_Tp'] = [1, None, 1, None, None, None]
+    expected['PIB_GapDays'] = [-10, None, -30, None, None, None]
+    pd.testing.assert_frame_equal(out, expected, check_dtype=False)
+
+    out = datamerge.nearest_visit(visits, scans, 'NP_Date', 'PIB_Scandate', 29)
+    assert list(out['PIB_Tp'].notnull()) == [True, False, False, False, False, False]
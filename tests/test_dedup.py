@@ -0,0 +1,56 @@
+import os
+import numpy as np
+from datapipeline.tools import dedup
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def test_find_duplicates(tmp_path, monkeypatch):
+    root = str(tmp_path) + '/'
+    data = np.random.default_rng(0).bytes(1024 * 1024)
+    #differs from data only between the sampled blocks
+    changed = bytearray(data)
+    changed[100000] ^= 0xff
+    paths = [write(root + 'b/c/pn_B1_v1.nii', data),
+             write(root + 'a/pn_B1_v1.nii', data),
+             write(root + 'a/pn_B1_v2.nii', bytes(changed)),
+             write(root + 'a/pn_B2_v1.nii', data[:1000]),
+             write(root + 'pn_B1_v1.nii', data),
+             root + 'missing.nii']
+    assert dedup.sample_hash(paths[2]) == dedup.sample_hash(paths[1])
+    assert dedup.full_hash(paths[2]) != dedup.full_hash(paths[1])
+
+    hashed = []
+    full_hash = dedup.full_hash
+    monkeypatch.setattr(dedup, 'full_hash', lambda path: hashed.append(path) or full_hash(path))
+    failures = []
+    dups = dedup.find_duplicates(paths, jobs=2, failures=failures)
+    assert sorted(hashed) == sorted(paths[:3] + paths[4:5])
+    assert list(dups['path']) == paths
+    #the copy fewest folders deep is kept
+    assert list(dups['canonical']) == [paths[4], paths[4]] + paths[2:]
+    assert list(dups['duplicate']) == [True, True, False, False, False, False]
+    assert list(dups['digest'].isnull()) == [False, False, False, True, False, True]
+    assert dups['size'][0] == len(data) and np.isnan(dups['size'][5])
+    assert failures == []
+
+
+def test_unreadable_files_are_unique(tmp_path, monkeypatch):
+    root = str(tmp_path) + '/'
+    paths = [write(root + name, b'x' * 10) for name in ['a.nii', 'b.nii', 'c.nii']]
+
+    def sample_hash(path):
+        if path.endswith('b.nii'):
+            raise IOError('unreadable')
+        return 'same'
+    monkeypatch.setattr(dedup, 'sample_hash', sample_hash)
+    failures = []
+    dups = dedup.find_duplicates(paths, failures=failures)
+    assert list(dups['duplicate']) == [False, False, True]
+    assert list(dups['canonical']) == [paths[0], paths[1], paths[0]]
+    assert list(failures[0]['item']) == [paths[1]]
@@ -0,0 +1,18 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.gather import factoranalysis
+
+
+def test_factorscores_weight_each_test(tmp_path):
+    pytest.importorskip('openpyxl')
+    tests = ['Digit Span', 'Trails B']
+    subjdata = pd.DataFrame({'Digit Span': [1., -1.], 'Trails B': [0.5, 2.]},
+                            index=pd.MultiIndex.from_tuples([('x1', 'sess1'), ('x1', 'sess2')],
+                                                            names=['major', 'minor']))
+    wpth = str(tmp_path / 'weights.xlsx')
+    pd.DataFrame({'Digit Span': [0.5, -1.], 'Trails B': [2., 0.]}).to_excel(wpth, index=False)
+    scores = factoranalysis.factorscores(subjdata, wpth, tests)
+    assert list(scores['Tp']) == ['1', '2']
+    assert np.allclose(scores['F0'], [0.5 + 1., -0.5 + 4.])
+    assert np.allclose(scores['F1'], [-1., 1.])
@@ -0,0 +1,100 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import dedup
+from datapipeline.gather import fdg
+
+nb = pytest.importorskip('nibabel')
+SHAPE = (6, 5, 4)
+
+
+def save_scan(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    nb.save(nb.Nifti1Image(np.full(SHAPE, value, dtype=np.float32), np.eye(4)), path)
+
+
+def make_atlas(path):
+    labels = np.zeros(SHAPE, dtype=np.int16)
+    labels[:3] = 1
+    labels[3:] = 2
+    nb.save(nb.Nifti1Image(labels, np.eye(4)), path)
+
+
+def test_copies_keyed_by_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    datadir = str(tmp_path / 'data') + '/'
+    save_scan(datadir + '20150101/pn_B1.nii', 1.)
+    save_scan(datadir + '20160101/pn_B1.nii', 2.)
+    #a copy of the second scan filed under a later date
+    save_scan(datadir + 'backup/20170101/pn_B1.nii', 2.)
+    atlas = str(tmp_path / 'atlas.nii')
+    make_atlas(atlas)
+    fdgfold = str(tmp_path / 'fdg') + '/'
+    os.makedirs(fdgfold)
+
+    vals, tbl = fdg.fdg_run(datadir, fdgfold, atlas, str(tmp_path) + '/', 'pn*',
+                            atlas=atlas, lut={'A': 1, 'B': 2})
+    rundir, = [os.path.join(fdgfold, d) for d in os.listdir(fdgfold)]
+    assert len(os.listdir(os.path.join(rundir, 'W'))) == 2
+    assert len(vals) == 2
+    assert list(tbl['FDG_Scandate'].dt.year) == [2015, 2016, 2017]
+    assert list(tbl['FDG_Tp']) == [1, 2, 3]
+    assert list(tbl['A_mean']) == [1., 2., 2.]
+    assert list(tbl['B_nvox']) == [60, 60, 60]
+    assert np.allclose(tbl['A_mean_sl'], 0.5, rtol=0.01)
+
+
+def test_generate_df_adds_duplicates(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    datadir = str(tmp_path / 'data') + '/'
+    sources = [datadir + 'pn_B1_v1.nii', datadir + 'pn_B2_v1.nii']
+    save_scan(sources[0], 1.)
+    save_scan(sources[1], 3.)
+    save_scan(datadir + 'old/pn_B1_v2.nii', 1.)
+    dups = dedup.find_duplicates(sources + [datadir + 'old/pn_B1_v2.nii'])
+    maskdir = str(tmp_path / 'J') + '/'
+    vals = dict((maskdir + 'mi_' + fdg.copy_name(p) + '.gz', v)
+                for p, v in zip(sources, ['1.0\n', '3.0\n']))
+    tbl = fdg.generate_df(vals, str(tmp_path) + '/', sources, dups)
+    expected = pd.DataFrame({'codea': ['B1', 'B1', 'B2'], 'FDG_Tp': [1, 2, 1],
+                             'FDG_val': [1., 1., 3.]})
+    pd.testing.assert_frame_equal(tbl[['codea', 'FDG_Tp', 'FDG_val']], expected)
+
+
+def test_atlas_values_match_dense(tmp_path):
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 4, SHAPE).astype(np.int16)
+    atlas = str(tmp_path / 'atlas.nii')
+    nb.save(nb.Nifti1Image(labels, np.eye(4)), atlas)
+    vols = [rng.uniform(0.5, 2, SHAPE) for _ in range(2)]
+    vols[1][labels == 2] = np.nan
+    vols[1][tuple(np.argwhere(labels == 1)[:3].T)] = np.inf
+    scans = []
+    for i, vol in enumerate(vols):
+        scans.append(str(tmp_path / ('pn_B%d_v1.nii' %(i + 1))))
+        nb.save(nb.Nifti1Image(vol.astype(np.float32), np.eye(4)), scans[-1])
+    bad = str(tmp_path / 'pn_B9_v1.nii')
+    nb.save(nb.Nifti1Image(np.ones((3, 3, 3), dtype=np.float32), np.eye(4)), bad)
+    lut = {'ctx': 1, 'wm': 2, 'pons': 3, 'empty': 5}
+
+    failures = []
+    tbl = fdg.generate_atlas_values(scans + [bad], atlas, lut, refregion='pons', jobs=2,
+                                    failures=failures)
+    assert list(failures[0]['item']) == [bad]
+    assert list(tbl['codea']) == ['B1', 'B2']
+    for row, vol in enumerate(vols):
+        vol = vol.astype(np.float32).astype(np.float64)
+        refmean = vol[labels == 3].mean()
+        for name, value in lut.items():
+            vals = vol[labels == value]
+            vals = vals[np.isfinite(vals)]
+            assert tbl['%s_nvox' %name][row] == len(vals)
+            if len(vals) == 0:
+                assert tbl[['%s_mean' %name, '%s_median' %name]].iloc[row].isnull().all()
+                continue
+            assert np.isclose(tbl['%s_mean' %name][row], vals.mean())
+            assert np.isclose(tbl['%s_median' %name][row], np.median(vals))
+            assert np.isclose(tbl['%s_std' %name][row], vals.std(ddof=1))
+            assert np.isclose(tbl['%s_suvr' %name][row], vals.mean() / refmean)
@@ -0,0 +1,34 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+#libraries only the functions that need them should import
+HEAVY = ['nibabel', 'scipy', 'matplotlib', 'statsmodels', 'yaml']
+PROBE = """
+import sys, json, importlib, pkgutil
+import datapipeline
+names = ['datapipeline.merge.datamerge', 'datapipeline.__main__']
+for pkg in ['tools', 'gather', 'merge', 'analyze']:
+    path = ['%s/datapipeline/' %sys.argv[1] + pkg]
+    names += ['datapipeline.%s.%s' %(pkg, m.name) for m in pkgutil.iter_modules(path)]
+loaded = {}
+for name in names:
+    importlib.import_module(name)
+    for lib in sys.argv[2:]:
+        if lib in sys.modules:
+            loaded.setdefault(lib, name)
+print(json.dumps({'modules': names, 'loaded': loaded}))
+"""
+
+
+def test_imports_leave_out_heavy_libraries():
+    out = subprocess.run([sys.executable, '-c', PROBE, ROOT] + HEAVY, cwd=ROOT,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    assert out.returncode == 0, out.stderr
+    res = json.loads(out.stdout.strip().splitlines()[-1])
+    assert 'datapipeline.merge.datamerge' in res['modules']
+    #each library is reported with the first module that loaded it
+    assert res['loaded'] == {}
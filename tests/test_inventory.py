@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import inventory
+
+nb = pytest.importorskip('nibabel')
+AFFINE = np.array([[-2., 0, 0, 90], [0, 2., 0, -126], [0, 0, 2., -72], [0, 0, 0, 1]])
+
+
+def image(cls, shape=(10, 12, 8)):
+    return cls(np.arange(np.prod(shape), dtype=np.float32).reshape(shape), AFFINE)
+
+
+def test_big_endian_header(tmp_path):
+    img = image(nb.Nifti1Image)
+    hdr = img.header.as_byteswapped('>')
+    path = str(tmp_path / 'pn_B1_v1.nii')
+    with open(path, 'wb') as f:
+        hdr.write_to(f)
+        f.write(b'\0' * (int(hdr['vox_offset']) - f.tell()))
+        f.write(np.asarray(img.dataobj).astype('>f4').tobytes(order='F'))
+    assert nb.load(path).header.endianness == '>'
+    info = inventory.read_header(path)
+    assert info['format'] == 'nifti1'
+    assert info['shape'] == '10x12x8'
+    assert info['zooms'] == '2x2x2'
+    assert info['orientation'] == 'LAS'
+    assert info['dtype'] == '>f4'
+
+
+@pytest.mark.parametrize('cls,fmt', [(nb.Nifti1Pair, 'nifti1'), (nb.AnalyzeImage, 'analyze')])
+def test_pair_reads_hdr(tmp_path, cls, fmt):
+    path = str(tmp_path / 'pn_B1_v1.img')
+    nb.save(image(cls), path)
+    info = inventory.read_header(path)
+    assert info['format'] == fmt
+    assert info['shape'] == '10x12x8'
+    assert info['zooms'] == '2x2x2'
+
+
+def test_inventory_lists_pairs_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    fdgdir = tmp_path / 'fdg'
+    fdgdir.mkdir()
+    nb.save(image(nb.Nifti1Pair), str(fdgdir / 'pn_B1_v1.img'))
+    nb.save(image(nb.Nifti1Image), str(fdgdir / 'pn_B2_v1.nii.gz'))
+    inv = inventory.inventory_run(str(tmp_path) + '/', fdgdir=str(fdgdir) + '/', strict=True)
+    assert sorted(p.rsplit('/', 1)[1] for p in inv['path']) == ['pn_B1_v1.img',
+                                                                'pn_B2_v1.nii.gz']
+    assert inv['geometry_ok'].all()
+    assert list(inv['codea']) == ['B1', 'B2']
@@ -0,0 +1,31 @@
+import os
+from datapipeline.tools import journal
+
+
+def test_append_does_not_reread(tmp_path, monkeypatch):
+    path = str(tmp_path / 'work.journal')
+    reads = []
+    read = journal._read
+    monkeypatch.setattr(journal, '_read', lambda *args: reads.append(args) or read(*args))
+    for i in range(200):
+        journal.append(path, 't', [(i, 2 * i)])
+    assert len(reads) == 1
+    assert journal.load(path, 't') == dict((i, 2 * i) for i in range(200))
+
+
+def test_append_after_outside_change(tmp_path):
+    path = str(tmp_path / 'work.journal')
+    journal.append(path, 't', [(0, 'a'), (1, 'b')])
+    #a record cut short by a crash in another process
+    with open(path, 'ab') as f:
+        f.write(b'\x80\x04\x95')
+    journal.append(path, 't', [(2, 'c')])
+    assert journal.load(path, 't') == {0: 'a', 1: 'b', 2: 'c'}
+
+    journal.append(path, 'other', [(3, 'd')])
+    assert journal.load(path, 't') == {}
+    assert journal.load(path, 'other') == {3: 'd'}
+    journal.remove(path)
+    assert not os.path.exists(path)
+    journal.append(path, 't', [(4, 'e')])
+    assert journal.load(path, 't') == {4: 'e'}
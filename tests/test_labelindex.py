@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import labelindex
+
+nb = pytest.importorskip('nibabel')
+FS_LUT = {'Left-Hippocampus': 17, 'Right-Hippocampus': 53, 'ctx': 1000, 'absent': 99}
+
+
+def make_labels(shape=(9, 8, 7)):
+    rng = np.random.default_rng(0)
+    labels = rng.choice([0, 17, 53, 1000], size=shape, p=[0.4, 0.2, 0.2, 0.2])
+    #long runs across the end of rows, and a label only at the last voxel
+    labels[2, :, :] = 17
+    labels[-1, -1, -1] = 7
+    return labels.astype(np.int32)
+
+
+def test_index_matches_dense():
+    labels = make_labels()
+    index = labelindex.build_index(labels)
+    values = np.unique(labels[labels != 0])
+    assert list(index['labels']) == list(values)
+    for i, value in enumerate(values):
+        where = labels == value
+        assert index['counts'][i] == where.sum()
+        assert np.array_equal(labelindex.label_voxels(index, [value]), np.flatnonzero(where))
+        ijk = np.argwhere(where)
+        assert list(index['bbox'][i]) == list(ijk.min(axis=0)) + list(ijk.max(axis=0))
+    both = np.isin(labels, [17, 1000])
+    assert np.array_equal(labelindex.label_voxels(index, [1000, 17, 99]), np.flatnonzero(both))
+    box = labelindex.label_bbox(index, [7])
+    assert box == (slice(8, 9), slice(7, 8), slice(6, 7))
+    assert labelindex.label_bbox(index, [99]) is None
+
+
+def test_region_means_match_dense(tmp_path):
+    labels = make_labels()
+    aparcpath = str(tmp_path / 'aparc+aseg.nii')
+    nb.save(nb.Nifti1Image(labels, np.eye(4)), aparcpath)
+    img = np.random.default_rng(1).normal(size=labels.shape)
+    img[tuple(np.argwhere(labels == 53)[:5].T)] = np.nan
+    imgpath = str(tmp_path / 'fdg.nii')
+    nb.save(nb.Nifti1Image(img, np.eye(4)), imgpath)
+
+    index = labelindex.label_index(aparcpath)
+    regions = {'Hippocampus': ['Left-Hippocampus', 'Right-Hippocampus'], 'ctx': ['ctx'],
+               'last': [7], 'absent': ['absent']}
+    means = labelindex.region_means(index, imgpath, regions, FS_LUT)
+    for name, members in [('Hippocampus', [17, 53]), ('ctx', [1000]), ('last', [7])]:
+        vals = img[np.isin(labels, members)]
+        assert np.isclose(means[name], np.nanmean(vals))
+    assert np.isnan(means['absent'])
+    vols = labelindex.region_volumes(index, regions, FS_LUT)
+    assert vols == {'Hippocampus': int(np.isin(labels, [17, 53]).sum()),
+                    'ctx': int((labels == 1000).sum()), 'last': 1, 'absent': 0}
+    #a missing label next to one that is present counts nothing
+    vols = labelindex.region_volumes(index, {'ctx': [99, 1000]}, FS_LUT)
+    assert vols == {'ctx': int((labels == 1000).sum())}
+
+    small = str(tmp_path / 'small.nii')
+    nb.save(nb.Nifti1Image(img[:-1], np.eye(4)), small)
+    with pytest.raises(ValueError):
+        labelindex.region_means(index, small, regions, FS_LUT)
+
+
+def test_sidecar_is_reused_until_the_labels_change(tmp_path, monkeypatch):
+    aparcpath = str(tmp_path / 'aparc+aseg.nii')
+    nb.save(nb.Nifti1Image(make_labels(), np.eye(4)), aparcpath)
+    cachedir = str(tmp_path / 'cache')
+    index = labelindex.label_index(aparcpath, cachedir)
+    sidecar = labelindex.sidecar_path(aparcpath, cachedir)
+    assert os.path.isfile(sidecar)
+
+    reads = []
+    preproc_aparc = cf.preproc_aparc
+    monkeypatch.setattr(cf, 'preproc_aparc', lambda path: reads.append(path) or preproc_aparc(path))
+    again = labelindex.label_index(aparcpath, cachedir)
+    assert reads == []
+    for key in ['labels', 'counts', 'bbox', 'runptr', 'runstart', 'runlen', 'shape']:
+        assert np.array_equal(again[key], index[key])
+
+    labels = make_labels()
+    labels[labels == 53] = 0
+    nb.save(nb.Nifti1Image(labels, np.eye(4)), aparcpath)
+    os.utime(aparcpath, ns=(1, 1))
+    index = labelindex.label_index(aparcpath, cachedir)
+    assert reads == [aparcpath]
+    assert 53 not in index['labels']
+    assert not [name for name in os.listdir(cachedir) if '.tmp' in name]
@@ -0,0 +1,47 @@
+import glob
+import pandas as pd
+import pytest
+from datapipeline import __main__ as cli
+
+yaml = pytest.importorskip('yaml')
+pytest.importorskip('openpyxl')
+
+
+def write_config(tmp_path):
+    codetblpath = str(tmp_path / 'codes.xlsx')
+    pd.DataFrame({'codeaGRAB': ['B1', 'B2', None], 'codeb': [10012, 10015, 10020]}).to_excel(
+        codetblpath, index=False)
+    config = {'outdir': str(tmp_path / 'out'),
+              'codetranslator': {'codetblpath': codetblpath},
+              'datamerge': {'roc_cols': []}}
+    path = str(tmp_path / 'config.yaml')
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def test_no_command_prints_help(capsys):
+    assert cli.main([]) == 1
+    assert 'usage: python -m datapipeline' in capsys.readouterr().out
+
+
+def test_runs_one_stage(tmp_path, capsys):
+    config = write_config(tmp_path)
+    assert cli.main(['codetranslator', config, '-j', '2']) == 0
+    assert 'Running codetranslator' in capsys.readouterr().out
+    assert len(glob.glob(str(tmp_path / 'out' / 'codetranslator_*.pkl'))) == 1
+
+    assert cli.main(['codetranslator', config, '--only-new']) == 0
+    assert 'codetranslator unchanged' in capsys.readouterr().out
+
+    assert cli.main(['codetranslator', config, '--only-new', '--quiet']) == 0
+    assert capsys.readouterr().out == ''
+
+
+def test_unset_stage_is_an_error(tmp_path, capsys):
+    config = write_config(tmp_path)
+    with pytest.raises(SystemExit) as err:
+        cli.main(['fdg', config])
+    assert err.value.code == 2
+    assert 'fdg is not set up in' in capsys.readouterr().err
+    assert not (tmp_path / 'out').exists()
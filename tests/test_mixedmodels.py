@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.analyze import mixedmodels
+
+smf = pytest.importorskip('statsmodels.formula.api')
+
+
+def make_table(nsub=40, ntp=4):
+    rng = np.random.default_rng(0)
+    rows = []
+    for s in range(nsub):
+        pos = s % 2
+        b0, b1 = rng.normal(0, 1.), rng.normal(0, 0.3)
+        for tp in range(ntp):
+            t = tp + rng.uniform(-0.2, 0.2)
+            rows.append({'codeb': 10000 + s, 'NP_YrsRelBL': t, 'PIB_Pos': pos,
+                         'F0': 2 + b0 + 0.3 * pos + (0.5 - 0.4 * pos + b1) * t
+                               + rng.normal(0, 0.5)})
+    #a subject with too few sessions and a missing outcome
+    rows.append({'codeb': 20000, 'NP_YrsRelBL': 0., 'PIB_Pos': 0, 'F0': 9.})
+    rows[5]['F0'] = np.nan
+    return pd.DataFrame(rows)
+
+
+def test_matches_statsmodels_mixedlm():
+    tbl = make_table()
+    lmmtbl, restbl, slopetbl = mixedmodels.mixedmodels_run(
+        tbl, ['F0'], 'NP_YrsRelBL + PIB_Pos*NP_YrsRelBL')
+    fixed = lmmtbl[lmmtbl['kind'] == 'fixed'].set_index('term')
+    varcomp = lmmtbl[lmmtbl['kind'] == 'varcomp'].set_index('term')['estimate']
+
+    modeled = tbl[(tbl['codeb'] != 20000) & tbl['F0'].notnull()]
+    ref = smf.mixedlm('F0 ~ NP_YrsRelBL + PIB_Pos + PIB_Pos:NP_YrsRelBL', modeled,
+                      groups=modeled['codeb'], re_formula='~NP_YrsRelBL').fit(reml=True)
+    assert np.allclose(fixed['estimate'], ref.fe_params, rtol=1e-4)
+    assert np.allclose(fixed['std_err'], ref.bse_fe, rtol=1e-3)
+    cov = ref.cov_re.values
+    assert np.isclose(varcomp['sd_intercept'], np.sqrt(cov[0, 0]), rtol=1e-3)
+    assert np.isclose(varcomp['sd_slope'], np.sqrt(cov[1, 1]), rtol=1e-3)
+    assert np.isclose(varcomp['corr_intercept_slope'],
+                      cov[0, 1] / np.sqrt(cov[0, 0] * cov[1, 1]), atol=1e-3)
+    assert np.isclose(varcomp['sd_residual'], np.sqrt(ref.scale), rtol=1e-4)
+    assert np.isclose(lmmtbl['reml'][0], ref.llf, atol=1e-4)
+    assert (lmmtbl['nobs'] == len(modeled)).all()
+
+    assert len(restbl) == len(tbl) - 1
+    assert restbl['F0_resid'].isnull().sum() == 1
+    assert np.allclose(restbl['F0_resid'].dropna(), ref.resid, atol=1e-3)
+    assert len(slopetbl) == 40
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+import pandas as pd
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import mri
+
+
+def write_subject(root, sub, volumes, date=None):
+    os.makedirs(os.path.join(root, sub, 'stats'))
+    with open(os.path.join(root, sub, 'stats', 'aseg.stats'), 'w') as f:
+        f.write('# Measure IntraCranialVol, ICV, Intracranial Volume, 1500000.0, mm^3\n')
+        f.write('# ColHeaders  Index SegId NVoxels Volume_mm3 StructName\n')
+        for i, (roi, vol) in enumerate(sorted(volumes.items())):
+            f.write('%3d %4d %8d %10.1f %s\n' %(i + 1, 17 + i, 0, vol, roi))
+    if date is not None:
+        os.makedirs(os.path.join(root, sub, 'scripts'))
+        with open(os.path.join(root, sub, 'scripts', 'recon-all.log'), 'w') as f:
+            f.write('%s\nsynthetic\n\n-i /data/raw/%s_mprage.nii -all\n' %(sub, date))
+
+
+def test_mri_run_long_stream(tmp_path, monkeypatch):
+    saved = {}
+    monkeypatch.setattr(cf, 'save_xls_and_pkl',
+                        lambda tbl, name, path, overwriteold=False: saved.update({name: tbl}))
+    datadir = str(tmp_path / 'subjects') + '/'
+    outdir = str(tmp_path / 'out') + '/'
+    os.makedirs(outdir)
+    #B1 loses 100 mm^3 a year, B2 has one timepoint
+    visits = [('B1', 1, '20100101', 4000.), ('B1', 2, '20120101', 3800.),
+              ('B1', 3, '20130101', 3700.), ('B2', 1, '20110601', 4200.)]
+    for codea, tp, date, vol in visits:
+        #the cross-sectional run holds the scan date, the long run the volumes
+        write_subject(datadir, '%s_v%d' %(codea, tp), {'Left-Hippocampus': vol + 50}, date)
+        write_subject(datadir, '%s_v%d.long.%s_base' %(codea, tp, codea),
+                      {'Left-Hippocampus': vol})
+    for codea in ['B1', 'B2']:
+        write_subject(datadir, '%s_base' %codea, {'Left-Hippocampus': 0.})
+
+    aseg_stats, aseg_change = mri.mri_run(datadir, outdir, ['Left-Hippocampus'],
+                                          stream='long')
+
+    assert len(aseg_change) == 4
+    assert (aseg_change['MRI_Stream'] == 'long').all()
+    b1 = aseg_change[aseg_change['codea'] == 'B1']
+    assert list(b1['Left-Hippocampus']) == [4000., 3800., 3700.]
+    years = (pd.to_datetime(['2010-01-01', '2012-01-01', '2013-01-01'])
+             - pd.Timestamp('2010-01-01')).days / 365.25
+    assert np.allclose(b1['Left-Hippocampus_sl'], np.polyfit(years, b1['Left-Hippocampus'], 1)[0])
+    assert aseg_change.loc[aseg_change['codea'] == 'B2', 'Left-Hippocampus_sl'].isnull().all()
+    assert np.allclose(aseg_change['Left-Hippocampus_icvcorr'],
+                       aseg_change['Left-Hippocampus'] / 1500000.)
+    assert set(saved) == {'aseg_stats', 'aseg_change'}
+    assert not os.path.exists(outdir + 'mri_stats.journal')
+
+
+def test_long_stream_needs_base(tmp_path):
+    datadir = str(tmp_path) + '/'
+    for codea in ['B1', 'B2']:
+        write_subject(datadir, '%s_v1.long.%s_base' %(codea, codea), {'Left-Hippocampus': 4000.})
+    write_subject(datadir, 'B1_base', {'Left-Hippocampus': 0.})
+    aseg_stats = mri.extract_stream_stats(datadir, 'long')
+    assert list(aseg_stats['codea']) == ['B1']
+    assert list(aseg_stats['MRI_Base']) == ['B1_base']
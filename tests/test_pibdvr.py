@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.gather import pibdvr
+from datapipeline.gather import pibparams
+
+FRAMETIMES = [[0, 1], [1, 2], [2, 3], [3, 5], [5, 10], [10, 20], [20, 30], [30, 40],
+              [40, 50], [50, 60], [60, 70], [70, 80], [80, 90]]
+
+
+@pytest.fixture
+def scan(tmp_path):
+    #known DVRs in two cortical parcels and one subcortical region, 8 is the reference
+    nb = pytest.importorskip('nibabel')
+    mid = pibdvr.frame_midtimes(FRAMETIMES)
+    ref = 10 * mid * np.exp(-mid / 15) + 0.5
+    labels = np.zeros((12, 10, 8), dtype=np.int32)
+    labels[1:11, 1:9, 0:2] = 8
+    labels[1:6, 1:9, 3:7] = 1000
+    labels[6:11, 1:9, 3:7] = 2000
+    labels[1:3, 1:3, 7] = 17
+    dvr = np.ones(labels.shape)
+    dvr[labels == 1000] = 1.2
+    dvr[labels == 2000] = 1.6
+    dvr[labels == 17] = 3.0
+    framespath = str(tmp_path / 'pib_B1_v1.nii')
+    atlaspath = str(tmp_path / 'aparc+aseg.nii')
+    nb.save(nb.Nifti1Image((dvr[..., None] * ref).astype(np.float32), np.eye(4)), framespath)
+    nb.save(nb.Nifti1Image(labels, np.eye(4)), atlaspath)
+    return framespath, atlaspath, pibdvr.frame_midtimes(FRAMETIMES)
+
+
+def test_pib_index_defaults_to_cortex(scan):
+    framespath, atlaspath, midtimes = scan
+    stats = pibdvr.subject_dvr((framespath, atlaspath), midtimes, 20)
+    assert np.isclose(stats['17_DVR'], 3.0)
+    assert np.isclose(stats['PIB_Index'], (1.2 + 1.6) / 2)
+
+
+def test_pib_index_leaves_out_reference(scan):
+    framespath, atlaspath, midtimes = scan
+    lut = {'Left-Cerebellum-Cortex': 8, 'ctx-lh': 1000, 'ctx-rh': 2000, 'Thal': 17}
+    stats = pibdvr.subject_dvr((framespath, atlaspath), midtimes, 20, lut=lut,
+                               indexrois=['ctx-lh', 'Left-Cerebellum-Cortex'])
+    assert np.isclose(stats['PIB_Index'], 1.2)
+
+
+def test_add_dvr():
+    sheet = pd.DataFrame({'codea': ['B1', 'B2'], 'PIB_Tp': [1, 1], 'PIB_Index': [9., 1.3]})
+    dvrtbl = pd.DataFrame({'codea': ['B1', 'B3'], 'PIB_Tp': [1., 2.], 'PIB_Index': [1.4, 1.1]})
+    merged = pibparams.add_dvr(sheet, dvrtbl).set_index(['codea', 'PIB_Tp'])
+    assert merged.index.get_level_values('PIB_Tp').dtype == sheet['PIB_Tp'].dtype
+    assert merged.loc[('B1', 1), 'PIB_Index'] == 1.4
+    assert merged.loc[('B1', 1), 'PIB_IndexSource'] == 'dvr'
+    assert merged.loc[('B2', 1), 'PIB_IndexSource'] == 'sheet'
+    assert len(merged) == 3
+
+    with pytest.raises(ValueError):
+        pibparams.add_dvr(sheet, pd.concat([dvrtbl, dvrtbl]))
+    with pytest.raises(ValueError):
+        pibparams.add_dvr(sheet, dvrtbl.assign(PIB_Tp=[1., np.nan]))
+
+
+def test_pibparams_run(tmp_path, monkeypatch):
+    pytest.importorskip('openpyxl')
+    saved = {}
+    monkeypatch.setattr(cf, 'save_xls_and_pkl',
+                        lambda tbl, name, path, overwriteold=False: saved.update({name: tbl}))
+    sheet = pd.DataFrame({'codea': ['B1', 'B1', 'B2'], 'PIB_Tp': [1, 2, 1],
+                          'PIB_Scandate': pd.to_datetime(['2010-01-01', '2012-01-01',
+                                                          '2011-01-01']),
+                          'PIB_Age': [70., 72., 65.], 'PIB_Index': [1.0, 1.2, 1.5]})
+    path = str(tmp_path / 'pib.xlsx')
+    with pd.ExcelWriter(path) as writer:
+        sheet[sheet['PIB_Tp'] == 1].to_excel(writer, sheet_name='i', index=False)
+        sheet[sheet['PIB_Tp'] > 1].to_excel(writer, sheet_name='j', index=False)
+    pib_df = pibparams.pibparams_run(path, dict((c, c) for c in sheet.columns),
+                                     str(tmp_path) + '/', 1.08)
+    pib_df = pib_df.set_index(['codea', 'PIB_Tp'])
+    assert list(pib_df['PIB_Pos']) == [0, 1, 1]
+    assert list(pib_df['PIB_agepos']) == [72., 72., 65.]
+    assert np.isclose(pib_df.loc[('B1', 1), 'PIB_sl'], 0.2 / (730 / 365.25))
+    assert 'pibparams' in saved
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+from datapipeline.tools import common_funcs as cf
+from datapipeline.tools import labelindex
+from datapipeline.gather import pvc
+
+nb = pytest.importorskip('nibabel')
+ndimage = pytest.importorskip('scipy.ndimage')
+ZOOMS = (2., 2., 2.)
+FWHM = 8.
+LUT = {'Pons': 2, 'wm': 3, 'ctx': 17, 'putamen': 12}
+TRUE = {'Pons': 1., 'wm': 2., 'ctx': 5., 'putamen': 3.}
+
+
+def make_phantom(shape=(28, 26, 24)):
+    """Labels of a sphere of cortex in a shell of white matter, a small putamen
+    and a pons slab, with nothing labeled at the edges
+    """
+    ijk = np.indices(shape).astype(np.float64)
+    dist = np.sqrt(((ijk - np.array([13, 12, 13])[:, None, None, None]) ** 2).sum(axis=0))
+    labels = np.zeros(shape, dtype=np.int16)
+    labels[dist < 9] = 3
+    labels[dist < 5] = 17
+    labels[20:23, 10:14, 14:18] = 12
+    labels[3:24, 3:23, 2:4] = 2
+    return labels
+
+
+def write_subject(tmp_path, labels, name='pn_B1_v1'):
+    affine = np.diag(ZOOMS + (1.,))
+    truth = np.zeros(labels.shape)
+    for region, value in LUT.items():
+        truth[labels == value] = TRUE[region]
+    sigma = pvc.psf_sigma(FWHM, ZOOMS)
+    pet = ndimage.gaussian_filter(truth, sigma, mode='constant', truncate=pvc.TRUNCATE)
+    petpath = str(tmp_path / (name + '.nii'))
+    aparcpath = str(tmp_path / (name + '_aparc+aseg.nii'))
+    nb.save(nb.Nifti1Image(pet.astype(np.float32), affine), petpath)
+    nb.save(nb.Nifti1Image(labels, affine), aparcpath)
+    return petpath, aparcpath
+
+
+def test_transfer_matrix_matches_dense():
+    labels = make_phantom()
+    index = labelindex.build_index(labels)
+    values = list(LUT.values())
+    regions = pvc.region_volume(index, values)
+    sigma = pvc.psf_sigma(FWHM, ZOOMS)
+    gtm, nvox = pvc.transfer_matrix(index, regions, values, sigma)
+    for j, value in enumerate(values):
+        spread = ndimage.gaussian_filter((labels == value).astype(np.float64), sigma,
+                                         mode='constant', truncate=pvc.TRUNCATE)
+        for i, other in enumerate(values):
+            assert np.isclose(gtm[i, j], spread[labels == other].mean(), atol=1e-12)
+    assert list(nvox) == [(labels == v).sum() for v in values]
+
+
+def test_gtm_recovers_smoothed_phantom(tmp_path, monkeypatch):
+    monkeypatch.setattr(cf, 'save_xls_and_pkl', lambda *args, **kwargs: None)
+    labels = make_phantom()
+    pairs = [write_subject(tmp_path, labels)]
+    #a second subject missing the putamen, whose row stays NaN
+    labels = labels.copy()
+    labels[labels == 12] = 3
+    pairs.append(write_subject(tmp_path, labels, 'pn_B2_v1'))
+    tbl = pvc.pvc_run(pairs, str(tmp_path) + '/', FWHM, lut=LUT, refregion='Pons',
+                      indexrois=['ctx', 'putamen'], jobs=2)
+    assert list(tbl['codea']) == ['B1', 'B2'] and list(tbl['FDG_Tp']) == [1, 1]
+    for row in range(2):
+        for region, value in TRUE.items():
+            if row == 1 and region == 'putamen':
+                assert np.isnan(tbl['putamen_pvc'][row])
+                continue
+            assert np.isclose(tbl['%s_pvc' %region][row], value, rtol=1e-4)
+            assert np.isclose(tbl['%s_pvcsuvr' %region][row], value / TRUE['Pons'], rtol=1e-4)
+        #without correction the small hot regions are underestimated
+        assert tbl['ctx_obs'][row] < 0.95 * TRUE['ctx']
+    assert np.isclose(tbl['Index_pvc'][0], (TRUE['ctx'] + TRUE['putamen']) / 2, rtol=1e-4)
+    assert np.isclose(tbl['Index_pvc'][1], TRUE['ctx'], rtol=1e-4)
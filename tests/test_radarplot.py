@@ -0,0 +1,50 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from datapipeline.tools import radarplot
+
+LABELS = ['CVLT', 'Stroop', 'Category', 'Trails', 'Tapping']
+
+
+@pytest.fixture
+def tbl():
+    pytest.importorskip('matplotlib')
+    rng = np.random.default_rng(0)
+    tbl = pd.DataFrame(rng.standard_normal((6, len(LABELS))), columns=LABELS)
+    tbl['codeb'] = ['x%d' %i for i in range(6)]
+    tbl.loc[2, 'Stroop'] = np.nan
+    return tbl
+
+
+def test_render_pngs(tbl, tmp_path):
+    outdir = str(tmp_path / 'radars')
+    paths = radarplot.render_radars(tbl, LABELS, outdir, namecols=['codeb'], chunksize=4)
+    assert paths == [os.path.join(outdir, 'x%d.png' %i) for i in range(6)]
+    assert all(os.path.getsize(p) > 0 for p in paths)
+
+
+def test_render_pdf_pages_are_vector(tbl, tmp_path):
+    outpath = str(tmp_path / 'radars.pdf')
+    assert radarplot.render_radars(tbl, LABELS, outpath, chunksize=4, jobs=2) == [outpath]
+    with open(outpath, 'rb') as f:
+        pdf = f.read()
+    assert len(re.findall(rb'/Type\s*/Page[^s]', pdf)) == 6
+    assert b'/Subtype /Image' not in pdf
+
+
+def test_missing_value_breaks_line():
+    pytest.importorskip('matplotlib')
+    from matplotlib.figure import Figure
+    theta = radarplot._radar_factory(len(LABELS))
+    ax = Figure().add_subplot(1, 1, 1, projection=radarplot._projections[len(LABELS)])
+    line = ax.plot(theta, np.zeros(len(theta)))[0]
+    patch = ax.fill(theta, np.zeros(len(theta)))[0]
+    value = np.array([1., np.nan, 2., 3., 4.])
+    radarplot._set_profile(line, patch, theta, value)
+    assert np.isnan(line.get_ydata()[1])
+    assert np.allclose(np.delete(line.get_ydata(), 1), [1., 2., 3., 4., 1.])
+    assert not patch.get_visible()
+    radarplot._set_profile(line, patch, theta, np.ones(len(theta)))
+    assert patch.get_visible()
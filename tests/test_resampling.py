@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from datapipeline.analyze import resampling
+
+
+def simulated_cohort(nsub, ntp, slope=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.tile(np.arange(ntp, dtype=float), nsub)
+    y = slope * t + rng.standard_normal(len(t))
+    return pd.DataFrame({'codeb': np.repeat(np.arange(nsub), ntp), 'Yrs': t, 'y': y})
+
+
+def true_se(ntp):
+    t = np.arange(ntp, dtype=float)
+    return 1. / np.sqrt(((t - t.mean()) ** 2).sum())
+
+
+def test_residual_bootstrap_coverage():
+    tbl = simulated_cohort(1000, 8)
+    ci = resampling.subject_slope_ci(tbl, 'codeb', 'Yrs', 'y', nboot=1000)
+    covered = (ci['y_sl_lo'] <= 0.5) & (ci['y_sl_hi'] >= 0.5)
+    assert 0.85 < covered.mean() < 0.99
+    rmsse = np.sqrt((ci['y_sl_se'] ** 2).mean())
+    assert abs(rmsse / true_se(8) - 1) < 0.1
+
+
+def test_residual_bootstrap_se_three_timepoints():
+    #raw residuals gave less than half the true standard error here
+    tbl = simulated_cohort(2000, 3)
+    ci = resampling.subject_slope_ci(tbl, 'codeb', 'Yrs', 'y', nboot=500)
+    rmsse = np.sqrt((ci['y_sl_se'] ** 2).mean())
+    assert abs(rmsse / true_se(3) - 1) < 0.15
+
+
+def test_too_few_timepoints():
+    tbl = simulated_cohort(5, 2)
+    ci = resampling.subject_slope_ci(tbl, 'codeb', 'Yrs', 'y', nboot=50)
+    assert ci['y_sl_lo'].isnull().all()
+    assert ci['y_sl'].notnull().all()
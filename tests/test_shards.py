@@ -0,0 +1,22 @@
+from datapipeline.tools import journal
+from datapipeline.tools import shards
+
+
+def double_or_die(x):
+    if x == 7:
+        raise KeyboardInterrupt
+    return 2 * x
+
+
+def test_journal_keeps_each_finished_subject(tmp_path):
+    path = str(tmp_path / 'work.journal')
+    try:
+        shards.shard_map(double_or_die, list(range(20)), journal=path, journaltag='t')
+    except KeyboardInterrupt:
+        pass
+    assert sorted(journal.load(path, 't')) == list(range(7))
+
+    results, failures = shards.shard_map(lambda x: 2 * x, list(range(20)), journal=path,
+                                         journaltag='t')
+    assert results == [2 * x for x in range(20)]
+    assert len(failures) == 0
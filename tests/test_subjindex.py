@@ -0,0 +1,58 @@
+import os
+import pickle
+import threading
+from datapipeline.tools import subjindex
+
+
+def make_subject(root, sub, files=tuple(subjindex.EXPECTED_FILES.values())):
+    for relpath in files:
+        path = os.path.join(root, sub, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+
+def test_unchanged_root_is_not_scanned(tmp_path, monkeypatch):
+    root = str(tmp_path / 'subjects')
+    cachepath = str(tmp_path / 'index.pkl')
+    make_subject(root, 'B1_v1')
+    make_subject(root, 'B1_v1.long.B1_base')
+    make_subject(root, 'B1_base')
+    #never holds the expected files
+    os.makedirs(os.path.join(root, 'fsaverage', 'surf'))
+    index = subjindex.subject_index(root, cachepath)
+    assert len(index) == 4
+    assert list(index.loc[index['sub'] == 'B1_v1.long.B1_base', 'base']) == ['B1_base']
+
+    subjindex.clear()
+    monkeypatch.setattr(subjindex.os, 'scandir', None)
+    assert subjindex.subject_index(root, cachepath).equals(index)
+
+
+def test_unfinished_subject_is_checked_again(tmp_path):
+    root = str(tmp_path / 'subjects')
+    make_subject(root, 'B1_v1', ['stats/aseg.stats'])
+    index = subjindex.subject_index(root)
+    assert not index['has_reconlog'].any()
+    make_subject(root, 'B1_v1')
+    subjindex.clear()
+    index = subjindex.subject_index(root)
+    assert index['has_reconlog'].all()
+
+
+def test_concurrent_roots_share_one_cache(tmp_path):
+    cachepath = str(tmp_path / 'index.pkl')
+    roots = []
+    for i in range(8):
+        root = str(tmp_path / ('subjects%d' %i))
+        make_subject(root, 'B%d_v1' %i)
+        roots.append(os.path.join(root, ''))
+    threads = [threading.Thread(target=subjindex.subject_index, args=(root, cachepath))
+               for root in roots]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    with open(cachepath, 'rb') as f:
+        assert sorted(pickle.load(f)) == sorted(roots)
+    assert os.listdir(str(tmp_path)).count('index.pkl') == 1
+    assert not [name for name in os.listdir(str(tmp_path)) if name.endswith('.tmp')]
@@ -0,0 +1,52 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+from datapipeline.tools import tablestore
+
+
+def make_table():
+    return pd.DataFrame({'codeb': [10015, 10012, 10012, 10020],
+                         'NP_Tp': [1, 2, 1, 1],
+                         'NP_Date': pd.to_datetime(['2012-05-01', '2013-02-01', '2011-09-01',
+                                                    '2014-01-01']),
+                         'score': [1.5, np.nan, 2.5, 3.0],
+                         'site': ['a', 'b', None, 'a'],
+                         'PIB_Pos': [True, False, True, False],
+                         'geometry_ok': pd.array([True, None, False, True], dtype='boolean'),
+                         'merged_ok': [True, np.nan, False, True]})
+
+
+def test_dtypes_round_trip(tmp_path):
+    dbpath = str(tmp_path / 'tables.db')
+    tbl = make_table()
+    tablestore.write_table(tbl, 'NPtbl', dbpath)
+    out = tablestore.query(dbpath, 'NPtbl')
+    expected = tbl.sort_values(['codeb', 'NP_Tp']).reset_index(drop=True)
+    expected['merged_ok'] = expected['merged_ok'].astype('boolean')
+    for col in ['codeb', 'NP_Tp', 'NP_Date', 'score', 'PIB_Pos', 'geometry_ok', 'merged_ok']:
+        assert out[col].dtype == expected[col].dtype, col
+        pd.testing.assert_series_equal(out[col], expected[col])
+    assert out['site'].isnull().equals(expected['site'].isnull())
+    assert (out['site'].dropna() == expected['site'].dropna()).all()
+    assert out['merged_ok'].isnull().sum() == 1
+
+
+def test_query_projects_and_filters_in_sqlite(tmp_path, monkeypatch):
+    dbpath = str(tmp_path / 'tables.db')
+    tablestore.write_table(make_table(), 'NPtbl', dbpath)
+    sqls = []
+    read_sql = pd.read_sql
+    monkeypatch.setattr(pd, 'read_sql', lambda sql, con, params=None:
+                        sqls.append((sql, params)) or read_sql(sql, con, params=params))
+    out = tablestore.query(dbpath, 'NPtbl', columns=['codeb', 'score'], codeb=[10012, 10020],
+                           NP_Date=('2011-01-01', '2013-12-31'))
+    assert list(out.columns) == ['codeb', 'score']
+    assert np.allclose(out['score'], [2.5, np.nan], equal_nan=True)
+    sql, params = sqls[-1]
+    assert sql.startswith('SELECT "codeb", "score" FROM "NPtbl" WHERE')
+    assert params == [10012, 10020, '2011-01-01 00:00:00', '2013-12-31 00:00:00']
+
+    con = sqlite3.connect(dbpath)
+    plan = ' '.join(row[-1] for row in con.execute('EXPLAIN QUERY PLAN ' + sql, params))
+    con.close()
+    assert 'USING INDEX' in plan